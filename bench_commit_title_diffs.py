@@ -0,0 +1,89 @@
+# Benchmarks how commit-title-diffs.py writes its per-title commits
+# on a synthetic repository with thousands of changed section files.
+# It compares the old way (an index.add and index.commit per title)
+# with building the trees in memory and committing from them.
+#
+# Usage:
+# python3 bench_commit_title_diffs.py [titles] [sections_per_title]
+
+import sys, os, os.path, time, shutil, subprocess, tempfile, importlib.util
+from collections import defaultdict
+from git import Repo, Blob
+
+def load_commit_title_diffs():
+	# commit-title-diffs.py isn't an importable module name.
+	path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "commit-title-diffs.py")
+	spec = importlib.util.spec_from_file_location("commit_title_diffs", path)
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	return module
+
+def section_xml(title, section, version):
+	return ("<section>\n  <num>{0}-{1}</num>\n  <heading>Section {1} of title {0}.</heading>\n"
+		"  <text>The Mayor shall issue rules under this section, version {2}.</text>\n</section>\n").format(title, section, version)
+
+def make_repo(path, titles, sections):
+	# Make a repository with one commit of every section, and then
+	# change every section in the working tree.
+	os.makedirs(path)
+	subprocess.check_call(["git", "init", "-q", path])
+	subprocess.check_call(["git", "-C", path, "config", "user.name", "bench"])
+	subprocess.check_call(["git", "-C", path, "config", "user.email", "bench@localhost"])
+	files = []
+	for t in range(1, titles + 1):
+		for s in range(1, sections + 1):
+			files.append(("Title-{}/Chapter-{}/{}-{}.xml".format(t, s % 10 + 1, t, s), t, s))
+	for fn, t, s in files:
+		os.makedirs(os.path.join(path, os.path.dirname(fn)), exist_ok=True)
+		with open(os.path.join(path, fn), "w") as f:
+			f.write(section_xml(t, s, 1))
+	subprocess.check_call(["git", "-C", path, "add", "-A"])
+	subprocess.check_call(["git", "-C", path, "commit", "-q", "-m", "initial"])
+	changed = []
+	for fn, t, s in files:
+		data = section_xml(t, s, 2).encode("utf-8")
+		with open(os.path.join(path, fn), "wb") as f:
+			f.write(data)
+		changed.append((fn, data))
+	return changed
+
+def commit_with_index(ctd, repo, changed):
+	# What commit-title-diffs.py used to do.
+	titles = defaultdict(list)
+	for path, binsha in ctd.store_blobs(repo, changed):
+		titles[ctd.title_of(path)].append(Blob(repo, binsha, mode=ctd.file_mode, path=path))
+	for title in sorted(titles, key=ctd.title_sort_key):
+		repo.index.add(titles[title])
+		repo.index.commit(title)
+
+def commit_with_trees(ctd, repo, changed):
+	titles = defaultdict(list)
+	for path, binsha in ctd.store_blobs(repo, changed):
+		titles[ctd.title_of(path)].append((path, binsha))
+	ctd.commit_titles(repo, titles, None)
+
+def main():
+	titles = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+	sections = int(sys.argv[2]) if len(sys.argv) > 2 else 250
+	ctd = load_commit_title_diffs()
+
+	tmp = tempfile.mkdtemp()
+	try:
+		print("making a repository with {} titles of {} sections...".format(titles, sections), file=sys.stderr)
+		changed = make_repo(os.path.join(tmp, "base"), titles, sections)
+		trees = {}
+		for name, commit in (("index", commit_with_index), ("trees", commit_with_trees)):
+			path = os.path.join(tmp, name)
+			shutil.copytree(os.path.join(tmp, "base"), path)
+			repo = Repo(path)
+			start = time.time()
+			commit(ctd, repo, changed)
+			print("{}: {} files in {} commits in {:.2f}s".format(name, len(changed), titles, time.time() - start))
+			trees[name] = repo.head.commit.tree.hexsha
+		if trees["index"] != trees["trees"]:
+			raise Exception("The two methods made different trees.")
+	finally:
+		shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+	main()
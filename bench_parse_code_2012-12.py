@@ -0,0 +1,129 @@
+# Checks and times parse_code_2012-12.py's pool of worker processes on a
+# synthetic West 2012-12 code. The same files are parsed with -j 1 and
+# with -j N, and the two outputs must be byte-identical. With --serial
+# REV, they're also compared with the parser at git revision REV, e.g.
+# the one from before the titles were parsed in parallel, which parsed
+# every title against one shared table of contents stack.
+#
+# The synthetic titles have the cases the merging of the titles' trees
+# has to get right: Divisions that span several titles, titles that
+# start with the end of the previous title's last section (set in
+# Courier New), repealed section ranges, and annotations.
+#
+# Usage:
+# python3 bench_parse_code_2012-12.py [--titles N] [--seed N] [-j N] [--serial REV]
+
+import sys, os, os.path, time, shutil, subprocess, tempfile, zipfile, random, argparse
+from xml.sax.saxutils import escape
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = "parse_code_2012-12.py"
+
+W = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+
+ROMAN = ["I", "II", "III", "IV", "V", "VI", "VII", "VIII", "IX", "X", "XI", "XII", "XIII", "XIV", "XV", "XVI", "XVII", "XVIII", "XIX", "XX"]
+
+def paragraph(text, font="Times New Roman", bold=False, indentation=None):
+	ppr = '<w:pPr><w:ind w:left="{}"/></w:pPr>'.format(indentation) if indentation else ""
+	rpr = '<w:rFonts w:ascii="{}"/>'.format(font) + ("<w:b/>" if bold else "")
+	return '<w:p>{}<w:r><w:rPr>{}</w:rPr><w:t xml:space="preserve">{}</w:t></w:r></w:p>'.format(ppr, rpr, escape(text))
+
+# West starts each section on a new page, which open_docx reads as the
+# end of a section of the document.
+SECTION_BREAK = '<w:p><w:pPr><w:sectPr/></w:pPr></w:p>'
+
+def title(r, t, division, continues_previous):
+	paras = []
+	def section(body):
+		paras.extend(body)
+		paras.append(SECTION_BREAK)
+
+	if continues_previous:
+		section([paragraph("| Column | Column |", font="Courier New"), paragraph("| 1 | 2 |", font="Courier New")])
+	for chapter in range(1, r.randint(2, 4)):
+		for n in range(1, r.randint(2, 6)):
+			location = [paragraph("Division {0}. Division {0} heading.".format(division)), paragraph("Title {0}. Title {0} heading.".format(t))]
+			if r.random() < 0.85:
+				location.append(paragraph("Chapter {0}. Chapter {0} of title {1}.".format(chapter, t)))
+			if r.random() < 0.2:
+				section(location + [paragraph("§§ {0}-{1}{2:02} to {0}-{1}{3:02}. [Repealed]".format(t, chapter, n, n + 1))])
+				continue
+			body = [paragraph("§ {}-{}{:02}. Section heading {}.".format(t, chapter, n, n))]
+			if r.random() < 0.3:
+				body.insert(0, paragraph("Formerly cited as DC ST 1981 § {}-{}".format(t, n)))
+			for k in range(r.randint(1, 5)):
+				body.append(paragraph("({}) The Mayor shall issue rules under paragraph {}.".format("abcde"[k], k), indentation=180 * r.randint(0, 2) or None))
+			body += [
+				paragraph("HISTORICAL AND STATUTORY NOTES"),
+				paragraph("Legislative History", bold=True),
+				paragraph("Law 4-{}.".format(n)),
+				paragraph("DC CODE § {}-{}{:02}".format(t, chapter, n)),
+				paragraph("Current through December 11, 2012"),
+			]
+			section(location + body)
+			if r.random() < 0.15:
+				section([paragraph("| x | y |", font="Courier New"), paragraph("more of the table", font="Courier New")])
+	return paras
+
+def make_code(path, titles, seed):
+	r = random.Random(seed)
+	os.makedirs(path)
+	division = 0
+	for t in range(1, titles + 1):
+		if r.random() < 0.4:
+			division = min(division + 1, len(ROMAN) - 1)
+		paras = title(r, t, ROMAN[division], t > 1 and r.random() < 0.15)
+		with zipfile.ZipFile(os.path.join(path, "{:03}.docx".format(t)), "w") as z:
+			z.writestr("word/document.xml", '<w:document xmlns:w="{}"><w:body>{}</w:body></w:document>'.format(W, "".join(paras)))
+
+def run(script, args, out_fn):
+	# Runs a copy of the parser that may not be in this directory, with
+	# this directory's modules importable.
+	env = dict(os.environ, PYTHONPATH=HERE)
+	start = time.time()
+	with open(out_fn, "wb") as f:
+		subprocess.check_call([sys.executable, script] + args, stdout=f, stderr=subprocess.DEVNULL, env=env)
+	return time.time() - start
+
+def main():
+	argparser = argparse.ArgumentParser(description="Check parse_code_2012-12.py's worker pool against one worker on a synthetic code.")
+	argparser.add_argument("--titles", type=int, default=100, help="number of titles (default: 100)")
+	argparser.add_argument("--seed", type=int, default=0, help="random seed for the synthetic code (default: 0)")
+	argparser.add_argument("-j", "--jobs", type=int, default=max(2, os.cpu_count() or 1), help="number of workers to compare with one (default: one per CPU, at least 2)")
+	argparser.add_argument("--serial", metavar="REV", help="also compare with the parser at this git revision")
+	args = argparser.parse_args()
+
+	tmp = tempfile.mkdtemp()
+	try:
+		code = os.path.join(tmp, "code")
+		make_code(code, args.titles, args.seed)
+		script = os.path.join(HERE, SCRIPT)
+
+		outputs = []
+		t = run(script, ["-j", "1", code], os.path.join(tmp, "j1.xml"))
+		print("-j 1: {:.2f}s".format(t))
+		outputs.append(("-j 1", os.path.join(tmp, "j1.xml")))
+		t = run(script, ["-j", str(args.jobs), code], os.path.join(tmp, "jN.xml"))
+		print("-j {}: {:.2f}s".format(args.jobs, t))
+		outputs.append(("-j {}".format(args.jobs), os.path.join(tmp, "jN.xml")))
+
+		if args.serial:
+			serial_script = os.path.join(tmp, SCRIPT)
+			with open(serial_script, "wb") as f:
+				f.write(subprocess.check_output(["git", "show", "{}:{}".format(args.serial, SCRIPT)], cwd=HERE))
+			t = run(serial_script, [code], os.path.join(tmp, "serial.xml"))
+			print("{}: {:.2f}s".format(args.serial, t))
+			outputs.append((args.serial, os.path.join(tmp, "serial.xml")))
+
+		with open(outputs[0][1], "rb") as f:
+			expected = f.read()
+		for name, fn in outputs[1:]:
+			with open(fn, "rb") as f:
+				if f.read() != expected:
+					raise Exception("{} and {} made different output.".format(outputs[0][0], name))
+		print("all {} outputs are identical ({} bytes)".format(len(outputs), len(expected)))
+	finally:
+		shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,85 @@
+# Benchmarks converting a volume of Statutes at Large files with
+# parse_statute.py, comparing one process per file (the way it used to
+# be run) with the batch mode that converts the whole volume in a pool
+# of worker processes. The statutes are synthetic.
+#
+# Usage:
+# python3 bench_parse_statute.py [files] [paragraphs_per_file] [jobs]
+
+import sys, os, os.path, time, shutil, subprocess, tempfile, zipfile, random, filecmp
+from xml.sax.saxutils import escape
+
+W = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+
+def paragraph(text, style=None, indentation=None, frame=False):
+	ppr = ""
+	if style: ppr += '<w:pStyle w:val="{}"/>'.format(style)
+	if frame: ppr += '<w:framePr w:w="2000" w:hAnchor="page" w:x="600"/>'
+	if indentation: ppr += '<w:ind w:left="{}"/>'.format(indentation)
+	return '<w:p>{}<w:r><w:t xml:space="preserve">{}</w:t></w:r></w:p>'.format(
+		"<w:pPr>" + ppr + "</w:pPr>" if ppr else "", escape(text))
+
+def statute(r, n, paragraphs):
+	header = [
+		paragraph("COUNCIL OF THE DISTRICT OF COLUMBIA\t\t{} DCSTAT {}".format(r.randint(55, 62), r.randint(1, 5000))),
+		paragraph("D.C. Law 20-{}, effective March {}, 2014".format(n, r.randint(1, 28))),
+	]
+	body = [
+		paragraph("Bill 20-{}".format(r.randint(1, 900)), "MarginNotes"),
+		paragraph("Act 20-{}".format(r.randint(1, 600)), "MarginNotes"),
+		paragraph("effective", "MarginNotes"),
+		paragraph("February {}, 2014".format(r.randint(1, 28)), "MarginNotes"),
+		paragraph("AN ACT"),
+		paragraph("To amend the District of Columbia Official Code to make changes.", "Longtitle"),
+	]
+	for i in range(paragraphs):
+		k = r.random()
+		if k < 0.1:
+			body.append(paragraph("Sec. {}".format(i), frame=True))
+		elif k < 0.3:
+			body.append(paragraph("“({}) The Mayor shall issue rules.”".format(i), indentation=720 * r.randint(1, 3)))
+		else:
+			body.append(paragraph("({}) The Mayor shall issue rules under this act.".format(i), indentation=720 * r.randint(0, 3)))
+	return header, body
+
+def make_docx(path, header, body):
+	with zipfile.ZipFile(path, "w") as z:
+		z.writestr("word/document.xml", '<w:document xmlns:w="{}"><w:body>{}</w:body></w:document>'.format(W, "".join(body)))
+		z.writestr("word/header1.xml", '<w:hdr xmlns:w="{}">{}</w:hdr>'.format(W, "".join(header)))
+
+def main():
+	files = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+	paragraphs = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+	jobs = sys.argv[3] if len(sys.argv) > 3 else str(os.cpu_count())
+	script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "parse_statute.py")
+
+	tmp = tempfile.mkdtemp()
+	try:
+		print("making {} statutes of {} paragraphs...".format(files, paragraphs), file=sys.stderr)
+		volume = os.path.join(tmp, "volume")
+		os.makedirs(volume)
+		r = random.Random(0)
+		for n in range(files):
+			make_docx(os.path.join(volume, "A20-{:03}.docx".format(n)), *statute(r, n, paragraphs))
+
+		start = time.time()
+		os.makedirs(os.path.join(tmp, "single"))
+		for n in range(files):
+			with open(os.path.join(tmp, "single", "A20-{:03}.xml".format(n)), "wb") as f:
+				subprocess.check_call([sys.executable, script, os.path.join(volume, "A20-{:03}.docx".format(n))], stdout=f)
+		single = time.time() - start
+		print("one process per file: {:.2f}s, {:.1f} files/s".format(single, files / single))
+
+		start = time.time()
+		subprocess.check_call([sys.executable, script, "-j", jobs, "-o", os.path.join(tmp, "batch"), volume])
+		batch = time.time() - start
+		print("batch with {} workers: {:.2f}s, {:.1f} files/s ({:.1f}x)".format(jobs, batch, files / batch, single / batch))
+
+		match, mismatch, errors = filecmp.cmpfiles(os.path.join(tmp, "single"), os.path.join(tmp, "batch"), os.listdir(os.path.join(tmp, "single")), shallow=False)
+		if mismatch or errors:
+			raise Exception("The two methods made different files.")
+	finally:
+		shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+	main()
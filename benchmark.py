@@ -0,0 +1,384 @@
+# Times the stages of building the DC Code, from the .docx files to the
+# split-up files and the State Decoded export, on a synthetic code made by
+# make_synthetic_code.py, and records the results so that a slowdown from
+# a parser fix shows up next to the commit that caused it.
+#
+# Usage:
+# python3 benchmark.py [-r N] [--history benchmark_history.json] [--baseline COMMIT] [--threshold 0.10] [--seed N] [--divisions N] [--titles N] [--chapters N] [--sections N]
+#
+# The stages are:
+#
+# docx-decode          worddoc.open_docx on each Division file
+# cache-load           loading the JSON cache that parse_code_2016-03.py keeps of open_docx's output
+# parse                running parsers.Parser over the paragraphs (parse_code_2016-03.parse_doc_section)
+# indentation          infer_list_indentation on the paragraph numbers of each section
+# insert-tables        insert_tables.py
+# split-up             split_up.py
+# statedecoded-export  export_to_statedecoded.export
+# compare              compare_helper.compare against a copy of the code with some sections changed
+#
+# Each stage is run N times (3 by default), each time in a fresh process,
+# and the best time and the smallest peak resident memory are kept. Only
+# the stage itself is timed and measured, not loading its input from the
+# previous stage's output. Peak memory includes the worker processes that
+# a stage starts. (The peak is reset at the start of the stage through
+# /proc/self/clear_refs; where that isn't possible, e.g. not on Linux, it
+# also includes loading the stage's input.)
+#
+# The results are added to the history file (benchmark_history.json by
+# default, which git ignores) under the current git commit
+# (with "+dirty" appended if there are uncommitted changes), along with the
+# size of the synthetic code, and compared with a baseline: the commit
+# given with --baseline, or else the most recently recorded other run of
+# the same size. A stage that got slower or used more memory by more than
+# the threshold (10% by default) is flagged, and then the exit status is 1.
+#
+# split_up.py and export_to_statedecoded.py read older schemas of the code
+# XML than parse_code_2016-03.py writes, so before those stages the parsed
+# code is converted: <prefix> children are added to <container>s for
+# split_up.py, and the whole document is rewritten as nested <level>s for
+# export_to_statedecoded.py and compare_helper.py.
+
+import sys, os, os.path, time, json, shutil, subprocess, tempfile, argparse, datetime, importlib, runpy, gc, glob, contextlib, platform
+import lxml.etree as etree
+from memprofile import reset_peak_rss, peak_rss_kb
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+def stage_docx_decode(work, timer):
+	from worddoc import open_docx
+	parse_code = importlib.import_module("parse_code_2016-03")
+	docs = []
+	with timer:
+		for path in docx_files(work):
+			docs.append(open_docx(path, pict=parse_code.pict_handler))
+
+	# Number the paragraphs and save the cache the way parse_code_2016-03.parse_file does.
+	start_para_index = 0
+	os.makedirs(os.path.join(work, "cache"), exist_ok=True)
+	for path, doc in zip(docx_files(work), docs):
+		for section in doc["sections"]:
+			for para_index, para in enumerate(section["paragraphs"], start_para_index):
+				para["index"] = para_index
+			start_para_index += len(section["paragraphs"])
+		with open(cache_path(work, path), "w") as f:
+			json.dump(doc, f, indent=2)
+
+def stage_cache_load(work, timer):
+	with timer:
+		for path in docx_files(work):
+			with open(cache_path(work, path)) as f:
+				json.load(f)
+
+def stage_parse(work, timer):
+	from parsers import _make_node
+	parse_code = importlib.import_module("parse_code_2016-03")
+	docs = []
+	for path in docx_files(work):
+		with open(cache_path(work, path)) as f:
+			docs.append(json.load(f))
+
+	dom = etree.Element("code")
+	_make_node(dom, "heading", "Code of the District of Columbia")
+	with timer:
+		for doc in docs:
+			for section in doc["sections"]:
+				parse_code.parse_doc_section(section, dom)
+
+	with open(os.path.join(work, "code.xml"), "wb") as f:
+		f.write(etree.tostring(dom, pretty_print=True, encoding="utf-8", xml_declaration=True))
+
+def stage_indentation(work, timer):
+	from infer_list_indentation import infer_list_indentation
+	# The paragraph numbers of each section, in document order, without
+	# their parentheses, as in parse_code_2013-10.do_paragraph_indentation.
+	lists = []
+	for section in etree.parse(os.path.join(work, "code.xml")).iter("section"):
+		nums = [num.text.strip("().") for num in section.iterfind(".//para/num") if num.text]
+		if nums:
+			lists.append(nums)
+	with timer:
+		for nums in lists:
+			infer_list_indentation(nums)
+
+def stage_insert_tables(work, timer):
+	with timer:
+		run_script("insert_tables.py", [os.path.join(work, "code.xml"), os.path.join(work, "tables.xml"), os.path.join(work, "codet.xml")])
+
+def stage_split_up(work, timer):
+	dom = etree.parse(os.path.join(work, "codet.xml"))
+	add_container_prefixes(dom.getroot())
+	dom.write(os.path.join(work, "code-split.xml"), encoding="utf-8")
+	del dom
+	out_dir = os.path.join(work, "split")
+	shutil.rmtree(out_dir, ignore_errors=True)
+	os.makedirs(out_dir)
+	with timer:
+		with open(os.path.join(work, "code-split.xml")) as f:
+			run_script("split_up.py", [out_dir + "/"], stdin=f)
+
+def stage_statedecoded_export(work, timer):
+	from export_to_statedecoded import export
+	levels = to_levels(etree.parse(os.path.join(work, "codet.xml")).getroot())
+	etree.ElementTree(levels).write(os.path.join(work, "code-levels.xml"), encoding="utf-8")
+	del levels
+	out_dir = os.path.join(work, "statedecoded")
+	shutil.rmtree(out_dir, ignore_errors=True)
+	os.makedirs(out_dir)
+	with timer:
+		with open(os.path.join(work, "code-levels.xml"), "rb") as f:
+			export(f, out_dir, jobs=1, rewrite_all=True)
+
+def stage_compare(work, timer):
+	from compare_helper import compare
+	# A new edition in which every tenth section has a changed sentence.
+	dom = etree.parse(os.path.join(work, "code-levels.xml"))
+	for i, section in enumerate(dom.xpath("//level[type='section']")):
+		text = section.find(".//text")
+		if i % 10 == 0 and text is not None:
+			text.text = (text.text or "") + " The Mayor shall issue rules to implement this section."
+	dom.write(os.path.join(work, "code-levels-new.xml"), encoding="utf-8")
+	del dom
+	with timer:
+		with contextlib.redirect_stdout(open(os.devnull, "w")):
+			compare(os.path.join(work, "code-levels.xml"), os.path.join(work, "code-levels-new.xml"), 1)
+
+STAGES = [
+	("docx-decode", stage_docx_decode),
+	("cache-load", stage_cache_load),
+	("parse", stage_parse),
+	("indentation", stage_indentation),
+	("insert-tables", stage_insert_tables),
+	("split-up", stage_split_up),
+	("statedecoded-export", stage_statedecoded_export),
+	("compare", stage_compare),
+]
+
+def docx_files(work):
+	return sorted(glob.glob(os.path.join(work, "docx", "*.docx")))
+
+def cache_path(work, path):
+	return os.path.join(work, "cache", os.path.basename(path) + ".json")
+
+def run_script(script, args, stdin=None):
+	# Run one of the command-line scripts in this process, as if it were
+	# run with the given arguments, discarding its output on stdout.
+	saved = sys.argv, sys.stdin
+	sys.argv = [script] + args
+	if stdin is not None: sys.stdin = stdin
+	try:
+		with contextlib.redirect_stdout(open(os.devnull, "w")):
+			runpy.run_path(os.path.join(HERE, script), run_name="__main__")
+	except SystemExit as e:
+		if e.code:
+			print("{} exited with status {}".format(script, e.code), file=sys.stderr)
+	finally:
+		sys.argv, sys.stdin = saved
+
+def add_container_prefixes(node):
+	# split_up.py finds a container's type in a <prefix> child, but the
+	# parser puts it on the container's parent as @childPrefix.
+	for child in node.iterfind("container"):
+		etree.SubElement(child, "prefix").text = node.get("childPrefix")
+		child.insert(0, child[-1])
+		add_container_prefixes(child)
+
+def to_levels(node):
+	# Rewrites the parser's output as the nested <level>s of the 2013-10
+	# edition's schema.
+	level = etree.Element("level")
+	def add(tag, text):
+		if text is not None:
+			etree.SubElement(level, tag).text = text
+	if node.tag == "code":
+		add("type", "document")
+	elif node.tag == "container":
+		add("type", "toc")
+		add("prefix", node.getparent().get("childPrefix"))
+	elif node.tag == "section" and node.find("reason") is not None:
+		add("type", "placeholder")
+		if node.find("num-end") is not None:
+			add("section-start", node.findtext("num"))
+			add("section-end", node.findtext("num-end"))
+			add("section-range-type", "range")
+		else:
+			add("section", node.findtext("num"))
+		add("heading", node.findtext("heading"))
+		add("reason", node.findtext("reason"))
+		return level
+	elif node.tag == "section":
+		add("type", "section")
+	elif node.tag == "annotations":
+		add("type", "annotations")
+	for child in node:
+		if child.tag in ("num", "heading"):
+			add(child.tag, child.text)
+		elif child.tag in ("text", "afterText"):
+			add("text", "".join(child.itertext()))
+		elif child.tag in ("container", "section", "para", "annotations", "annoGroup"):
+			level.append(to_levels(child))
+	return level
+
+class StageTimer:
+	# Measures the time and peak memory of the part of a stage inside a
+	# `with` block.
+
+	def __init__(self):
+		self.seconds = 0
+		self.peak_rss_kb = 0
+
+	def __enter__(self):
+		gc.collect()
+		self.can_reset_peak = reset_peak_rss()
+		self.started = time.perf_counter()
+
+	def __exit__(self, *exc):
+		self.seconds += time.perf_counter() - self.started
+		self.peak_rss_kb = max(self.peak_rss_kb, peak_rss_kb(self.can_reset_peak))
+
+def run_stage(name, work):
+	# Child process entry point. Prints the measurements as JSON.
+	timer = StageTimer()
+	dict(STAGES)[name](work, timer)
+	print(json.dumps({ "seconds": timer.seconds, "peak_rss_kb": timer.peak_rss_kb }))
+
+def measure_stage(name, work, repeat, log):
+	# Runs the stage in fresh processes and returns the best measurements.
+	results = []
+	for _ in range(repeat):
+		p = subprocess.run([sys.executable, os.path.abspath(__file__), "--stage", name, work],
+			stdout=subprocess.PIPE, stderr=log, universal_newlines=True)
+		if p.returncode != 0:
+			log.flush()
+			with open(log.name) as f:
+				raise Exception("Stage {} failed:\n{}".format(name, "".join(f.readlines()[-20:])))
+		results.append(json.loads(p.stdout.strip().splitlines()[-1]))
+	return {
+		"seconds": round(min(r["seconds"] for r in results), 4),
+		"peak_rss_kb": min(r["peak_rss_kb"] for r in results),
+	}
+
+def git_commit():
+	try:
+		commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=HERE, universal_newlines=True).strip()
+	except (OSError, subprocess.CalledProcessError):
+		return "unknown"
+	if subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"], cwd=HERE):
+		commit += "+dirty"
+	return commit
+
+def resolve_commit(rev):
+	try:
+		return subprocess.check_output(["git", "rev-parse", rev], cwd=HERE, stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+	except (OSError, subprocess.CalledProcessError):
+		return rev
+
+def load_history(fn):
+	try:
+		with open(fn) as f:
+			return json.load(f)
+	except FileNotFoundError:
+		return { }
+
+def save_history(fn, history):
+	with open(fn + ".tmp", "w") as f:
+		json.dump(history, f, indent=2, sort_keys=True)
+	os.replace(fn + ".tmp", fn)
+
+def find_baseline(history, key, params, baseline):
+	if baseline:
+		for k in (baseline, resolve_commit(baseline)):
+			if k in history:
+				return k
+		raise ValueError("No benchmark results recorded for " + baseline)
+	others = [k for k, run in history.items() if k != key and run["params"] == params]
+	return max(others, key=lambda k: history[k]["date"]) if others else None
+
+def compare_runs(run, base, threshold):
+	# Prints a table of the stages and returns the number of regressions.
+	regressions = 0
+	print("{:<20} {:>9} {:>9} {:>8}  {:>9} {:>9} {:>8}".format("stage", "seconds", "baseline", "change", "peak MB", "baseline", "change"))
+	for name, _ in STAGES:
+		m = run["stages"][name]
+		b = base["stages"].get(name) if base else None
+		line = "{:<20} {:>9.3f}".format(name, m["seconds"])
+		flags = []
+		if b:
+			change = m["seconds"] / b["seconds"] - 1 if b["seconds"] else 0
+			line += " {:>9.3f} {:>+7.1%}".format(b["seconds"], change)
+			# Ignore changes too small to measure reliably.
+			if change > threshold and m["seconds"] - b["seconds"] > .01:
+				flags.append("SLOWER")
+		else:
+			line += " {:>9} {:>8}".format("", "")
+		line += "  {:>9.1f}".format(m["peak_rss_kb"] / 1024)
+		if b:
+			change = m["peak_rss_kb"] / b["peak_rss_kb"] - 1 if b["peak_rss_kb"] else 0
+			line += " {:>9.1f} {:>+7.1%}".format(b["peak_rss_kb"] / 1024, change)
+			if change > threshold and m["peak_rss_kb"] - b["peak_rss_kb"] > 1024:
+				flags.append("MORE MEMORY")
+		if flags:
+			line += "  " + ", ".join(flags)
+			regressions += 1
+		print(line)
+	return regressions
+
+def main():
+	argparser = argparse.ArgumentParser(description="Benchmark the DC Code build on a synthetic code.")
+	argparser.add_argument("-r", "--repeat", type=int, default=3, help="runs of each stage, keeping the best (default: 3)")
+	argparser.add_argument("--history", default="benchmark_history.json", help="file to record results in (default: benchmark_history.json)")
+	argparser.add_argument("--no-record", action="store_true", help="don't add the results to the history file")
+	argparser.add_argument("--baseline", help="commit to compare with (default: the last recorded run of the same size)")
+	argparser.add_argument("--threshold", type=float, default=0.10, help="flag stages that are slower or use more memory by this fraction (default: 0.10)")
+	argparser.add_argument("--work-dir", help="keep the synthetic code and the outputs of each stage in this directory")
+	argparser.add_argument("--seed", type=int, default=0)
+	argparser.add_argument("--divisions", type=int, default=2)
+	argparser.add_argument("--titles", type=int, default=3)
+	argparser.add_argument("--chapters", type=int, default=10)
+	argparser.add_argument("--sections", type=int, default=25)
+	args = argparser.parse_args()
+
+	import make_synthetic_code
+	params = { "seed": args.seed, "divisions": args.divisions, "titles": args.titles, "chapters": args.chapters, "sections": args.sections }
+	code_args = argparse.Namespace(paragraphs=6, table_rate=0.03, **params)
+
+	work = args.work_dir or tempfile.mkdtemp()
+	try:
+		paragraphs = make_synthetic_code.make_code(os.path.join(work, "docx"), code_args)
+		shutil.move(os.path.join(work, "docx", "tables.xml"), os.path.join(work, "tables.xml"))
+		print("{} paragraphs in {} files".format(paragraphs, args.divisions), file=sys.stderr)
+
+		run = {
+			"commit": git_commit(),
+			"date": datetime.datetime.now().isoformat(timespec="seconds"),
+			"python": platform.python_version(),
+			"params": params,
+			"stages": { },
+		}
+		with open(os.path.join(work, "benchmark.log"), "w") as log:
+			for name, _ in STAGES:
+				print(name + "...", file=sys.stderr)
+				run["stages"][name] = measure_stage(name, work, args.repeat, log)
+	finally:
+		if not args.work_dir:
+			shutil.rmtree(work)
+
+	history = load_history(args.history)
+	baseline = find_baseline(history, run["commit"], params, args.baseline)
+	if baseline:
+		print("compared with", baseline)
+	regressions = compare_runs(run, history.get(baseline), args.threshold)
+
+	if not args.no_record:
+		history[run["commit"]] = run
+		save_history(args.history, history)
+
+	if regressions:
+		sys.exit(1)
+
+if __name__ == "__main__":
+	if len(sys.argv) == 4 and sys.argv[1] == "--stage":
+		run_stage(sys.argv[2], sys.argv[3])
+	else:
+		main()
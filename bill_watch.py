@@ -1,4 +1,49 @@
-import sys, time, os, lxml.etree as etree, re
+# Watches a folder of bill .docx files and keeps a parallel folder of
+# parsed XML up to date.
+#
+# Usage:
+# python3 bill_watch.py [--poll] in_path out_path
+#
+# On startup the whole folder is walked to catch up on anything that
+# changed while we weren't running. After that we only react to file
+# system events. Events are debounced per path, since Word writes temp
+# files and saves several times: each path is handled once it has gone
+# quiet, and the paths that go quiet together are handled together.
+# With --poll, the folder is walked every second instead.
+#
+# out_path/state.json records a hash of each docx and of the parser's
+# source code at the time it was parsed, so a bill is only parsed again
+# when its contents or the parser actually change.
+#
+# Bills are parsed in a pool of -j worker processes (two by default) so
+# that one slow bill doesn't hold up the others. A parse that takes
+# longer than --timeout seconds is stopped and recorded as an error, and
+# a parse that is still running when the bill is saved again is thrown
+# away in favor of the new one. Output files are written to a temporary
+# file and renamed into place, so they are never seen half-written.
+#
+# Each output folder has a .manifest.json with the error count of each
+# bill in it and the totals of each folder under it. Index pages are
+# made from the manifests, and only for folders whose manifest changed.
+#
+# The syntax-highlighted view of a bill, pygments/.../bill.html, is made
+# by a low-priority background thread after the bill is parsed, or on
+# demand. Highlighted HTML is cached in html-cache/ by the hash of the
+# XML, so a bill whose XML didn't change isn't highlighted again. All of
+# the views share the one stylesheet, style.css.
+#
+# With --port, the outputs are also served at http://127.0.0.1:PORT/,
+# which shows the index pages and highlighted views without needing
+# file:// access. A bill can be uploaded there with
+#   curl -H 'X-Bill-Watch: upload' --data-binary @bill.docx http://127.0.0.1:PORT/upload/folder/bill.docx
+# which saves it into in_path and parses it ahead of anything else waiting.
+# Uploads without that header, or from a page on another site (by Origin
+# or Host), are refused, so that a web page open in the reviewer's browser
+# can't write files into in_path.
+
+import sys, time, os, lxml.etree as etree, re, threading, argparse, hashlib, json
+import multiprocessing, multiprocessing.connection, posixpath, urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from parse_bill import parse
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler, FileCreatedEvent, DirCreatedEvent
@@ -16,32 +61,400 @@ html_formatter = HtmlFormatter(style='igor')
 
 error_re = re.compile(r'errors="(\d+)"')
 
+STATE_FILENAME = 'state.json'
+MANIFEST_FILENAME = '.manifest.json'
+HTML_CACHE = 'html-cache'
+
+def file_digest(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def parser_version():
+    # A hash of the parser's source code, so that bills are parsed again
+    # when the parser changes.
+    h = hashlib.sha1()
+    here = os.path.dirname(os.path.abspath(__file__))
+    for fn in ('parse_bill.py', 'matchers.py', 'worddoc.py'):
+        with open(os.path.join(here, fn), 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def write_atomic(path, data):
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+
+def write_if_changed(path, data):
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == data:
+                return
+    except FileNotFoundError:
+        pass
+    write_atomic(path, data)
+
+def error_xml(message):
+    node = etree.Element('error', errors='1')
+    node.text = message
+    return etree.tostring(node, encoding='utf-8')
+
+def summarize(xml):
+    # What the index pages show about a bill, from its XML. The error count
+    # is an attribute of the root element, on the first line.
+    match = error_re.search(xml.split(b'\n', 1)[0].decode('utf-8', 'replace'))
+    return {'errors': int(match.group(1)) if match else 0, 'hash': hashlib.sha1(xml).hexdigest()}
+
+def parse_to_xml(src_path):
+    try:
+        dom = parse(src_path)
+        return etree.tostring(dom, pretty_print=True, encoding="utf-8")
+    except BaseException as e:
+        print('error parsing {}: {}'.format(src_path, e), file=sys.stderr)
+        return error_xml('A fatal parsing error occurred. Please contact support. {}'.format(e))
+
+def parse_worker(conn):
+    # Runs in a worker process. Parses each path sent to it and sends back the XML.
+    while True:
+        try:
+            src_path = conn.recv()
+        except EOFError:
+            return
+        conn.send_bytes(parse_to_xml(src_path))
+
+class ParseWorker:
+    def __init__(self, context):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=parse_worker, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.job = None
+        self.deadline = None
+
+    def start(self, job, timeout):
+        self.job = job
+        self.deadline = time.monotonic() + timeout
+        self.conn.send(job[0])
+
+    def kill(self):
+        self.process.terminate()
+        self.process.join()
+        self.conn.close()
+
+class ParsePool(threading.Thread):
+    """
+    Parses bills in up to `jobs` worker processes and hands each result to
+    callback(src_path, key, xml) on this thread. key identifies the version
+    of the file being parsed. Submitting a path again with a different key
+    replaces it if it hasn't started yet and stops it if it has, so only
+    the latest version's result is ever handed over. Workers that run past
+    `timeout` seconds or die are killed and replaced. idle_callback() is
+    called whenever the pool runs out of work.
+    """
+    def __init__(self, callback, idle_callback, jobs=2, timeout=60):
+        super().__init__(daemon=True)
+        self.callback = callback
+        self.idle_callback = idle_callback
+        self.jobs = jobs
+        self.timeout = timeout
+        self.context = multiprocessing.get_context('spawn')
+        self.workers = []
+        self.pending = {}
+        self.lock = threading.Lock()
+        # The pool's thread waits on the workers' pipes, so it's woken up by
+        # a message on this pipe too. Only one wakeup is sent until the
+        # thread has read it, so the pipe can't fill up and block submit.
+        self.wakeup_recv, self.wakeup_send = multiprocessing.Pipe(False)
+        self.wakeup_sent = False
+
+    def submit(self, src_path, key, priority=False):
+        # A priority job goes ahead of the other pending jobs.
+        with self.lock:
+            if any(w.job == (src_path, key) for w in self.workers):
+                return
+            if self.pending.get(src_path) == key and not priority:
+                return
+            self.pending.pop(src_path, None)
+            if priority:
+                self.pending = dict([(src_path, key)] + list(self.pending.items()))
+            else:
+                self.pending[src_path] = key
+            self.cancel_running(src_path)
+            self.wakeup()
+
+    def cancel(self, src_path):
+        with self.lock:
+            self.pending.pop(src_path, None)
+            self.cancel_running(src_path)
+            self.wakeup()
+
+    def wakeup(self):
+        # Called with the lock held.
+        if not self.wakeup_sent:
+            self.wakeup_send.send(None)
+            self.wakeup_sent = True
+
+    def cancel_running(self, src_path):
+        for w in self.workers:
+            if w.job is not None and w.job[0] == src_path:
+                w.job = None
+
+    def run(self):
+        while True:
+            results = []
+            with self.lock:
+                # Kill workers whose job was cancelled or took too long.
+                now = time.monotonic()
+                for w in list(self.workers):
+                    if w.deadline is None:
+                        continue
+                    if w.job is not None and now < w.deadline:
+                        continue
+                    if w.job is not None:
+                        src_path, key = w.job
+                        print('parsing {} took more than {} seconds, stopped'.format(src_path, self.timeout), file=sys.stderr)
+                        results.append((src_path, key, error_xml('Parsing took longer than {} seconds and was stopped. Please contact support.'.format(self.timeout))))
+                    w.kill()
+                    self.workers.remove(w)
+
+                # Start pending jobs on idle workers.
+                while self.pending:
+                    idle = [w for w in self.workers if w.deadline is None]
+                    if idle:
+                        w = idle[0]
+                    elif len(self.workers) < self.jobs:
+                        w = ParseWorker(self.context)
+                        self.workers.append(w)
+                    else:
+                        break
+                    src_path = next(iter(self.pending))
+                    w.start((src_path, self.pending.pop(src_path)), self.timeout)
+
+                busy = {w.conn: w for w in self.workers if w.deadline is not None}
+                deadline = min((w.deadline for w in busy.values()), default=None)
+                is_idle = not busy and not self.pending
+
+            for result in results:
+                self.callback(*result)
+            if is_idle:
+                self.idle_callback()
+
+            timeout = max(0, deadline - time.monotonic()) if deadline is not None else None
+            ready = multiprocessing.connection.wait(list(busy) + [self.wakeup_recv], timeout)
+            results = []
+            with self.lock:
+                if self.wakeup_recv in ready:
+                    self.wakeup_recv.recv()
+                    self.wakeup_sent = False
+                for conn in ready:
+                    w = busy.get(conn)
+                    if w is None:
+                        continue
+                    try:
+                        xml = conn.recv_bytes()
+                    except (EOFError, OSError):
+                        # The worker died, e.g. by running out of memory or stack.
+                        w.kill()
+                        if w.job is not None:
+                            results.append(w.job + (error_xml('The parser crashed (exit code {}). Please contact support.'.format(w.process.exitcode)),))
+                        self.workers.remove(w)
+                        continue
+                    if w.job is not None:
+                        results.append(w.job + (xml,))
+                        w.job = None
+                        w.deadline = None
+                    # Otherwise the job was cancelled while the result was on its
+                    # way. The worker is killed on the next time around.
+            for result in results:
+                self.callback(*result)
+
+    def shutdown(self):
+        with self.lock:
+            for w in self.workers:
+                w.kill()
+            self.workers = []
+
+class Highlighter(threading.Thread):
+    """
+    Makes the highlighted views of bills in the background, most recently
+    parsed first, at low priority so that it doesn't slow down parsing.
+    """
+    def __init__(self, handler):
+        super().__init__(daemon=True)
+        self.handler = handler
+        self.pending = {}
+        self.condition = threading.Condition()
+
+    def schedule(self, src_path):
+        with self.condition:
+            self.pending.pop(src_path, None)
+            self.pending[src_path] = None
+            self.condition.notify()
+
+    def run(self):
+        try:
+            # On Linux this lowers the priority of just this thread.
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError):
+            pass
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                src_path = next(reversed(self.pending))
+                del self.pending[src_path]
+            try:
+                self.handler.publish_html(src_path)
+            except Exception as e:
+                print('error highlighting {}: {}'.format(src_path, e), file=sys.stderr)
+
+class Debouncer(threading.Thread):
+    """
+    Collects (path, action) events and hands them to callback in batches.
+    A later event for a path replaces an earlier one. Each path is handed
+    over once no new event has arrived for it for `delay` seconds, or once
+    its first event has waited `max_wait` seconds, so that a file that
+    keeps being saved neither holds up the others nor is put off forever.
+    The paths that come due together are handed over as one batch, along
+    with any pending events for the folders they're in.
+    """
+    def __init__(self, callback, delay=1.0, max_wait=10.0):
+        super().__init__(daemon=True)
+        self.callback = callback
+        self.delay = delay
+        self.max_wait = max_wait
+        # path => [action, time of its first event, time of its last event]
+        self.pending = {}
+        self.condition = threading.Condition()
+
+    def schedule(self, path, action):
+        with self.condition:
+            now = time.monotonic()
+            event = self.pending.get(path)
+            if event is None:
+                self.pending[path] = [action, now, now]
+            else:
+                event[0] = action
+                event[2] = now
+            self.condition.notify()
+
+    def due(self, event):
+        action, first_event, last_event = event
+        return min(last_event + self.delay, first_event + self.max_wait)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    if not self.pending:
+                        self.condition.wait()
+                        continue
+                    now = time.monotonic()
+                    due = min(self.due(event) for event in self.pending.values())
+                    if now >= due:
+                        break
+                    self.condition.wait(due - now)
+                paths = [path for path, event in self.pending.items() if self.due(event) <= now]
+                paths += [
+                    path for path, event in self.pending.items()
+                    if event[0] == 'dir' and path not in paths and any(p.startswith(path + os.sep) for p in paths)
+                ]
+                batch = {path: self.pending.pop(path)[0] for path in paths}
+            try:
+                self.callback(batch)
+            except Exception as e:
+                print('error handling changes:', e, file=sys.stderr)
+
 class EventHandler(FileSystemEventHandler):
-    def __init__(self, in_path, out_path):
+    def __init__(self, in_path, out_path, jobs=2, timeout=60):
         self.in_path = in_path
         self.out_path = out_path
+        self.debouncer = Debouncer(self.process)
+        self.pool = ParsePool(self.finish_file, self.finish_batch, jobs, timeout)
+        # Held while the state or the output folder is being changed, since
+        # that happens on the debouncer's thread and the pool's thread.
+        self.lock = threading.RLock()
+        self.manifests = {}
+        self.changed_dirs = set()
+        self.highlighter = Highlighter(self)
+        os.makedirs(os.path.join(out_path, HTML_CACHE), exist_ok=True)
+        write_if_changed(os.path.join(out_path, 'style.css'), html_formatter.get_style_defs('.highlight').encode('utf-8'))
+        self.parser_version = parser_version()
+        self.state = self.load_state()
+        self.state_changed = False
+
+    def manifest_path(self, src_path):
+        return os.path.join(self.pygments_path(src_path), MANIFEST_FILENAME)
+
+    def manifest(self, src_path):
+        # A folder's manifest has a summary of each bill in it, the totals of
+        # each folder in it, and its own totals, which include subfolders.
+        manifest = self.manifests.get(src_path)
+        if manifest is None:
+            try:
+                with open(self.manifest_path(src_path)) as f:
+                    manifest = json.load(f)
+            except FileNotFoundError:
+                manifest = {'bills': {}, 'dirs': {}, 'totals': {}}
+            self.manifests[src_path] = manifest
+        return manifest
+
+    def update_manifest(self, src_path, kind, name, summary):
+        # Set (or with None, remove) the summary of a bill or folder in a
+        # folder's manifest, and remember that the folder changed if it did.
+        entries = self.manifest(src_path)[kind]
+        if entries.get(name) == summary:
+            return
+        if summary is None:
+            del entries[name]
+        else:
+            entries[name] = summary
+        self.changed_dirs.add(src_path)
+
+    def update_bill(self, src_path, summary):
+        self.update_manifest(os.path.dirname(src_path), 'bills', os.path.basename(src_path), summary)
+
+    def update_indexes(self):
+        # Recompute the totals, and write the manifest and index page, of
+        # each folder that changed, deepest first. A change in a folder's
+        # totals changes its parent's manifest, and so on up.
+        while self.changed_dirs:
+            path = max(self.changed_dirs, key=lambda p: p.count(os.sep))
+            self.changed_dirs.remove(path)
+            if not os.path.isdir(self.pygments_path(path)):
+                self.manifests.pop(path, None)
+                continue
+            manifest = self.manifest(path)
+            totals = {'bills': len(manifest['bills']), 'errors': 0}
+            for summary in manifest['bills'].values():
+                totals['errors'] += summary['errors']
+            for summary in manifest['dirs'].values():
+                totals['bills'] += summary['bills']
+                totals['errors'] += summary['errors']
+            manifest['totals'] = totals
+            write_atomic(self.manifest_path(path), json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+            self.make_index(path)
+            if path != self.in_path:
+                self.update_manifest(os.path.dirname(path), 'dirs', os.path.basename(path), totals)
 
     def make_index(self, src_path):
-        pyg_path = self.pygments_path(src_path)
-        children = os.listdir(pyg_path)
+        manifest = self.manifest(src_path)
         html = '<ul>'
-        for child in children:
-            if child == 'index.html':
-                continue
+        for child, summary in sorted(manifest['dirs'].items()):
             url_path = '#' + os.path.join(self.rel_path(src_path), child)
-            child_path = os.path.join(pyg_path, child)
-            glyph = '&#128194;'
             error = ''
-            if not os.path.isdir(child_path):
-                glyph = '&nbsp;'
-                with open(os.path.join(self.raw_path(src_path), child)[:-4] + 'xml', 'r', encoding='utf-8') as f:
-                    match = error_re.search(f.readline())
-                    if match:
-                        error = ' <span class="error">({} errors)</span>'.format(match.group(1))
-            html += '<li>{} <a href="{}">{}</a>{}</li>'.format(glyph, url_path, child, error)
+            if summary['errors']:
+                error = ' <span class="error">({} errors)</span>'.format(summary['errors'])
+            html += '<li>{} <a href="{}">{}</a>{}</li>'.format('&#128194;', url_path, child, error)
+        for bill, summary in sorted(manifest['bills'].items()):
+            child = os.path.basename(self.pygments_path(os.path.join(src_path, bill)))
+            url_path = '#' + os.path.join(self.rel_path(src_path), child)
+            error = ' <span class="error">({} errors)</span>'.format(summary['errors'])
+            html += '<li>{} <a href="{}">{}</a>{}</li>'.format('&nbsp;', url_path, child, error)
         html += '</ul>'
-        with open(os.path.join(pyg_path, 'index.html'), 'w') as f:
-            f.write(html)
+        write_atomic(os.path.join(self.pygments_path(src_path), 'index.html'), html.encode('utf-8'))
 
     def rel_path(self, src_path):
         return os.path.relpath(src_path, self.in_path)
@@ -58,112 +471,454 @@ class EventHandler(FileSystemEventHandler):
             path = path[:-4] + 'html'
         return path
 
+    def load_state(self):
+        # Maps the path of each docx, relative to in_path, to the hash,
+        # size, and mtime it had and the parser version when it was parsed.
+        try:
+            with open(os.path.join(self.out_path, STATE_FILENAME)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def save_state(self):
+        if not self.state_changed:
+            return
+        fn = os.path.join(self.out_path, STATE_FILENAME)
+        write_atomic(fn, json.dumps(self.state, indent=2, sort_keys=True).encode('utf-8'))
+        self.state_changed = False
+
+    def file_key(self, src_path, digest=None):
+        # The key the pool parses a version of the docx under.
+        st = os.stat(src_path)
+        return (digest or file_digest(src_path), st.st_size, st.st_mtime)
+
+    def dirty_key(self, src_path):
+        # Whether the docx needs to be parsed: the key to parse it under if
+        # it does, otherwise None. If its size and mtime are what they were
+        # when it was last parsed we take it as unchanged without reading
+        # it. Otherwise we compare hashes, since Word and file syncing tools
+        # touch files without changing them. The file is hashed at most once.
+        entry = self.state.get(self.rel_path(src_path))
+        if entry is None or entry['parser'] != self.parser_version or not os.path.exists(self.raw_path(src_path)):
+            return self.file_key(src_path)
+        st = os.stat(src_path)
+        if entry['size'] == st.st_size and entry['mtime'] == st.st_mtime:
+            return None
+        digest = file_digest(src_path)
+        if entry['hash'] != digest:
+            return (digest, st.st_size, st.st_mtime)
+        entry['size'] = st.st_size
+        entry['mtime'] = st.st_mtime
+        self.state_changed = True
+        return None
+
     def make_dir(self, src_path, update_index=True):
+        os.makedirs(self.raw_path(src_path), exist_ok=True)
+        os.makedirs(self.pygments_path(src_path), exist_ok=True)
+        if not os.path.exists(self.manifest_path(src_path)):
+            self.changed_dirs.add(src_path) # a new folder
+        if update_index:
+            self.update_indexes()
+
+    def make_file(self, src_path, update_index=True, priority=False, key=None):
+        # Start parsing the file, under key if dirty_key already made it. The
+        # output is written by finish_file when the parse is done, and the
+        # bill's index entry by finish_batch once the pool has nothing left
+        # to do. update_index only writes the indexes of folders that have
+        # already changed, like new folders made for the file.
+        self.pool.submit(src_path, key or self.file_key(src_path), priority)
+        if update_index:
+            self.update_indexes()
+
+    def finish_file(self, src_path, key, xml):
+        digest, size, mtime = key
+        with self.lock:
+            if not os.path.isdir(os.path.dirname(self.raw_path(src_path))):
+                return # the folder was deleted while we were parsing
+            write_atomic(self.raw_path(src_path), xml)
+            self.state[self.rel_path(src_path)] = {
+                'hash': digest,
+                'size': size,
+                'mtime': mtime,
+                'parser': self.parser_version,
+            }
+            self.state_changed = True
+            self.update_bill(src_path, summarize(xml))
+        self.highlighter.schedule(src_path)
+
+    def bill_summary(self, src_path):
+        with self.lock:
+            return self.manifest(os.path.dirname(src_path))['bills'].get(os.path.basename(src_path))
+
+    def render_html(self, src_path):
+        # Returns the highlighted HTML of a bill's XML, or None if the bill
+        # hasn't been parsed, from the cache if it's there.
+        summary = self.bill_summary(src_path)
+        if summary is None:
+            return None
+        cache_path = os.path.join(self.out_path, HTML_CACHE, summary['hash'] + '.html')
         try:
-            os.makedirs(self.raw_path(src_path))
-            os.makedirs(self.pygments_path(src_path))
-        except OSError:
+            with open(cache_path, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
             pass
+        with open(self.raw_path(src_path), 'rb') as f:
+            xml = f.read()
+        if hashlib.sha1(xml).hexdigest() != summary['hash']:
+            return None # it's being rewritten right now
+        html = highlight(xml.decode('utf-8'), xml_lexer, html_formatter).encode('utf-8')
+        write_atomic(cache_path, html)
+        return html
+
+    def publish_html(self, src_path):
+        # Put the highlighted view of a bill where the viewer looks for it.
+        summary = self.bill_summary(src_path)
+        html = self.render_html(src_path)
+        with self.lock:
+            if html is not None and summary == self.bill_summary(src_path):
+                write_if_changed(self.pygments_path(src_path), html)
+
+    def prune_html_cache(self):
+        # Remove cached HTML for XML that no bill has anymore. The highlighter
+        # may be writing a file right now, so leave the .tmp files alone;
+        # write_atomic renames them into place when it's done.
+        hashes = set()
+        for manifest in self.manifests.values():
+            for summary in manifest['bills'].values():
+                hashes.add(summary['hash'])
+        cache_dir = os.path.join(self.out_path, HTML_CACHE)
+        for fn in os.listdir(cache_dir):
+            if fn.endswith('.html') and fn[:-5] not in hashes:
+                try:
+                    os.remove(os.path.join(cache_dir, fn))
+                except FileNotFoundError:
+                    pass
+
+    def finish_batch(self):
+        with self.lock:
+            self.update_indexes()
+            self.save_state()
+
+    def delete_dir(self, src_path, update_index=True):
+        rmtree(self.raw_path(src_path), ignore_errors=True)
+        rmtree(self.pygments_path(src_path), ignore_errors=True)
+        prefix = self.rel_path(src_path) + os.sep
+        for rel_path in [p for p in self.state if p.startswith(prefix)]:
+            self.pool.cancel(os.path.join(self.in_path, rel_path))
+            del self.state[rel_path]
+            self.state_changed = True
+        for path in [p for p in self.manifests if p == src_path or p.startswith(src_path + os.sep)]:
+            del self.manifests[path]
+        if src_path != self.in_path and os.path.basename(src_path) in self.manifest(os.path.dirname(src_path))['dirs']:
+            self.update_manifest(os.path.dirname(src_path), 'dirs', os.path.basename(src_path), None)
         if update_index:
-            self.make_index(src_path)
+            self.update_indexes()
 
-    def make_file(self, src_path, update_index=True):
-        try:
-            dom = parse(src_path)
-            xml = etree.tostring(dom, pretty_print=True, encoding="utf-8")
-        except BaseException as e:
-            print()
-            xml = '<error errors="1">A fatal parsing error occurred. Please contact support. {}</error>'.format(e).encode('utf-8')
-        with open(self.raw_path(src_path), 'wb') as f:
-            f.write(xml)
-        # html = highlight(xml, xml_lexer, html_formatter)
-        # with open(self.pygments_path(src_path), 'w') as f:
-        #     f.write(html)
-        # if update_index:
-        #     self.make_index(os.path.dirname(src_path))
-
-    def delete_dir(self, src_path):
-        rmtree(self.raw_path(src_path))
-        rmtree(self.pygments_path(src_path))
-        self.make_index(os.path.dirname(src_path))
-
-    def delete_file(self, src_path):
-        os.remove(self.raw_path(src_path))
-        os.remove(self.pygments_path(src_path))
-        self.make_index(os.path.dirname(src_path))
+    def delete_file(self, src_path, update_index=True):
+        self.pool.cancel(src_path)
+        for path in (self.raw_path(src_path), self.pygments_path(src_path)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        if self.state.pop(self.rel_path(src_path), None) is not None:
+            self.state_changed = True
+        if os.path.basename(src_path) in self.manifest(os.path.dirname(src_path))['bills']:
+            self.update_bill(src_path, None)
+        if update_index:
+            self.update_indexes()
+
+    def process(self, batch):
+        # Handle a batch of debounced changes. batch maps each path to the
+        # last thing that happened to it. Check what's actually on disk
+        # now rather than trusting the event, since a file may have been
+        # created and deleted again within the batch. Index pages are
+        # updated at the end for the folders whose manifests changed.
+        with self.lock:
+            self.process_batch(batch)
+
+    def process_batch(self, batch):
+        for src_path, action in sorted(batch.items()):
+            if action == 'dir':
+                if os.path.isdir(src_path):
+                    self.make_dir(src_path, False)
+                else:
+                    self.delete_dir(src_path, False)
+            elif os.path.exists(src_path):
+                key = self.dirty_key(src_path)
+                if key:
+                    self.make_file(src_path, False, key=key)
+            else:
+                self.delete_file(src_path, False)
+        self.update_indexes()
+        self.save_state()
 
     def on_created(self, event):
         if event.is_directory:
-            self.make_dir(event.src_path)
-        else:
-            self.make_file(event.src_path)
+            self.debouncer.schedule(event.src_path, 'dir')
+        elif is_docx(event.src_path):
+            self.debouncer.schedule(event.src_path, 'file')
 
     def on_modified(self, event):
-        if event.is_directory:
-            return
-        else:
-            self.make_file(event.src_path)
+        if not event.is_directory and is_docx(event.src_path):
+            self.debouncer.schedule(event.src_path, 'file')
 
     def on_deleted(self, event):
+        self.on_created(event)
+
+    def on_moved(self, event):
+        # A move is a delete of the old path and a create of the new one.
+        # Word saves by writing a temp file and moving it into place.
         if event.is_directory:
-            self.delete_dir(event.src_path)
+            self.debouncer.schedule(event.src_path, 'dir')
+            self.debouncer.schedule(event.dest_path, 'dir')
         else:
-            self.delete_file(event.src_path)
+            if is_docx(event.src_path):
+                self.debouncer.schedule(event.src_path, 'file')
+            if is_docx(event.dest_path):
+                self.debouncer.schedule(event.dest_path, 'file')
 
-    def on_moved(self, event):
-        if event.is_directory or is_docx(event.src_path) and is_docx(event.dest_path):
-            os.rename(self.raw_path(event.src_path), self.raw_path(event.dest_path))
-            os.rename(self.raw_path(event.src_path), self.raw_path(event.dest_path))
-        elif is_docx(event.src_path):
-            self.delete_file(event.src_path)
-        elif is_docx(event.dest_path):
-            self.make_file(event.dest_path)
+VIEWER_PAGE = b'''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Bills</title>
+<link rel="stylesheet" href="/style.css">
+<style>.error { color: #c00; }</style>
+</head>
+<body>
+<div id="content"></div>
+<script>
+function show() {
+  var path = location.hash.substring(1) || ".";
+  if (!/\\.html$/.test(path)) path += "/index.html";
+  fetch("/pygments/" + path).then(function(r) { return r.text(); }).then(function(html) {
+    document.getElementById("content").innerHTML = html;
+  });
+}
+window.addEventListener("hashchange", show);
+show();
+</script>
+</body>
+</html>
+'''
+
+# The biggest upload we'll accept.
+MAX_UPLOAD_SIZE = 64 * 1024 * 1024
+
+# Uploads must have this header. A browser won't send a custom header to
+# another site without a CORS preflight, which we never allow.
+UPLOAD_HEADER = ('X-Bill-Watch', 'upload')
+
+class PreviewRequestHandler(BaseHTTPRequestHandler):
+    # Serves the outputs of self.server.event_handler:
+    #   /                        a page that shows the index pages and views
+    #   /style.css               the stylesheet for the views
+    #   /pygments/.../index.html a folder's index page
+    #   /pygments/.../bill.html  a bill's highlighted XML, made on demand
+    #   /raw/.../bill.xml        a bill's XML
+    # and accepts POST /upload/.../bill.docx.
+
+    def rel_path(self, prefix):
+        # The part of the request path after prefix, or None if it would
+        # escape the folder it's relative to.
+        path = posixpath.normpath(urllib.parse.unquote(self.path.split('?', 1)[0][len(prefix):]))
+        if path.startswith('/') or path == '..' or path.startswith('../'):
+            return None
+        return path
+
+    def etag_matches(self, etag):
+        # Whether the client's If-None-Match has the (unquoted) etag.
+        tags = [t.strip() for t in self.headers.get('If-None-Match', '').split(',')]
+        return '*' in tags or '"{}"'.format(etag) in [t[2:] if t.startswith('W/') else t for t in tags]
+
+    def is_same_origin(self):
+        # Whether the request was made to this server by its own name (not
+        # through a DNS name that points here) and not from another site.
+        port = self.server.server_address[1]
+        hosts = ['127.0.0.1:{}'.format(port), 'localhost:{}'.format(port)]
+        if self.headers.get('Host') not in hosts:
+            return False
+        origin = self.headers.get('Origin')
+        return origin is None or origin in ['http://' + host for host in hosts]
+
+    def send(self, body, content_type, etag=None):
+        if etag is not None:
+            matches = self.etag_matches(etag)
+            etag = '"{}"'.format(etag)
+            if matches:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if etag is not None:
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_file(self, path, content_type):
+        try:
+            with open(path, 'rb') as f:
+                st = os.fstat(f.fileno())
+                etag = '{:x}-{:x}'.format(st.st_mtime_ns, st.st_size)
+                if self.etag_matches(etag):
+                    body = b''
+                else:
+                    body = f.read()
+        except (FileNotFoundError, IsADirectoryError):
+            self.send_error(404)
+            return
+        self.send(body, content_type, etag)
+
+    def do_GET(self):
+        handler = self.server.event_handler
+        if self.path == '/':
+            self.send(VIEWER_PAGE, 'text/html; charset=utf-8')
+        elif self.path == '/style.css':
+            self.send_file(os.path.join(handler.out_path, 'style.css'), 'text/css')
+        elif self.path.startswith('/raw/') and self.rel_path('/raw/') is not None:
+            self.send_file(os.path.join(handler.out_path, 'raw', self.rel_path('/raw/')), 'application/xml')
+        elif self.path.startswith('/pygments/') and self.rel_path('/pygments/') is not None:
+            rel_path = self.rel_path('/pygments/')
+            if os.path.basename(rel_path) == 'index.html':
+                self.send_file(os.path.join(handler.out_path, 'pygments', rel_path), 'text/html; charset=utf-8')
+                return
+            src_path = os.path.join(handler.in_path, rel_path[:-4] + 'docx')
+            summary = handler.bill_summary(src_path) if rel_path.endswith('.html') else None
+            if summary is None:
+                self.send_error(404)
+            elif self.etag_matches(summary['hash']):
+                self.send(b'', 'text/html; charset=utf-8', summary['hash'])
+            else:
+                html = handler.render_html(src_path)
+                if html is None:
+                    self.send_error(404)
+                else:
+                    self.send(html, 'text/html; charset=utf-8', summary['hash'])
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        handler = self.server.event_handler
+        rel_path = self.rel_path('/upload/') if self.path.startswith('/upload/') else None
+        if rel_path is None or not is_docx(rel_path):
+            self.send_error(404)
+            return
+        if self.headers.get(UPLOAD_HEADER[0]) != UPLOAD_HEADER[1] or not self.is_same_origin():
+            self.send_error(403)
+            return
+        if 'Content-Length' not in self.headers:
+            self.send_error(411)
+            return
+        try:
+            length = int(self.headers['Content-Length'])
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.send_error(400)
+            return
+        if length > MAX_UPLOAD_SIZE:
+            self.send_error(413)
+            return
+        body = self.rfile.read(length)
+
+        src_path = os.path.join(handler.in_path, rel_path)
+        with handler.lock:
+            path = os.path.dirname(src_path)
+            os.makedirs(path, exist_ok=True)
+            while path != handler.in_path:
+                handler.make_dir(path, False)
+                path = os.path.dirname(path)
+            write_atomic(src_path, body)
+            handler.make_file(src_path, priority=True)
+
+        self.send(json.dumps({'path': rel_path, 'status': 'queued'}).encode('utf-8'), 'application/json')
+
+def serve(event_handler, port):
+    # Serve on localhost only. Reviewers reach it from their own machine.
+    server = ThreadingHTTPServer(('127.0.0.1', port), PreviewRequestHandler)
+    server.daemon_threads = True
+    server.event_handler = event_handler
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    print('serving at http://127.0.0.1:{}/'.format(server.server_address[1]), file=sys.stderr)
+    return server
 
 def walk(event_handler):
-    dirs_to_update = []
+    with event_handler.lock:
+        walk_folder(event_handler)
+
+def walk_folder(event_handler):
+    seen = set()
     for root, dirs, files in os.walk(event_handler.in_path):
         event_handler.make_dir(root, False)
-        dirty = False
+        bills = event_handler.manifest(root)['bills']
         for f in files:
             src_path = os.path.join(root, f)
             if not is_docx(src_path):
                 continue
-            raw_path = event_handler.raw_path(src_path)
-            pyg_path = event_handler.pygments_path(src_path)
-            src_mod_time = os.path.getmtime(src_path)
-            try:
-                raw_mod_time = os.path.getmtime(raw_path)
-                pyg_mod_time = os.path.getmtime(pyg_path)
-            except FileNotFoundError:
-                dirty = True
-                event_handler.make_file(src_path, False)
+            seen.add(event_handler.rel_path(src_path))
+            key = event_handler.dirty_key(src_path)
+            if key:
+                event_handler.make_file(src_path, False, key=key)
             else:
-                if src_mod_time >= raw_mod_time or src_mod_time >= pyg_mod_time:
-                    dirty = True
-                    event_handler.make_file(src_path, False)
-        if dirty:
-            dirs_to_update.append(root)
+                if 'hash' not in bills.get(f, {}):
+                    # Parsed before there were manifests.
+                    with open(event_handler.raw_path(src_path), 'rb') as fp:
+                        event_handler.update_bill(src_path, summarize(fp.read()))
+                if not os.path.exists(event_handler.pygments_path(src_path)):
+                    event_handler.highlighter.schedule(src_path)
 
+    # Clean up after bills and folders that were deleted while we weren't looking.
+    for rel_path in sorted(set(event_handler.state) - seen):
+        event_handler.delete_file(os.path.join(event_handler.in_path, rel_path), False)
+    for path in list(event_handler.manifests):
+        if path not in event_handler.manifests:
+            continue
+        for child in list(event_handler.manifests[path]['dirs']):
+            if not os.path.isdir(os.path.join(path, child)):
+                event_handler.delete_dir(os.path.join(path, child), False)
 
-    for path in dirs_to_update:
-        event_handler.make_index(path)
+    event_handler.update_indexes()
+    event_handler.prune_html_cache()
+    event_handler.save_state()
 
 if __name__ == '__main__':
-    observer = Observer()
-    in_path = os.path.abspath(sys.argv[1])
-    out_path = os.path.abspath(sys.argv[2])
-    event_handler = EventHandler(in_path, out_path)
+    argparser = argparse.ArgumentParser(description='Keep parsed XML of a folder of bills up to date.')
+    argparser.add_argument('--poll', action='store_true', help='walk the folder every second instead of watching for changes')
+    argparser.add_argument('-j', '--jobs', type=int, default=2, help='number of bills to parse at once (default: 2)')
+    argparser.add_argument('--timeout', type=float, default=60, help='seconds to let a bill parse before giving up on it (default: 60)')
+    argparser.add_argument('--port', type=int, default=None, help='serve the outputs at http://127.0.0.1:PORT/')
+    argparser.add_argument('in_path')
+    argparser.add_argument('out_path')
+    args = argparser.parse_args()
 
-    while True:
-        walk(event_handler)
-        time.sleep(1)
-
-    # walk(event_handler)
-    # observer.schedule(event_handler, in_path, recursive=True)
-    # observer.start()
-    # try:
-    #     while True:
-    #         time.sleep(1)
-    # except KeyboardInterrupt:
-    #     observer.stop()
-    # observer.join()
+    in_path = os.path.abspath(args.in_path)
+    out_path = os.path.abspath(args.out_path)
+    event_handler = EventHandler(in_path, out_path, args.jobs, args.timeout)
+    event_handler.pool.start()
+    event_handler.highlighter.start()
+    if args.port is not None:
+        serve(event_handler, args.port)
+
+    if args.poll:
+        while True:
+            walk(event_handler)
+            time.sleep(1)
+
+    walk(event_handler)
+    event_handler.debouncer.start()
+    observer = Observer()
+    observer.schedule(event_handler, in_path, recursive=True)
+    observer.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        observer.stop()
+        event_handler.pool.shutdown()
+    observer.join()
@@ -9,21 +9,29 @@ per title.
 
 useful for reviewing parser output diffs to minimize
 regressions.
+
+the changed files are read and diffed in a pool of
+worker processes (-j to set how many). the blobs are
+then written in one batch and the per-title commits
+are made directly from trees built in memory, so the
+index is only rewritten once at the end.
 """
 
 msg = 'fix levels for inlined docs'
 
-from git import Repo, Blob
+from git import Repo, Commit, Tree
+from git.objects.fun import tree_entries_from_data, tree_to_stream
+import os
 import os.path
-from collections import OrderedDict
-repo = Repo('.')
-index = repo.index
-diffs = repo.index.diff(None)
-total = 0
-included = 0
+import sys
+import time
+import argparse
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
 import difflib
 import re
+import heapq
 leading_whitespace = re.compile('^\s*')
 diffs_out = {}
 
@@ -34,34 +42,106 @@ def normalized_equal(a, b):
 	b_normalized = ignore_chars.sub('', b).lower()
 	return a_normalized == b_normalized
 
+def line_key(line):
+	""" the line normalized for comparison, keeping its indentation """
+	return leading_whitespace.match(line).group() + ignore_chars.sub('', line).lower()
+
+def is_temporary_heading(key):
+	return key.strip().startswith('<heading>temporary')
+
+def can_patch(a, a_keys, b, b_keys):
+	"""
+	whether any line of b could be patched back to a different line
+	of a. if not, patching can't change b, whatever order ndiff's op
+	stream is in.
+	"""
+	a_lines = defaultdict(set)
+	for line, key in zip(a, a_keys):
+		a_lines[key].add(line)
+		if is_temporary_heading(key):
+			a_lines['<heading>temporary'].add(line)
+	for line, key in zip(b, b_keys):
+		if is_temporary_heading(key):
+			key = '<heading>temporary'
+		if a_lines.get(key, set()) - {line}:
+			return True
+	return False
+
+def ndiff_ops(a, b, a_keys, b_keys):
+	"""
+	the ' ', '-' and '+' ops (with their line) that difflib.ndiff(a, b)
+	gives, except inside changed blocks where nothing could be patched,
+	which are given as plain '-' and '+' ops.
+
+	ndiff lines up the files with a SequenceMatcher, which is fast,
+	and then compares every pair of lines in each replaced block, which
+	is what's quadratic. The block's op order only matters to
+	substantive_diff when one of its inserted lines could be patched, so
+	that's the only time the block is handed to ndiff's _fancy_replace.
+	"""
+	differ = difflib.Differ(charjunk=difflib.IS_CHARACTER_JUNK)
+	for tag, alo, ahi, blo, bhi in difflib.SequenceMatcher(None, a, b).get_opcodes():
+		if tag == 'equal':
+			for j in range(blo, bhi):
+				yield ' ', b[j]
+		elif tag == 'replace' and can_patch(a[alo:ahi], a_keys[alo:ahi], b[blo:bhi], b_keys[blo:bhi]):
+			for l in differ._fancy_replace(a, alo, ahi, b, blo, bhi):
+				if l[0] != '?':
+					yield l[0], l[2:]
+		else:
+			for i in range(alo, ahi):
+				yield '-', a[i]
+			for j in range(blo, bhi):
+				yield '+', b[j]
+
 def substantive_diff(a, b):
+	"""
+	return b with every changed line that is only a non-substantive
+	change of a line of a (spaces, periods, capitalization) put back
+	the way it was in a.
+
+	this gives exactly what replaying difflib.ndiff(a, b) did: each
+	inserted line is patched back to the first pending removed line it
+	matches, an inserted line that matches none of them clears them, and
+	an unchanged line clears them too. the patched line replaces the
+	first line of b with the inserted line's text, which ndiff found
+	with b.index(); here the positions of each line's text are kept in
+	heaps, so that doesn't make it quadratic.
+	"""
 	a = a.splitlines()
 	b = b.splitlines()
+	keys = {}
+	def key(line):
+		if line not in keys:
+			keys[line] = line_key(line)
+		return keys[line]
+	a_keys = [key(l) for l in a]
+	b_keys = [key(l) for l in b]
+	if not can_patch(a, a_keys, b, b_keys):
+		return '\n'.join(b) + '\n'
+
+	positions = defaultdict(list)
+	for j, line in enumerate(b):
+		positions[line].append(j)
 
 	rem = []
-	for l in difflib.ndiff(a, b):
-		if l[0] == ' ':
+	for op, line in ndiff_ops(a, b, a_keys, b_keys):
+		if op == ' ':
 			rem = []
-		elif l[0] == '-':
-			rem.append(l[2:])
-		elif l[0] == '+':
-			normalized = leading_whitespace.match(l[2:]).group() + ignore_chars.sub('', l[2:]).lower()
-			i = None
+		elif op == '-':
+			rem.append(line)
+		elif op == '+':
+			normalized = key(line)
 			for r in rem:
-				a_normalized = leading_whitespace.match(r).group() + ignore_chars.sub('', r).lower()
-				if normalized == a_normalized or (a_normalized.strip().startswith('<heading>temporary') and normalized.strip().startswith('<heading>temporary')):
-					i = b.index(l[2:])
-					b.remove(l[2:])
-					b.insert(i, r)
+				a_normalized = key(r)
+				if normalized == a_normalized or (is_temporary_heading(a_normalized) and is_temporary_heading(normalized)):
+					i = heapq.heappop(positions[line])
+					b[i] = r
+					heapq.heappush(positions[r], i)
+					rem.remove(r)
 					break
-			if i is not None: # if a rem was patched to the ins
-				rem.remove(r)
 			else:
 				rem = []
-		elif  l[0] == '?':
-			continue
-		else:
-			print(l[0])
 
 	return '\n'.join(b) + '\n'
 
@@ -69,47 +149,182 @@ def substantive_diff(a, b):
 import io
 import gitdb
 
-def make_blob(string, path):
-	b = string.encode('utf-8')
-	stream = io.BytesIO(b)
-	istream = gitdb.IStream('blob', len(b), stream)
-	repo.odb.store(istream)
-	blob = Blob (repo, istream.binsha, mode=100644, path=path)
-	return blob
+file_mode = 0o100644
+tree_mode = 0o040000
+
+def loose_object_db(repo):
+	"""
+	repo.odb runs git hash-object for every object it stores,
+	so write loose objects directly with gitdb instead.
+	"""
+	return gitdb.LooseObjectDB(os.path.join(repo.git_dir, 'objects'))
+
+def store_object(odb, type, data):
+	istream = gitdb.IStream(type, len(data), io.BytesIO(data))
+	odb.store(istream)
+	return istream.binsha
+
+def store_blobs(repo, files):
+	""" write the blobs for a list of (path, bytes) and return a list of (path, binsha) """
+	odb = loose_object_db(repo)
+	return [(path, store_object(odb, 'blob', data)) for path, data in files]
+
+def tree_sort_key(entry):
+	""" git sorts tree entries by name, as if trees had a trailing slash """
+	binsha, mode, name = entry
+	return name + '/' if mode == tree_mode else name
 
+class TreeWriter(object):
+	"""
+	builds new trees from a base tree plus changed paths. only
+	the trees along changed paths are loaded and rewritten,
+	so each write after a batch of changes is cheap.
+	"""
+	def __init__(self, repo, binsha):
+		self.repo = repo
+		self.odb = loose_object_db(repo)
+		self.root = self._node(binsha)
 
-titles_to_commit = OrderedDict([['index.xml', []], ['Title-1', []], ['Title-2', []], ['Title-3', []], ['Title-4', []], ['Title-5', []], ['Title-6', []], ['Title-7', []], ['Title-8', []], ['Title-9', []], ['Title-10', []], ['Title-11', []], ['Title-12', []], ['Title-13', []], ['Title-14', []], ['Title-15', []], ['Title-16', []], ['Title-17', []], ['Title-18', []], ['Title-19', []], ['Title-20', []], ['Title-21', []], ['Title-22', []], ['Title-23', []], ['Title-24', []], ['Title-25', []], ['Title-26', []], ['Title-27', []], ['Title-28', []], ['Title-29', []], ['Title-29A', []], ['Title-30', []], ['Title-31', []], ['Title-32', []], ['Title-33', []], ['Title-34', []], ['Title-35', []], ['Title-36', []], ['Title-37', []], ['Title-38', []], ['Title-39', []], ['Title-40', []], ['Title-41', []], ['Title-42', []], ['Title-43', []], ['Title-44', []], ['Title-45', []], ['Title-46', []], ['Title-47', []], ['Title-48', []], ['Title-49', []], ['Title-50', []], ['Title-51', []]])
+	def _node(self, binsha):
+		entries = {}
+		if binsha is not None:
+			for sha, mode, name in tree_entries_from_data(self.repo.odb.stream(binsha).read()):
+				entries[name] = (sha, mode)
+		return {'entries': entries, 'subtrees': {}, 'dirty': False}
 
-for d in diffs:
-	total +=1
-	a = d.a_blob.data_stream.read().decode("utf-8", "strict")
-	b = open(d.b_path).read()
-	if not normalized_equal(a,b):
-		diffs_out[d.b_path] = {'a': a, 'b': b}
+	def set(self, path, binsha):
+		*dirs, name = path.split('/')
+		node = self.root
+		node['dirty'] = True
+		for d in dirs:
+			if d not in node['subtrees']:
+				sha, mode = node['entries'].get(d, (None, None))
+				node['subtrees'][d] = self._node(sha if mode == tree_mode else None)
+			node = node['subtrees'][d]
+			node['dirty'] = True
+		mode = node['entries'].get(name, (None, file_mode))[1]
+		node['entries'][name] = (binsha, mode)
+
+	def write(self, node=None):
+		""" write the changed trees and return the root tree's binsha """
+		node = node or self.root
+		if node['dirty']:
+			for name, subtree in node['subtrees'].items():
+				node['entries'][name] = (self.write(subtree), tree_mode)
+			entries = sorted(((sha, mode, name) for name, (sha, mode) in node['entries'].items()), key=tree_sort_key)
+			stream = io.BytesIO()
+			tree_to_stream(entries, stream.write)
+			node['sha'] = store_object(self.odb, 'tree', stream.getvalue())
+			node['dirty'] = False
+		return node['sha']
+
+def commit_titles(repo, titles_to_commit, msg):
+	"""
+	titles_to_commit maps each title to a list of (path, binsha).
+	make one commit per title, in title order, on top of HEAD
+	and move HEAD to the last one. returns the commits.
+	"""
+	parent = repo.head.commit
+	writer = TreeWriter(repo, parent.tree.binsha)
+	writer.root['sha'] = parent.tree.binsha
+	commits = []
+	for title in sorted(titles_to_commit, key=title_sort_key):
+		for path, binsha in titles_to_commit[title]:
+			writer.set(path, binsha)
+		tree = Tree(repo, writer.write())
+		message = '{} - {}'.format(title, msg) if msg else title
+		parent = Commit.create_from_tree(repo, tree, message, parent_commits=[parent], head=False)
+		commits.append(parent)
+	if commits:
+		repo.head.commit = parent
+		repo.index.reset()
+	return commits
+
+def title_of(path):
+	return path.split('/', 1)[0]
+
+title_num_re = re.compile(r'^Title-(\d+)(.*)$')
+
+def title_sort_key(title):
+	""" index.xml and other top-level files first, then titles in numeric order (29, 29A, 30) """
+	m = title_num_re.match(title)
+	if m:
+		return (1, int(m.group(1)), m.group(2))
+	return (0, 0, title)
+
+worker_repo = None
+
+def init_worker():
+	global worker_repo
+	worker_repo = Repo('.')
+
+def process_file(args):
+	"""
+	read the committed and working copies of a file and
+	return (path, a, b, substantive b or None, seconds)
+	"""
+	a_binsha, path = args
+	start = time.time()
+	a = worker_repo.odb.stream(a_binsha).read().decode("utf-8", "strict")
+	with open(path) as f:
+		b = f.read()
+	new_b = None
+	if not normalized_equal(a, b):
 		new_b = substantive_diff(a, b)
-		if normalized_equal(a, new_b):
-			continue
-		blob = make_blob(new_b, d.b_path)
-		title = d.b_path.split('/', 1)[0]
-		titles_to_commit[title].append(blob)
-		included += 1
-
-
-for path in repo.untracked_files:
-	title = path.split('/', 1)[0]
-	titles_to_commit[title].append(path)
-
-for title, paths in titles_to_commit.items():
-	if paths:
-		print(title, len(paths))
-		index.add(paths)
-		if msg:
-			index.commit('{} - {}'.format(title, msg))
+	return path, a, b, new_b, time.time() - start
+
+def main(jobs=None):
+	repo = Repo('.')
+	diffs = repo.index.diff(None)
+	total = 0
+	included = 0
+
+	changed_files = []
+	titles_to_commit = defaultdict(list)
+	title_times = defaultdict(float)
+	title_counts = defaultdict(int)
+
+	files = [(d.a_blob.binsha, d.b_path) for d in diffs]
+	with ProcessPoolExecutor(jobs, initializer=init_worker) as pool:
+		for path, a, b, new_b, seconds in pool.map(process_file, files, chunksize=16):
+			total += 1
+			title = title_of(path)
+			title_times[title] += seconds
+			title_counts[title] += 1
+			if total % 500 == 0:
+				print('processed', total, '/', len(files), file=sys.stderr)
+			if new_b is None:
+				continue
+			diffs_out[path] = {'a': a, 'b': b}
+			if normalized_equal(a, new_b):
+				continue
+			changed_files.append((path, new_b.encode('utf-8')))
+			included += 1
+
+	for path in repo.untracked_files:
+		with open(path, 'rb') as f:
+			changed_files.append((path, f.read()))
+
+	start = time.time()
+	for path, binsha in store_blobs(repo, changed_files):
+		titles_to_commit[title_of(path)].append((path, binsha))
+	commits = commit_titles(repo, titles_to_commit, msg)
+	print('wrote {} blobs and {} commits in {:.1f}s'.format(len(changed_files), len(commits), time.time() - start))
+
+	for title in sorted(set(titles_to_commit) | set(title_counts), key=title_sort_key):
+		paths = titles_to_commit[title]
+		if paths:
+			print(title, len(paths), '/', title_counts[title], 'diffed in {:.1f}s'.format(title_times[title]))
 		else:
-			index.commit(title)
-	else:
-		print('skipping', title)
-import json
-json.dump(diffs_out, open('tmp.json', 'w'), indent=2, sort_keys=True)
-print(included, '/', total)
+			print('skipping', title, '({} diffed in {:.1f}s)'.format(title_counts[title], title_times[title]))
+	import json
+	json.dump(diffs_out, open('tmp.json', 'w'), indent=2, sort_keys=True)
+	print(included, '/', total)
 
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Commit the substantive changes in the working tree, one commit per title.')
+	parser.add_argument('-j', '--jobs', type=int, default=None, help='number of worker processes (default: one per CPU)')
+	parser.add_argument('-m', '--message', default=msg, help='commit message suffix')
+	args = parser.parse_args()
+	msg = args.message
+	main(args.jobs)
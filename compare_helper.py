@@ -3,60 +3,175 @@
 # the 2013 Lexis file can be compared more easily using diff.
 #
 # Usage:
-# python3 code_file.xml > new_file.xml
+# python3 compare_helper.py < code_file.xml > new_file.xml
+#
+# Or, to compare two editions directly, section by section:
+# python3 compare_helper.py [-j N] old_code_file.xml new_code_file.xml
+#
+# which normalizes each section the same way, computes a digest of
+# each normalized section, and prints the sections that were added,
+# removed, or changed, with a diff of just the changed sections. The
+# files are streamed and the sections are normalized in a pool of N
+# worker processes, one title at a time.
 
-import sys, lxml.etree, re
+import sys, os, lxml.etree, re, hashlib, difflib, argparse
+from concurrent.futures import ProcessPoolExecutor
 
 def strnorm(s):
 	if s is None: return s
 	return re.sub(r"\W", "", s).lower()
 
-dom = lxml.etree.parse(sys.stdin.buffer)
-
-# don't compare annotations, there are too many differences
-for n in dom.xpath('//level[type="annotations"]|//formerly-cited-as'):
-	n.getparent().remove(n)
-
-for n in dom.xpath('//level'):
-	# A level that only contains levels. Bad indentation in the West file.
-	#if len(n.xpath('*[not(name(.)="level")]')) == 0:
-	#	for c in n:
-	#		n.addprevious(c)
-	#	n.getparent().remove(n)
-
-	# West and Lexis handled subsection headings differently. We didn't
-	# even parse from West. Make West look like Lexis.
-	t = n.xpath("text/node()[1][@i='True']")
-	if len(t):
-		t = t[0]
-		p = t.getparent()
-		p.addprevious(t)
-		p.text = re.sub("^ -- ", "", t.tail) if t.tail is not None else None
-		t.text = re.sub("\.$", "", t.text)
-		t.tail = "\n"
-		t.tag = "heading"
-		t.attrib.pop("i")
-
-	# Actually don't even compare within-section hierarchy because there are
-	# too many differences. Unfold the levels.
-	for c in n:
-		n.addprevious(c)
-	n.getparent().remove(n)
-
-
-# normalize text because there are case, punctuation, and whitespace changes
-for n in dom.xpath('//heading'):
-	n.text = strnorm(n.text)
-for n in dom.xpath('//text'):
-	n.text = strnorm(n.text)
-
-	# remove empty <text/> from the West file
-	if len(n) == 0 and n.text in ("", None):
+def normalize(dom):
+	# don't compare annotations, there are too many differences
+	for n in dom.xpath('.//level[type="annotations"]|.//formerly-cited-as'):
+		n.getparent().remove(n)
+
+	for n in dom.xpath('.//level'):
+		# A level that only contains levels. Bad indentation in the West file.
+		#if len(n.xpath('*[not(name(.)="level")]')) == 0:
+		#	for c in n:
+		#		n.addprevious(c)
+		#	n.getparent().remove(n)
+
+		# West and Lexis handled subsection headings differently. We didn't
+		# even parse from West. Make West look like Lexis.
+		t = n.xpath("text/node()[1][@i='True']")
+		if len(t):
+			t = t[0]
+			p = t.getparent()
+			p.addprevious(t)
+			p.text = re.sub("^ -- ", "", t.tail) if t.tail is not None else None
+			t.text = re.sub("\.$", "", t.text)
+			t.tail = "\n"
+			t.tag = "heading"
+			t.attrib.pop("i")
+
+		# Actually don't even compare within-section hierarchy because there are
+		# too many differences. Unfold the levels.
+		for c in n:
+			n.addprevious(c)
+		n.getparent().remove(n)
+
+
+	# normalize text because there are case, punctuation, and whitespace changes
+	for n in dom.xpath('.//heading'):
+		n.text = strnorm(n.text)
+	for n in dom.xpath('.//text'):
+		n.text = strnorm(n.text)
+
+		# remove empty <text/> from the West file
+		if len(n) == 0 and n.text in ("", None):
+			n.getparent().remove(n)
+
+	# remove placeholder text from Lexis which wasn't in West (usually <text>Repealed</text>)
+	for n in dom.xpath('.//placeholder/text'):
 		n.getparent().remove(n)
 
-# remove placeholder text from Lexis which wasn't in West (usually <text>Repealed</text>)
-for n in dom.xpath('//placeholder/text'):
-	n.getparent().remove(n)
+def level_type(node):
+	# Level types are attributes in some editions and child nodes in others.
+	return node.get("type") or node.findtext("type")
+
+def section_key(node):
+	if node.findtext("num"):
+		return node.findtext("num")
+	elif node.findtext("section"):
+		return node.findtext("section")
+	elif node.findtext("section-start"):
+		return node.findtext("section-start") + "~" + node.findtext("section-end", "")
+	else:
+		return "?"
+
+def section_title(key):
+	# The title number is what comes before the dash, e.g. 28 in 28:2A-502.
+	return re.split("[-:]", key, 1)[0]
+
+def iter_title_batches(fn):
+	# Stream through a code file, yielding the serialized sections of each
+	# title in turn. Sections are cleared from the parsed tree once they have
+	# been serialized so that memory use stays flat.
+	title = None
+	batch = []
+	for event, node in lxml.etree.iterparse(fn, events=("end",), tag="level"):
+		if level_type(node) not in ("section", "placeholder"): continue
+		key = section_key(node)
+		if section_title(key) != title and batch:
+			yield batch
+			batch = []
+		title = section_title(key)
+		batch.append((key, lxml.etree.tostring(node, encoding="utf-8")))
+		node.clear()
+		while node.getprevious() is not None:
+			del node.getparent()[0]
+	if batch:
+		yield batch
+
+def digest_sections(batch):
+	# Normalize each section and return its digest along with the normalized
+	# lines, which we need for the diff if the section changed.
+	ret = []
+	for key, xml in batch:
+		node = lxml.etree.fromstring(xml, lxml.etree.XMLParser(remove_blank_text=True))
+		normalize(node)
+		lines = lxml.etree.tostring(node, pretty_print=True, encoding=str).splitlines(True)
+		ret.append((key, hashlib.sha1("".join(lines).encode("utf-8")).hexdigest(), lines))
+	return ret
+
+def digest_edition(fn, pool, jobs):
+	# Returns an ordered dict of section key => (digest, normalized lines).
+	sections = { }
+	def add(results):
+		for key, digest, lines in results:
+			# Disambiguate section numbers that occur more than once.
+			k, i = key, 1
+			while k in sections:
+				i += 1
+				k = "{}#{}".format(key, i)
+			sections[k] = (digest, lines)
+
+	# pool.map would read the whole file up front, so submit the titles
+	# ourselves and don't let the reader get too far ahead of the workers.
+	pending = []
+	for batch in iter_title_batches(fn):
+		pending.append(pool.submit(digest_sections, batch))
+		while len(pending) > 4 * jobs:
+			add(pending.pop(0).result())
+	for future in pending:
+		add(future.result())
+	return sections
+
+def compare(old_fn, new_fn, jobs):
+	jobs = jobs or os.cpu_count()
+	with ProcessPoolExecutor(jobs) as pool:
+		old = digest_edition(old_fn, pool, jobs)
+		new = digest_edition(new_fn, pool, jobs)
+
+	added = [k for k in new if k not in old]
+	removed = [k for k in old if k not in new]
+	changed = [k for k in new if k in old and new[k][0] != old[k][0]]
+
+	for key in added:
+		print("A", key)
+	for key in removed:
+		print("D", key)
+	for key in changed:
+		print("M", key)
+	for key in changed:
+		sys.stdout.writelines(difflib.unified_diff(old[key][1], new[key][1], old_fn + " " + key, new_fn + " " + key))
+
+	print("{} added, {} removed, {} changed, {} unchanged".format(
+		len(added), len(removed), len(changed), len(new) - len(added) - len(changed)), file=sys.stderr)
 
-sys.stdout.buffer.write(lxml.etree.tostring(dom, pretty_print=True, encoding="utf-8", xml_declaration=True))
+if __name__ == "__main__":
+	argparser = argparse.ArgumentParser(description="Normalize DC Code XML for comparison, or compare two editions section by section.")
+	argparser.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes when comparing (default: one per CPU)")
+	argparser.add_argument("files", nargs="*", help="the old and new code files to compare")
+	args = argparser.parse_args()
 
+	if len(args.files) == 2:
+		compare(args.files[0], args.files[1], args.jobs)
+	elif len(args.files) == 0:
+		dom = lxml.etree.parse(sys.stdin.buffer)
+		normalize(dom.getroot())
+		sys.stdout.buffer.write(lxml.etree.tostring(dom, pretty_print=True, encoding="utf-8", xml_declaration=True))
+	else:
+		argparser.error("expected two files to compare or none to normalize stdin")
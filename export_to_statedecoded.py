@@ -1,9 +1,28 @@
 # Exports a big code file into the State Decoded XML format (one section per file).
 #
 # Usage:
-# python3 export_to_statedecoded.py ~/data/dc_code/state_decoded < ~/data/dc_code/2013-10.xml
+# python3 export_to_statedecoded.py [-j N] ~/data/dc_code/state_decoded < ~/data/dc_code/2013-10.xml
+#
+# The code file is streamed, so only one section at a time is held in memory
+# by the reader. Sections are rendered and written by a pool of N worker
+# processes (one per CPU by default, -j 1 to do it all in this process).
+#
+# A digest of each section's XML, its place in the table of contents, and its
+# ordering is kept in out_dir/.statedecoded_manifest.json. Only sections whose
+# digest changed since the last export are rendered and written again (unless
+# --all is given), and files for sections that no longer exist are removed.
+
+import sys, os, os.path, lxml.etree, argparse, hashlib, json, contextlib
+from concurrent.futures import ProcessPoolExecutor
+import memprofile
+
+# How many sections to send to a worker at once.
+BATCH_SIZE = 100
+
+# Change this when the output format changes so that every section is rewritten.
+EXPORT_VERSION = 1
 
-import sys, os, os.path, lxml.etree
+MANIFEST_FILENAME = ".statedecoded_manifest.json"
 
 def make_node(parent, tag, text, **attrs):
   """Make a node in an XML document."""
@@ -15,31 +34,92 @@ def make_node(parent, tag, text, **attrs):
     n.set(k, v)
   return n
 
-def append_text(node, text):
-	# text versus tail
-	if len(node) > 0:
-		node[-1].tail += "\n\n"
-		node[-1].tail += text
-	else:
-		if node.text != "": node.text += "\n\n"
-		node.text += text
+class TextBuilder:
+	# Accumulates the text that goes into a node, appending to the node's
+	# text until it has a child and then to the last child's tail. The
+	# text is collected in a list and joined once, rather than growing
+	# the node's text by repeated concatenation.
+	def __init__(self, node):
+		self.node = node
+		self.last_child = None
+		self.parts = [node.text or ""]
+		self.is_empty = not node.text
 
-def write_section(node, spine, index):
-	# Construct a file name,
-	if node.xpath("string(type)") == "placeholder":
-		if node.xpath("string(section)"):
-			name = node.xpath("string(section)")
+	def append_text(self, text):
+		# text versus tail
+		if self.last_child is not None or not self.is_empty:
+			self.parts.append("\n\n")
+		self.parts.append(text)
+		if text: self.is_empty = False
+
+	def make_child(self, tag):
+		self.flush()
+		self.last_child = make_node(self.node, tag, "")
+		self.last_child.tail = ""
+		self.parts = []
+		return self.last_child
+
+	def flush(self):
+		if self.last_child is None:
+			self.node.text = "".join(self.parts)
+		else:
+			self.last_child.tail = "".join(self.parts)
+
+def string_value(node):
+	# Same as xpath's string() function.
+	return "".join(node.itertext()) if node is not None else ""
+
+class Level:
+	# What we need to know about a <level>, gathered in a single pass
+	# over its children: the string values of its first type, prefix,
+	# num, heading, etc. children; its text and level children in
+	# order; and its first annotations child.
+	FIELDS = ("type", "prefix", "num", "heading", "section", "section-start", "section-end", "section-range-type")
+
+	def __init__(self, node):
+		self.node = node
+		self.fields = { }
+		self.content = []
+		self.text_count = 0
+		self.annotations = None
+		for child in node:
+			tag = child.tag
+			if tag in Level.FIELDS and tag not in self.fields:
+				self.fields[tag] = string_value(child)
+			if tag == "text":
+				self.content.append(child)
+				self.text_count += 1
+			elif tag == "level":
+				self.content.append(child)
+			if self.annotations is None and string_value(child.find("type")) == "annotations":
+				self.annotations = child
+
+	def __getitem__(self, field):
+		return self.fields.get(field, "")
+
+def section_filename(level):
+	# Returns the section's name and the file name to write it to, without the extension.
+	if level["type"] == "placeholder":
+		if level["section"]:
+			name = level["section"]
 			fn = name + "~P"
-		elif node.xpath("string(section-start)") and node.xpath("string(section-end)"):
-			name = node.xpath("string(section-start)") \
-			 + (" to " if node.xpath("string(section-range-type)") == "range" else ", ") \
-			 + node.xpath("string(section-end)")
-			fn = node.xpath("string(section-start)") + "~" + node.xpath("string(section-end)") + "~"
+		elif level["section-start"] and level["section-end"]:
+			name = level["section-start"] \
+			 + (" to " if level["section-range-type"] == "range" else ", ") \
+			 + level["section-end"]
+			fn = level["section-start"] + "~" + level["section-end"] + "~"
 		else:
 			raise Exception()
-	elif node.xpath("string(type)") == "section":
-		name = node.xpath("string(num)")
+	elif level["type"] == "section":
+		name = level["num"]
 		fn = name
+	return name, fn
+
+def write_section(node, spine, index, out_dir):
+	level = Level(node)
+
+	# Construct a file name,
+	name, fn = section_filename(level)
 
 	# Construct a StateDecoded-format file.
 
@@ -52,72 +132,55 @@ def write_section(node, spine, index):
 
 	# number, heading, ordering
 	make_node(dom, "section_number", name)
-	if node.xpath("string(heading)"): make_node(dom, "catch_line", node.xpath("string(heading)"))
+	if level["heading"]: make_node(dom, "catch_line", level["heading"])
 	make_node(dom, "order_by", str(index).zfill(10))
 
 	# body content
 	body_content = make_node(dom, "text", "")
 	body_section = make_node(body_content, "section", "")
 
-	render_body(node, body_section, with_heading=False)
+	render_body(level, TextBuilder(body_section), with_heading=False)
 
 	# annotation content
 	history_content = make_node(dom, "history", "")
-	for n in node:
-		if n.xpath("string(type)") == "annotations":
-			render_body(n, history_content)
-			break
+	if level.annotations is not None:
+		render_body(Level(level.annotations), TextBuilder(history_content))
 
 	# Write the remaining part out to disk, ensuring it is utf-8 encoded.
-	with open(sys.argv[1] + "/" + fn + ".xml", "wb") as f:
+	with open(out_dir + "/" + fn + ".xml", "wb") as f:
 		f.write(lxml.etree.tostring(dom, pretty_print=True, encoding="utf-8", xml_declaration=False))
 
-def traverse_tree(node, spine, index):
-	if node.xpath("string(type)") in ("section", "placeholder"):
-		write_section(node, spine, index)
-		return
-
-	if node.xpath("string(type)") != "document": # not the root element
-		if node.xpath("string(heading)"):
-			spine = spine + [
-				(
-					node.xpath("string(heading)"),
-					{
-						"label": node.xpath("string(prefix)"),
-						"identifier": node.xpath("string(num)"),
-						"order_by": str(index).zfill(10),
-						"level": str(len(spine)+1),
-					}
-				)
-			]
-
-	for i, child in enumerate(node.xpath("level")):
-		traverse_tree(child, spine, i)
-
-def render_body(node, dom, with_heading=True):
+def write_sections(batch):
+	# Worker entry point. Each item is a serialized section with its spine and index.
+	for xml, spine, index, out_dir in batch:
+		write_section(lxml.etree.fromstring(xml), spine, index, out_dir)
+
+def render_body(level, dom, with_heading=True):
+	heading = level["heading"]
+
 	# If there is a heading, no number, and multiple text paragraphs, don't do an inline heading.
-	if node.xpath("string(heading)") and not node.xpath("string(num)") and len(node.xpath("text")) > 1:
-		append_text(dom, " -- " + node.xpath("string(heading)") + " -- ")
+	if heading and not level["num"] and level.text_count > 1:
+		dom.append_text(" -- " + heading + " -- ")
 		with_heading = False
 
-	for i, child in enumerate(n for n in node if n.tag in ("text", "level")):
+	for i, child in enumerate(level.content):
 		if child.tag == "text":
 			# ignore <span>s that give styled text by just rendering the text content of the node
 			# and except if this is the top Section-level, put the level's heading inside the first
 			# text paragraph. (The number is handled by the level above because it goes in an attribute.)
-			append_text(dom, ""
-				+ ((node.xpath("string(heading)") + " -- ") if i == 0 and node.xpath("string(heading)") and with_heading  else "")
+			dom.append_text(""
+				+ ((heading + " -- ") if i == 0 and heading and with_heading  else "")
 				+ lxml.etree.tostring(child, method='text', encoding=str))
 		elif child.tag == "level":
 			# if the node has a heading but the first child is not text, put the heading in now
-			if i == 0 and node.xpath("string(heading)") and with_heading:
-				append_text(dom, node.xpath("string(heading)"))
+			if i == 0 and heading and with_heading:
+				dom.append_text(heading)
 
-			append_text(dom, "") # force paragraph-like whitespace above the new node
-			lvl = make_node(dom, "section", "")
-			lvl.tail = ""
+			dom.append_text("") # force paragraph-like whitespace above the new node
+			lvl = dom.make_child("section")
+			child_level = Level(child)
 
-			typ = child.xpath("string(type)")
+			typ = child_level["type"]
 			if typ in ("form", "table"):
 				lvl.set("type", "table")
 			elif typ in ("annotations",):
@@ -126,21 +189,165 @@ def render_body(node, dom, with_heading=True):
 				pass # nothing special for the top-level node
 			elif typ == "":
 				# paragraphs
-				if child.xpath("string(num)"): lvl.set("prefix", child.xpath("string(num)"))
+				if child_level["num"]: lvl.set("prefix", child_level["num"])
 			elif typ == "appendices":
 				pass # no special handling!! TODO
 			else:
 				raise ValueError(typ)
 
-			if len(child.xpath("text|level")) == 0:
+			lvl_text = TextBuilder(lvl)
+			if len(child_level.content) == 0:
 				# if there is nothing inside this level, better put the heading in now
-				append_text(lvl, child.xpath("string(heading)"))
+				lvl_text.append_text(child_level["heading"])
+
+			render_body(child_level, lvl_text)
+
+	dom.flush()
+
+class OpenLevel:
+	# A <level> that the reader is inside of. spine is None if this node
+	# isn't reached by going from the root through <level> children
+	# without entering a section.
+	def __init__(self, node, index, spine):
+		self.node = node
+		self.index = index
+		self.spine = spine
+		self.child_count = 0
+		self._child_spine = False
+
+	def next_child_index(self):
+		self.child_count += 1
+		return self.child_count - 1
+
+	def child_spine(self):
+		# The spine for this level's children. The level's own children that
+		# come before its sub-levels (type, heading, etc.) have been read by now.
+		if self._child_spine is False:
+			spine = self.spine
+			level = Level(self.node)
+			if spine is None or level["type"] in ("section", "placeholder"):
+				spine = None # we don't descend into sections
+			elif level["type"] != "document": # not the root element
+				if level["heading"]:
+					spine = spine + [
+						(
+							level["heading"],
+							{
+								"label": level["prefix"],
+								"identifier": level["num"],
+								"order_by": str(self.index).zfill(10),
+								"level": str(len(spine)+1),
+							}
+						)
+					]
+			self._child_spine = spine
+		return self._child_spine
+
+def iter_sections(source):
+	# Stream through the code file and yield each (section node, spine, index)
+	# that a recursive traversal from the root through <level> children would
+	# reach. Sections are cleared once the caller is done with them.
+	stack = []
+	root_child_count = 0
+	for event, node in lxml.etree.iterparse(source, events=("start", "end"), tag="level", remove_blank_text=True):
+		if event == "start":
+			parent = node.getparent()
+			if parent is None:
+				stack.append(OpenLevel(node, 0, [])) # the root element
+			elif stack and stack[-1].node is parent:
+				stack.append(OpenLevel(node, stack[-1].next_child_index(), stack[-1].child_spine()))
+			elif parent.getparent() is None:
+				# a <level> child of a root element that isn't a <level>
+				stack.append(OpenLevel(node, root_child_count, []))
+				root_child_count += 1
+			else:
+				stack.append(OpenLevel(node, 0, None))
+			continue
+
+		level = stack.pop()
+		if level.spine is None: continue
+		if string_value(node.find("type")) in ("section", "placeholder"):
+			yield node, level.spine, level.index
+			node.clear()
+
+		# Free the sections and levels that we're done with.
+		while node.getprevious() is not None and node.getprevious().tag == "level":
+			node.getparent().remove(node.getprevious())
+
+def section_digest(xml, spine, index):
+	# Everything that goes into a section's output file.
+	h = hashlib.sha1()
+	h.update(json.dumps([EXPORT_VERSION, spine, index]).encode("utf-8"))
+	h.update(xml)
+	return h.hexdigest()
+
+def load_manifest(out_dir):
+	try:
+		with open(os.path.join(out_dir, MANIFEST_FILENAME)) as f:
+			return json.load(f)
+	except FileNotFoundError:
+		return { }
+
+def save_manifest(out_dir, manifest):
+	with open(os.path.join(out_dir, MANIFEST_FILENAME), "w") as f:
+		json.dump(manifest, f, indent=2, sort_keys=True)
+
+def export(source, out_dir, jobs=None, rewrite_all=False):
+	old_manifest = load_manifest(out_dir)
+	new_manifest = { }
+	written = 0
+
+	jobs = jobs or os.cpu_count()
+	with (ProcessPoolExecutor(jobs) if jobs > 1 else contextlib.nullcontext()) as pool:
+		pending = []
+		batch = []
+		def submit():
+			pending.append(pool.submit(write_sections, batch))
+			# Don't let the reader get too far ahead of the writers.
+			while len(pending) > 4 * jobs:
+				pending.pop(0).result()
+
+		for node, spine, index in iter_sections(source):
+			xml = lxml.etree.tostring(node, encoding="utf-8", with_tail=False)
+			name, fn = section_filename(Level(node))
+			digest = section_digest(xml, spine, index)
+			new_manifest[fn] = digest
+
+			# Skip sections that haven't changed since the last export.
+			if not rewrite_all and old_manifest.get(fn) == digest and os.path.exists(out_dir + "/" + fn + ".xml"):
+				continue
+			written += 1
+
+			if pool is None:
+				write_section(node, spine, index, out_dir)
+				continue
+			batch.append((xml, spine, index, out_dir))
+			if len(batch) == BATCH_SIZE:
+				submit()
+				batch = []
+		if batch:
+			submit()
+		for future in pending:
+			future.result()
+
+	# Remove the files for sections that are gone.
+	removed = 0
+	for fn in set(old_manifest) - set(new_manifest):
+		if os.path.exists(out_dir + "/" + fn + ".xml"):
+			os.remove(out_dir + "/" + fn + ".xml")
+			removed += 1
 
-			render_body(child, lvl)
+	memprofile.checkpoint("export sections")
 
+	save_manifest(out_dir, new_manifest)
+	print("{} sections written, {} unchanged, {} removed".format(written, len(new_manifest) - written, removed), file=sys.stderr)
 
-# Read in the master code file.
-dom = lxml.etree.parse(sys.stdin.buffer, lxml.etree.XMLParser(remove_blank_text=True))
+if __name__ == "__main__":
+	argparser = argparse.ArgumentParser(description="Export a code file into the State Decoded XML format.")
+	argparser.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes (default: one per CPU)")
+	argparser.add_argument("--all", action="store_true", help="write every section, even if it hasn't changed")
+	argparser.add_argument("out_dir", help="directory to write the section files to")
+	args = argparser.parse_args()
 
-# Write out the split-up XML files.
-traverse_tree(dom.getroot(), [], 0)
+	# Read in the master code file and write out the split-up XML files.
+	export(sys.stdin.buffer, args.out_dir, args.jobs, args.all)
@@ -1,4 +1,13 @@
+# Inserts the tables in tables.xml into the code XML in place of the
+# @@TABLE@@ placeholders that the parser leaves where Word tables were.
+# The tables for a section are listed under <section id="{section num}">
+# in the order in which they appear in the section.
+#
+# Usage:
+# python3 insert_tables.py [code.xml] [tables.xml] [out.xml]
+
 import sys, lxml.etree as etree, re
+import memprofile
 
 try:
 	xml_path = sys.argv[1]
@@ -15,45 +24,84 @@ try:
 except IndexError:
 	out_path = '2015-06t.xml'
 
-with open(xml_path) as f:
-	xml = f.read() # etree.parse(f).getroot()
+table_re = re.compile(r'@@TABLE@@')
+
+def index_tables(tables_dom):
+	# Map each section id to the list of its tables, in order.
+	return {
+		section.get('id'): [table for table in section if table.tag == 'table']
+		for section in tables_dom.iterfind('section')
+	}
 
-with open(tables_path or 'tables.xml') as f:
-	Tables = etree.parse(f).getroot()
+def insert_tables(dom, tables_by_section):
+	# Replace the placeholders in a single pass over the document's sections,
+	# consuming each section's tables in document order. Returns a list of
+	# (section id, placeholder count, table count) for every section where
+	# the placeholders and tables didn't line up.
+	mismatches = []
+	for section in list(dom.iter('section')):
+		num = section.findtext('num')
+		tables = tables_by_section.pop(num, [])
+		placeholders = section.xpath('.//text()[contains(., "@@TABLE@@")]')
+		count = sum(len(table_re.findall(p)) for p in placeholders)
+		if count != len(tables):
+			mismatches.append((num, count, len(tables)))
+		if not count or not tables:
+			continue
+		tables = iter(tables)
+		for placeholder in placeholders:
+			replace_placeholders(placeholder, tables)
+	return mismatches
 
-num_re = re.compile('<num>(?P<num>.+?)</num>')
-table_re = re.compile(r'@@TABLE@@')
-sections = xml.split('<section>\n')
-
-out = []
-for section in sections:
-	try:
-		num = num_re.search(section).group(1)
-	except:
-		import ipdb
-		ipdb.set_trace()
-	section_tables = Tables.find('section[@id="{}"]'.format(num))
-	if section_tables is not None:
-		tables = section_tables.getchildren()
-		i = 0
-		def replacement(match):
-			global i
-			table = tables[i]
-			out = etree.tostring(table, pretty_print=True, encoding='utf-8').decode('utf-8')
-			table.set('inserted', 'true')
-			i = i + 1
-			return out
-		out.append(table_re.sub(replacement, section))
+def replace_placeholders(placeholder, tables):
+	# Split the text node on the placeholders and put the tables between
+	# the pieces. If we run out of tables, leave the placeholder in.
+	parts = table_re.split(placeholder)
+	node = placeholder.getparent()
+	if placeholder.is_text:
+		node.text = parts[0]
 	else:
-		out.append(section)
+		node.tail = parts[0]
+	last = None
+	for part in parts[1:]:
+		table = next(tables, None)
+		if table is None:
+			if last is not None:
+				last.tail += '@@TABLE@@' + part
+			elif placeholder.is_text:
+				node.text += '@@TABLE@@' + part
+			else:
+				node.tail += '@@TABLE@@' + part
+			continue
+		if last is not None:
+			last.addnext(table)
+		elif placeholder.is_text:
+			node.insert(0, table)
+		else:
+			node.addnext(table)
+		table.tail = part
+		last = table
 
-if len(Tables.findall('section/table[@inserted]')) != len(Tables.findall('section/table')):
-	import ipdb
-	ipdb.set_trace()
-	raise Exception('some tables not inserted')
+dom = etree.parse(xml_path)
+memprofile.checkpoint('parse code')
 
-out = '<section>\n'.join(out).encode('utf-8')
-dom = etree.fromstring(out)
+with open(tables_path or 'tables.xml', 'rb') as f:
+	tables_by_section = index_tables(etree.parse(f).getroot())
+memprofile.checkpoint('index tables')
 
+mismatches = insert_tables(dom, tables_by_section)
+memprofile.checkpoint('insert tables')
+
+for num, placeholder_count, table_count in mismatches:
+	print('section {}: {} placeholders but {} tables'.format(num, placeholder_count, table_count), file=sys.stderr)
+for num, tables in sorted(tables_by_section.items()):
+	if tables:
+		print('section {}: {} tables not inserted, section not found'.format(num, len(tables)), file=sys.stderr)
+
+out = etree.tostring(dom, pretty_print=True, encoding="utf-8")
+memprofile.checkpoint('tostring')
 with open(out_path, 'wb') as f:
-	f.write(etree.tostring(dom, pretty_print=True, encoding="utf-8"))
+	f.write(out)
+
+if mismatches or any(tables_by_section.values()):
+	sys.exit(1)
@@ -0,0 +1,306 @@
+# Writes a synthetic edition of the DC Code as .docx files, one per
+# Division, laid out the way the Lexis files are, so that open_docx,
+# parsers.Parser, insert_tables, and split_up can be benchmarked and
+# checked without the real files. The text is nonsense, but the structure
+# is what the parsers look for:
+#
+# * centered "Division I. ...", "Title 1. ...", "Chapter 1. ..." and
+#   "Subchapter I. ..." headings, each followed by indented table of
+#   contents entries
+# * "Title"-styled "§ 1-101. Heading." section lines, and "§ 1-102.
+#   [Repealed]." and "§§ 1-103 to 1-105. [Reserved]." placeholders
+# * section text, either plain or in numbered paragraphs with a bold,
+#   tab-indented "(a)", "(1)", "(A)" or "(a)(1)" run and sometimes an
+#   italic heading
+# * Word tables, with the same tables written to a tables.xml file for
+#   insert_tables.py
+# * the history parenthetical (one run, no formatting) and "Subtitle"-styled
+#   annotation headings with their paragraphs
+#
+# The same arguments and seed always produce byte-for-byte the same files.
+#
+# Usage:
+# python3 make_synthetic_code.py [--seed N] [--divisions N] [--titles N] [--chapters N] [--sections N] out_dir/
+#
+# --titles, --chapters, and --sections are per Division, Title, and
+# Chapter. The defaults make about 20,000 paragraphs. Then e.g.:
+#
+# python3 parse_code_2016-03.py out_dir/ > code.xml
+# python3 insert_tables.py code.xml out_dir/tables.xml codet.xml
+
+import sys, os, os.path, random, zipfile, argparse
+from xml.sax.saxutils import escape
+import lxml.etree as etree
+
+W = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+
+# A fixed timestamp for the zip entries so the output is reproducible.
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+CONTENT_TYPES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>
+<Override PartName="/word/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.styles+xml"/>
+</Types>"""
+
+RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/>
+</Relationships>"""
+
+DOCUMENT_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>
+</Relationships>"""
+
+STYLES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<w:styles xmlns:w="{}">
+<w:style w:type="paragraph" w:default="1" w:styleId="Normal"><w:name w:val="Normal"/></w:style>
+<w:style w:type="paragraph" w:styleId="Title"><w:name w:val="Title"/><w:basedOn w:val="Normal"/><w:rPr><w:b/></w:rPr></w:style>
+<w:style w:type="paragraph" w:styleId="Subtitle"><w:name w:val="Subtitle"/><w:basedOn w:val="Normal"/><w:rPr><w:i/></w:rPr></w:style>
+</w:styles>""".format(W)
+
+WORDS = """
+	agency amount application appointment approval assessment authority
+	board budget certificate claim commission compensation contract council
+	court credit department director district employee enforcement entity
+	facility fee fund grant hearing housing income inspection insurance
+	license mayor member notice office officer order owner payment penalty
+	permit person plan program property provision public record regulation
+	report requirement resident revenue rule school service standard tax
+	tenant transfer vehicle violation
+""".split()
+
+ANNOTATION_HEADINGS = ["Prior Codifications", "Section References", "Effect of Amendments",
+	"Editor's Notes", "Emergency Legislation", "Temporary Legislation", "Cross References"]
+
+MONTHS = ["Jan.", "Feb.", "Mar.", "Apr.", "May", "June", "July", "Aug.", "Sept.", "Oct.", "Nov.", "Dec."]
+
+CENTER = '<w:jc w:val="center"/>'
+TOC_INDENT = '<w:ind w:left="720"/>'
+TAB_STOPS = '<w:tabs><w:tab w:val="left" w:pos="360"/><w:tab w:val="left" w:pos="720"/></w:tabs>'
+
+def roman(n):
+	ret = ""
+	for value, numeral in ((1000, "M"), (900, "CM"), (500, "D"), (400, "CD"), (100, "C"), (90, "XC"),
+		(50, "L"), (40, "XL"), (10, "X"), (9, "IX"), (5, "V"), (4, "IV"), (1, "I")):
+		while n >= value:
+			ret += numeral
+			n -= value
+	return ret
+
+def letters(n, upper=False):
+	# a, b, ..., z, aa, bb, ... as in the Code's paragraph numbering.
+	s = chr(ord("a") + (n - 1) % 26) * ((n - 1) // 26 + 1)
+	return s.upper() if upper else s
+
+def run(text, b=False, i=False):
+	rpr = ("<w:b/>" if b else "") + ("<w:i/>" if i else "")
+	ret = "<w:r>"
+	if rpr: ret += "<w:rPr>" + rpr + "</w:rPr>"
+	for j, part in enumerate(text.split("\t")):
+		if j > 0: ret += "<w:tab/>"
+		if part: ret += '<w:t xml:space="preserve">' + escape(part) + "</w:t>"
+	return ret + "</w:r>"
+
+def paragraph(*runs, style=None, ppr=""):
+	if style: ppr = '<w:pStyle w:val="{}"/>'.format(style) + ppr
+	if not runs: return "<w:p>" + ("<w:pPr>" + ppr + "</w:pPr>" if ppr else "") + "</w:p>"
+	return "<w:p>" + ("<w:pPr>" + ppr + "</w:pPr>" if ppr else "") + "".join(runs) + "</w:p>"
+
+class CodeGenerator:
+	# Makes the paragraphs of one Division. Each Division gets its own
+	# random number generator so that Divisions don't depend on each other.
+
+	def __init__(self, seed, division, first_title, args):
+		self.random = random.Random("{}:{}".format(seed, division))
+		self.division = division
+		self.first_title = first_title
+		self.args = args
+		self.body = []
+		self.tables = []
+		self.paragraphs = 0
+
+	def words(self, lo, hi):
+		return " ".join(self.random.choice(WORDS) for _ in range(self.random.randint(lo, hi)))
+
+	def heading(self):
+		return self.words(1, 5).capitalize() + "."
+
+	def sentence(self):
+		return "The " + self.words(6, 30) + "."
+
+	def text(self):
+		return " ".join(self.sentence() for _ in range(self.random.randint(1, 3)))
+
+	def add(self, *runs, **kwargs):
+		self.body.append(paragraph(*runs, **kwargs))
+		self.paragraphs += 1
+
+	def add_toc(self, heading, entries):
+		self.add(run(heading), ppr=CENTER)
+		self.add()
+		for entry in entries:
+			self.add(run(entry), ppr=TOC_INDENT)
+		self.add()
+
+	def make(self):
+		# An empty paragraph comes first, since the parser skips whatever
+		# paragraph gets index 0.
+		self.add()
+		titles = []
+		for t in range(self.first_title, self.first_title + self.args.titles):
+			titles.append((t, self.heading()))
+		self.add_toc("Division {}. {}".format(roman(self.division), self.heading()),
+			["Title {}. {}".format(t, h) for t, h in titles])
+		for t, h in titles:
+			self.make_title(t, h)
+		return self.body, self.tables
+
+	def make_title(self, t, heading):
+		chapters = [(c, self.heading()) for c in range(1, self.args.chapters + 1)]
+		self.add_toc("Title {}. {}".format(t, heading),
+			["Chapter {}. {}".format(c, h) for c, h in chapters])
+		for c, h in chapters:
+			# Sections are numbered t-cNN, so there are at most 99 in a chapter.
+			sections = ["{}-{}{:02}".format(t, c, s) for s in range(1, min(self.args.sections, 99) + 1)]
+			if self.random.random() < 0.2 and len(sections) >= 4:
+				# Split the chapter into subchapters.
+				split = self.random.randint(1, len(sections) - 1)
+				subchapters = ["Subchapter {}. {}".format(roman(i), self.heading()) for i in (1, 2)]
+				self.add_toc("Chapter {}. {}".format(c, h), subchapters)
+				self.make_sections(subchapters[0], sections[:split])
+				self.make_sections(subchapters[1], sections[split:])
+			else:
+				self.make_sections("Chapter {}. {}".format(c, h), sections)
+
+	def make_sections(self, heading, sections):
+		# Pick the section headings first so they can go in the table of contents.
+		headings = [self.heading() for _ in sections]
+		self.add_toc(heading, ["{}.\t{}".format(num, h) for num, h in zip(sections, headings)])
+		i = 0
+		while i < len(sections):
+			k = self.random.random()
+			if k < 0.03 and i + 2 < len(sections):
+				self.add(run("§§ {} to {}. [Repealed].".format(sections[i], sections[i + 2])), style="Title")
+				i += 3
+				continue
+			if k < 0.06:
+				self.add(run("§ {}. [{}].".format(sections[i], self.random.choice(["Repealed", "Reserved", "Expired"]))), style="Title")
+				self.add_history()
+				i += 1
+				continue
+			self.add(run("§ {}. {}".format(sections[i], headings[i])), style="Title")
+			self.add()
+			self.make_section_text(sections[i])
+			self.add_history()
+			self.add_annotations()
+			i += 1
+
+	def make_section_text(self, num):
+		if self.random.random() < 0.3:
+			self.add(run("\t" + self.text()), ppr=TAB_STOPS)
+		else:
+			self.make_numbered_paragraphs(0, self.random.randint(1, self.args.paragraphs))
+		if self.random.random() < self.args.table_rate:
+			self.add(run("The following table applies:"))
+			self.make_table(num)
+
+	def make_numbered_paragraphs(self, depth, count, skip_first=False):
+		# (a) paragraphs contain (1) paragraphs, which contain (A) paragraphs.
+		for n in range(1, count + 1):
+			label = ["({})".format(letters(n)), "({})".format(n), "({})".format(letters(n, True))][depth]
+			children = self.random.randint(2, 4) if depth < 2 and self.random.random() < 0.3 else 0
+			if skip_first and n == 1:
+				# The label was already in the parent's "(a)(1)" run.
+				pass
+			elif children and depth == 0 and self.random.random() < 0.3:
+				# "(a)(1)" numbering, where the paragraph has no text of its own.
+				self.add(run("\t{}(1) ".format(label), b=True), run(self.text()), ppr=TAB_STOPS)
+				self.make_numbered_paragraphs(depth + 1, children, skip_first=True)
+				continue
+			else:
+				runs = [run("\t" * (depth + 1) + label + " ", b=True)]
+				if depth == 0 and self.random.random() < 0.3:
+					runs.append(run(self.heading(), i=True))
+					runs.append(run(" " + self.text()))
+				else:
+					runs.append(run(self.text()))
+				self.add(*runs, ppr=TAB_STOPS)
+			if children:
+				self.make_numbered_paragraphs(depth + 1, children)
+
+	def make_table(self, num):
+		rows = [[self.heading() for _ in range(2)] for _ in range(self.random.randint(2, 8))]
+		self.body.append("<w:tbl><w:tblPr/>" + "".join(
+			"<w:tr>" + "".join("<w:tc>" + paragraph(run(cell)) + "</w:tc>" for cell in row) + "</w:tr>"
+			for row in rows) + "</w:tbl>")
+		self.paragraphs += 1
+		self.tables.append((num, rows))
+
+	def add_history(self):
+		self.add(run("({} {}, {}, D.C. Law {}-{}, § {}, {} DCR {}.)".format(
+			self.random.choice(MONTHS), self.random.randint(1, 28), self.random.randint(1975, 2015),
+			self.random.randint(1, 21), self.random.randint(1, 300), self.random.randint(1, 900),
+			self.random.randint(20, 62), self.random.randint(1, 12000))))
+
+	def add_annotations(self):
+		for heading in self.random.sample(ANNOTATION_HEADINGS, self.random.randint(0, 3)):
+			self.add(run(heading + "."), style="Subtitle")
+			for _ in range(self.random.randint(1, 2)):
+				self.add(run(self.text()))
+
+def write_docx(path, body):
+	document = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<w:document xmlns:w="{}"><w:body>{}</w:body></w:document>'.format(W, "".join(body))
+	with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+		for name, data in (("[Content_Types].xml", CONTENT_TYPES), ("_rels/.rels", RELS),
+			("word/_rels/document.xml.rels", DOCUMENT_RELS), ("word/styles.xml", STYLES), ("word/document.xml", document)):
+			info = zipfile.ZipInfo(name, date_time=ZIP_DATE_TIME)
+			info.compress_type = zipfile.ZIP_DEFLATED
+			z.writestr(info, data)
+
+def write_tables(path, tables):
+	# In the format of tables.xml: the tables of each section, in order.
+	dom = etree.Element("tables")
+	section = None
+	for num, rows in tables:
+		if section is None or section.get("id") != num:
+			section = etree.SubElement(dom, "section", id=num)
+		table = etree.SubElement(section, "table")
+		for i, row in enumerate(rows):
+			tr = etree.SubElement(table, "tr")
+			for cell in row:
+				etree.SubElement(tr, "th" if i == 0 else "td").text = cell
+	with open(path, "wb") as f:
+		f.write(etree.tostring(dom, pretty_print=True, encoding="utf-8"))
+
+def make_code(out_dir, args):
+	# Returns the number of paragraphs written.
+	os.makedirs(out_dir, exist_ok=True)
+	tables = []
+	paragraphs = 0
+	for d in range(1, args.divisions + 1):
+		generator = CodeGenerator(args.seed, d, (d - 1) * args.titles + 1, args)
+		body, division_tables = generator.make()
+		write_docx(os.path.join(out_dir, "Division {}.docx".format(roman(d))), body)
+		tables.extend(division_tables)
+		paragraphs += generator.paragraphs
+	write_tables(os.path.join(out_dir, "tables.xml"), tables)
+	return paragraphs
+
+if __name__ == "__main__":
+	argparser = argparse.ArgumentParser(description="Write a synthetic DC Code as .docx files.")
+	argparser.add_argument("--seed", type=int, default=0, help="random seed (default: 0)")
+	argparser.add_argument("--divisions", type=int, default=2, help="number of Divisions, one .docx file each (default: 2)")
+	argparser.add_argument("--titles", type=int, default=3, help="Titles per Division (default: 3)")
+	argparser.add_argument("--chapters", type=int, default=10, help="Chapters per Title (default: 10)")
+	argparser.add_argument("--sections", type=int, default=25, help="sections per Chapter, at most 99 (default: 25)")
+	argparser.add_argument("--paragraphs", type=int, default=6, help="most top-level numbered paragraphs in a section (default: 6)")
+	argparser.add_argument("--table-rate", type=float, default=0.03, help="fraction of sections with a table (default: 0.03)")
+	argparser.add_argument("out_dir")
+	args = argparser.parse_args()
+
+	paragraphs = make_code(args.out_dir, args)
+	print("{} paragraphs in {} files".format(paragraphs, args.divisions), file=sys.stderr)
@@ -1,4 +1,6 @@
 from enum import Enum
+from collections import namedtuple
+from collections.abc import Mapping
 import re
 
 class exists(object):
@@ -125,6 +127,43 @@ anno = Matcher({
 })
 
 
+#################################
+
+class CascadeMatch(namedtuple('CascadeMatch', ['kind', 'text', 'groups', 'groupdict'])):
+	def group(self, i=0):
+		return self.groups[i - 1] if i else self.text
+
+class RegexCascade(object):
+	"""
+	Classifies a string by trying a list of (kind, pattern) pairs in order,
+	the same as a chain of re.match(pattern + '$', string) calls, but with
+	a single compiled alternation. Returns a CascadeMatch with the kind of
+	the first pattern that matches and that pattern's own groups, or None.
+	Pass dollar_sign=False to match just a prefix of the string.
+	"""
+	def __init__(self, *patterns, flags=0, dollar_sign=True):
+		self.alternatives = {}
+		alternatives = []
+		group = 0
+		for kind, pattern in patterns:
+			compiled = re.compile(pattern, flags)
+			# Each alternative is wrapped in a group so we can tell which one
+			# matched. The group closes last, so it is the match's lastindex.
+			group += 1
+			self.alternatives[group] = (kind, compiled)
+			alternatives.append('(' + re.sub(r'\(\?P<\w+>', '(', pattern) + ('$' if dollar_sign else '') + ')')
+			group += compiled.groups
+		self.regex = re.compile('|'.join(alternatives), flags)
+
+	def match(self, string):
+		m = self.regex.match(string)
+		if m is None:
+			return None
+		kind, compiled = self.alternatives[m.lastindex]
+		groups = m.groups()[m.lastindex:m.lastindex + compiled.groups]
+		return CascadeMatch(kind, m.group(m.lastindex), groups, {name: groups[i - 1] for name, i in compiled.groupindex.items()})
+
+
 #################################
 
 class NoMatch(BaseException):
@@ -224,7 +263,7 @@ def match(pattern, obj, is_child=False, **kwargs):
 		return True
 
 def isdict(obj):
-	return isinstance(obj, dict)
+	return isinstance(obj, (dict, Mapping))
 
 def islist(obj):
 	return isinstance(obj, list)
@@ -0,0 +1,173 @@
+# Opt-in memory profiling for the build scripts, to find out which stage
+# of a build uses the most memory. Set MEMPROFILE to a file name to turn
+# it on:
+#
+# MEMPROFILE=parse.json python3 parse_code_2016-03.py 2016-03/ > 2016-03.xml
+# MEMPROFILE=insert.json python3 insert_tables.py
+#
+# or to a directory to write a report named after each script into it
+# (e.g. MEMPROFILE=profiles/ ./build.sh).
+#
+# The scripts call memprofile.checkpoint("stage name") at the end of each
+# stage (opening a .docx file, loading the JSON cache, parsing, tostring,
+# etc.), which does nothing unless profiling is on. When it's on, each
+# checkpoint records:
+#
+# * the memory allocated by Python (tracemalloc) now and at its peak
+#   since the last checkpoint
+# * the process's resident memory (RSS) now and at its peak since the
+#   last checkpoint (since the start, where the peak can't be reset)
+# * the allocation sites (file:line) holding the most memory, and the
+#   sites that grew the most since the last checkpoint
+#
+# When the script exits, a report is printed to stderr and written as
+# JSON to MEMPROFILE. tracemalloc only sees memory allocated through
+# Python, not by libxml2, so a large lxml tree shows up in RSS but not
+# in the traced numbers. Tracing makes the scripts a few times slower.
+
+import sys, os, os.path, time, json, atexit, resource, tracemalloc
+
+ENV_VAR = "MEMPROFILE"
+
+# How many allocation sites to keep at each checkpoint.
+TOP_SITES = 10
+
+_profile = None
+
+def reset_peak_rss():
+	# Resets the peak RSS of this process, if the OS lets us. Returns
+	# whether it did.
+	try:
+		with open("/proc/self/clear_refs", "w") as f:
+			f.write("5")
+		return True
+	except OSError:
+		return False
+
+def _proc_status_kb(field):
+	try:
+		with open("/proc/self/status") as f:
+			for line in f:
+				if line.startswith(field + ":"):
+					return int(line.split()[1])
+	except OSError:
+		pass
+	return None
+
+def current_rss_kb():
+	return _proc_status_kb("VmRSS")
+
+def peak_rss_kb(since_reset=False):
+	# The peak RSS of this process (since reset_peak_rss, if since_reset)
+	# and of any child processes we waited for.
+	children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+	peak = _proc_status_kb("VmHWM") if since_reset else None
+	if peak is None:
+		peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		if sys.platform == "darwin": peak //= 1024 # bytes, not kilobytes
+	return max(peak, children)
+
+def _site(frame):
+	fn = frame.filename
+	if not os.path.relpath(fn).startswith(".."):
+		fn = os.path.relpath(fn)
+	return "{}:{}".format(fn, frame.lineno)
+
+class MemoryProfile:
+	def __init__(self, path):
+		self.path = path
+		self.script = os.path.basename(sys.argv[0]) if sys.argv and sys.argv[0] else "python"
+		self.checkpoints = []
+		self.started = time.time()
+		tracemalloc.start()
+		self.rss_peak_per_stage = reset_peak_rss()
+		self.last_sites = { }
+
+	def site_statistics(self):
+		# Returns the memory held by each allocation site, largest first,
+		# leaving out what tracemalloc and this module allocated.
+		# (Snapshot.filter_traces would do it too, but much more slowly.)
+		return [
+			(_site(stat.traceback[0]), stat.size, stat.count)
+			for stat in tracemalloc.take_snapshot().statistics("lineno")
+			if stat.traceback[0].filename not in (tracemalloc.__file__, __file__)
+		]
+
+	def checkpoint(self, name):
+		traced, traced_peak = tracemalloc.get_traced_memory()
+		rss, rss_peak = current_rss_kb(), peak_rss_kb(self.rss_peak_per_stage)
+		sites = self.site_statistics()
+		growth = [
+			(site, size - self.last_sites.get(site, (0, 0))[0], count - self.last_sites.get(site, (0, 0))[1])
+			for site, size, count in sites
+		]
+		growth.sort(key=lambda g: -g[1])
+		self.checkpoints.append({
+			"stage": name,
+			"seconds": round(time.time() - self.started, 3),
+			"traced_kb": traced // 1024,
+			"traced_peak_kb": traced_peak // 1024,
+			"rss_kb": rss,
+			"rss_peak_kb": rss_peak,
+			"top_sites": [
+				{ "site": site, "size_kb": size // 1024, "count": count }
+				for site, size, count in sites[:TOP_SITES]
+			],
+			"growth_sites": [
+				{ "site": site, "size_diff_kb": size_diff // 1024, "count_diff": count_diff }
+				for site, size_diff, count_diff in growth[:TOP_SITES]
+				if size_diff >= 1024
+			],
+		})
+		self.last_sites = { site: (size, count) for site, size, count in sites }
+		tracemalloc.reset_peak()
+		if self.rss_peak_per_stage:
+			reset_peak_rss()
+
+	def report(self):
+		return {
+			"script": self.script,
+			"argv": sys.argv,
+			"rss_peak_per_stage": self.rss_peak_per_stage,
+			"checkpoints": self.checkpoints,
+		}
+
+	def print_report(self, out):
+		print("memory profile of {} (MB; peaks are {})".format(self.script,
+			"since the previous stage" if self.rss_peak_per_stage else "traced since the previous stage, RSS since the start"), file=out)
+		print("{:<40} {:>8} {:>8} {:>8} {:>8} {:>8}".format("stage", "seconds", "traced", "peak", "RSS", "peak"), file=out)
+		for c in self.checkpoints:
+			print("{:<40} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f}".format(c["stage"][:40], c["seconds"],
+				c["traced_kb"] / 1024, c["traced_peak_kb"] / 1024, (c["rss_kb"] or 0) / 1024, c["rss_peak_kb"] / 1024), file=out)
+			for site in [site for site in c["growth_sites"] if site["size_diff_kb"] >= 100][:3]:
+				print("    {:+9.1f} MB  {}".format(site["size_diff_kb"] / 1024, site["site"]), file=out)
+		if self.checkpoints:
+			top = max(self.checkpoints, key=lambda c: c["traced_kb"])
+			print("largest allocation sites at {}:".format(top["stage"]), file=out)
+			for site in top["top_sites"]:
+				print("    {:9.1f} MB  {:>9} blocks  {}".format(site["size_kb"] / 1024, site["count"], site["site"]), file=out)
+
+	def finish(self):
+		self.checkpoint("exit")
+		path = self.path
+		if os.path.isdir(path):
+			path = os.path.join(path, os.path.splitext(self.script)[0] + ".json")
+		with open(path, "w") as f:
+			json.dump(self.report(), f, indent=2)
+		self.print_report(sys.stderr)
+		print("memory profile written to", path, file=sys.stderr)
+		tracemalloc.stop()
+
+def start(path):
+	global _profile
+	if _profile is None:
+		_profile = MemoryProfile(path)
+		atexit.register(_profile.finish)
+
+def checkpoint(name):
+	# Marks the end of a stage. Does nothing unless profiling is on.
+	if _profile is not None:
+		_profile.checkpoint(name)
+
+if os.environ.get(ENV_VAR):
+	start(os.environ[ENV_VAR])
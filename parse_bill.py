@@ -12,105 +12,134 @@
 # it with this command-line option:
 #
 # google-chrome --allow-file-access-from-files 
-
-import sys, re, lxml.etree as etree, datetime, json
+#
+# To convert many bills at once:
+#
+# python3 parse_bill.py -o output/ [-j N] [--report report.json] bills/ 'more/*.docx'
+#
+# Each directory is searched for .docx files, and each output goes to the
+# same relative path under output/ with an .xml extension. The bills are
+# parsed in a pool of N worker processes (one per CPU by default). Bills
+# whose contents and parser code haven't changed since the last run are
+# skipped. The report, JSON or CSV depending on its extension, lists each
+# bill's error counts by reason and how long it took, and the slowest
+# bills are listed at the end.
+#
+# --doc-json also saves the paragraphs read from the docx, for debugging,
+# to the given file (doc.json if no file is given), or with -o as
+# .doc.json next to each output. Put it after the inputs or give its file
+# as --doc-json=FILE, so that it doesn't take an input as its file.
+
+import sys, os, re, lxml.etree as etree, datetime, json, bisect, glob, hashlib, time, csv, argparse
+from collections import Counter
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from worddoc import open_docx
 from matchers import Matcher, isint, exists
 
-errors = 0
-
-class Para(dict):
-	def __init__(self, paras, para=None):
+class ParseContext:
+	# Everything a call to parse() keeps track of as it goes, so that
+	# parses running at the same time don't share anything.
+	def __init__(self):
+		self.errors = 0
+		self.reasons = Counter()
+
+class Para(Mapping):
+	# A cursor over a run of paragraphs, paras[start:end], positioned at
+	# paras[pos]. Reading and writing keys reads and writes that paragraph's
+	# dict. Navigating returns new cursors over the same shared list, so
+	# nothing is copied. An empty run (start == end) is falsy. quotes is
+	# the list's QuoteIndex, if it has one.
+	__slots__ = ('_paras', 'start', 'end', 'pos', 'quotes')
+
+	def __init__(self, paras, start=0, end=None, pos=None, quotes=None):
 		self._paras = paras
-		if not paras:
-			return None
-		if para is None:
-			para = paras[0]
-		if isint(para):
-			para = paras[paras[0]['index'] + para]
-		super().__init__(para)
+		self.start = start
+		self.end = len(paras) if end is None else end
+		self.pos = start if pos is None else pos
+		self.quotes = quotes
+
+	def at(self, pos):
+		return Para(self._paras, self.start, self.end, pos, self.quotes)
+
+	def slice(self, start, end):
+		return Para(self._paras, start, end, None, self.quotes)
 
 	def next(self, skip=0, skip_empty=True):
-		index = self['index'] - self._paras[0]['index']
-		try:
-			para = Para(self._paras, self._paras[index + 1])
-		except:
-			return None
-		if skip_empty and not para['text']:
-			para = para.next(skip_empty=skip_empty)
-		if skip:
-			return para.next(skip-1, skip_empty)
-		else:
-			return para
+		pos = self.pos
+		while True:
+			pos += 1
+			if pos >= self.end:
+				return None
+			if skip_empty and not self.at(pos)['text']:
+				continue
+			if skip:
+				skip -= 1
+				continue
+			return self.at(pos)
 
 	def last(self):
-		return Para(self._paras, self._paras[-1])
+		return self.at(self.end - 1)
 
 	def prev(self, skip=0, skip_empty=True):
-		index = self['index'] - self._paras[0]['index']
-		if index < 1:
-			return None
-		para = Para(self._paras, self._paras[index - 1])
-		if skip_empty and not para['text']:
-			para = para.prev(skip_empty=skip_empty)
-		if skip:
-			return para.prev(skip-1, skip_empty)
-		else:
-			return para
+		pos = self.pos
+		while True:
+			pos -= 1
+			if pos < self.start:
+				return None
+			if skip_empty and not self.at(pos)['text']:
+				continue
+			if skip:
+				skip -= 1
+				continue
+			return self.at(pos)
 
 	def leading(self, index=None, matcher=None):
-		paras = self._paras[self.raw_index:]
 		if not index:
-			index = len(paras)
-			for i, para in enumerate(paras):
-				para = Para(self._paras, para)
+			index = self.end - self.pos
+			for pos in range(self.pos, self.end):
+				para = self.at(pos)
 				if not matcher(para) and para['text']:
-					index = i
+					index = pos - self.pos
 					break
-		return [Para(paras[:max(index, 0)]), Para(paras[index:])]
+		return [self.slice(self.pos, self.pos + max(index, 0)), self.slice(self.pos + index, self.end)]
 
 	def trailing(self, index=None, matcher=None):
-		paras = self._paras[self.raw_index:]
 		if not index:
-			paras.reverse()
-			index = len(paras)
-			for i, para in enumerate(paras):
-				para = Para(self._paras, para)
+			index = self.end - self.pos
+			for i, pos in enumerate(range(self.end - 1, self.pos - 1, -1)):
+				para = self.at(pos)
 				if not matcher(para) and para['text']:
 					index = i - 1
 					break
-			paras.reverse()
 		if index <= 0:
 			return [self, None]
-		return [Para(paras[:-index]), Para(paras[-index:])]
+		return [self.slice(self.pos, self.end - index), self.slice(self.end - index, self.end)]
 
 	def search(self, matcher, reverse=False):
 		if reverse:
-			paras = self._paras[:self.raw_index+1][::-1]
+			positions = range(self.pos, self.start - 1, -1)
 		else:
-			paras = self._paras[self.raw_index:]
-		for para in paras:
-			para = Para(self._paras, para)
+			positions = range(self.pos, self.end)
+		for pos in positions:
+			para = self.at(pos)
 			if matcher(para):
 				return para
 
 	def split(self, matcher):
-		paras = self._paras[self.raw_index:]
 		out = []
-		working = []
-		for para in paras:
-			p = Para(self._paras, para)
-			if working and matcher(p):
-				out.append(working)
-				working = []
-			working.append(para)
-		if working:
-			out.append(working)
-		return [Para(paras) for paras in out]
+		first = self.pos
+		for pos in range(self.pos + 1, self.end):
+			if matcher(self.at(pos)):
+				out.append(self.slice(first, pos))
+				first = pos
+		if first < self.end:
+			out.append(self.slice(first, self.end))
+		return out
 
 	def __getitem__(self, item):
 		try:
-			return super().__getitem__(item)
+			return self._paras[self.pos][item]
 		except KeyError:
 			if item == 'text':
 				return self.text()
@@ -118,19 +147,43 @@ class Para(dict):
 				raise
 
 	def __setitem__(self, key, item):
-		self._paras[self.raw_index][key] = item
-		super().__setitem__(key, item)
+		self._paras[self.pos][key] = item
+		if key == 'text' and self.quotes:
+			self.quotes.update(self.pos)
+
+	def __delitem__(self, key):
+		del self._paras[self.pos][key]
+		if key == 'text' and self.quotes:
+			self.quotes.update(self.pos)
+
+	def __contains__(self, key):
+		return key in self._paras[self.pos]
+
+	def __iter__(self):
+		return iter(self._paras[self.pos])
+
+	def __len__(self):
+		return len(self._paras[self.pos])
+
+	def __bool__(self):
+		return self.start < self.end
+
+	__eq__ = object.__eq__
+	__hash__ = object.__hash__
+
+	def get(self, key, default=None):
+		return self._paras[self.pos].get(key, default)
 
 	def text(self, skip=0):
 		return "".join(r["text"].strip('\n') for r in self["runs"][skip:]).strip()
 
 	@property
 	def raw_index(self):
-		return self['index'] - self._paras[0]['index']
+		return self.pos - self.start
 
 	@property
 	def paras(self):
-	    return [Para(self._paras, para) for para in self._paras]
+		return [self.at(pos) for pos in range(self.start, self.end)]
 
 has_leading_whitespace = Matcher({'runs': [{'text': re.compile(r'^\s*')}]})
 
@@ -157,34 +210,82 @@ def parse_file(path_to_file):
 
 	return paras
 
-def pipeline(*parsers, final_parser=None):
-	def _next_parser(dom, para, next_parser=None):
-		if parsers:
-			parser = parsers[0] if callable(parsers[0]) else globals()[parsers[0]]
-			return parser(dom, para, pipeline(*parsers[1:], final_parser=final_parser or next_parser))
-		elif next_parser:
-			return next_parser(dom, para)
-		elif final_parser:
-			return final_parser(dom, para)
-	return _next_parser
+# A document is parsed by a pipeline of stages. Each stage is called as
+# stage(ctx, dom, para, next_parser) and handles what it recognizes at
+# para, handing the rest on by yielding next_parser(dom, para) (as many
+# times as it likes). A stage can also yield another pipeline, called as
+# pipeline(dom, para) or pipeline(dom, para, next_parser) to continue
+# with next_parser after it. What's yielded is run to completion before
+# the stage resumes. run() keeps the stages in progress on an explicit
+# stack, so deeply nested bills don't run into the recursion limit.
+
+class Pipeline:
+	def __init__(self, *stages):
+		self.stages = list(stages)
+
+	def __call__(self, dom, para, next_parser=None):
+		return (Continuation(self.stages, 0, next_parser), dom, para)
+
+class Continuation:
+	# The stages of a pipeline from index on, and then the continuation after
+	# it (or None). This is what a stage gets as next_parser.
+	__slots__ = ('stages', 'index', 'after')
+
+	def __init__(self, stages, index, after):
+		self.stages = stages
+		self.index = index
+		self.after = after
+
+	def __call__(self, dom, para):
+		return (self, dom, para)
+
+def start(ctx, task):
+	# Call the next stage of a task, returning the stage's generator (or
+	# None if it's done already or there's no stage left).
+	continuation, dom, para = task
+	while continuation is not None:
+		if continuation.index == len(continuation.stages):
+			continuation = continuation.after
+			continue
+		stage = continuation.stages[continuation.index]
+		rest = Continuation(continuation.stages, continuation.index + 1, continuation.after)
+		if isinstance(stage, Pipeline):
+			continuation = Continuation(stage.stages, 0, rest)
+			continue
+		return stage(ctx, dom, para, rest)
+
+def run(ctx, task):
+	# Run a task and everything it yields, depth first.
+	stack = []
+	stage = start(ctx, task)
+	while True:
+		if stage is not None:
+			stack.append(stage)
+		if not stack:
+			return
+		try:
+			task = next(stack[-1])
+		except StopIteration:
+			stack.pop()
+			stage = None
+			continue
+		stage = start(ctx, task)
 
 def _get_short_title_para(para):
 	return  para.search(lambda para: para['text'].startswith('BE IT ENACTED BY THE COUNCIL'))
 
 short_title_re = re.compile(r'(\u201c|")(?P<short_title>.*?)(\u201d|")')
-def header(dom, para, next_parser):
-	global errors
+def header(ctx, dom, para, next_parser):
 	make_node(dom, 'act-header', para['text'])
 	para = para.next(skip=3)
 	make_node(dom, 'long-title', para['text'])
 	make_node(dom, 'short-title', short_title_re.search(_get_short_title_para(para)['text']).group('short_title'))
-	next_parser(dom, para.next())
+	yield next_parser(dom, para.next())
 
-	if errors:
-		dom.attrib['errors'] = str(errors)
-	errors = 0
+	if ctx.errors:
+		dom.attrib['errors'] = str(ctx.errors)
 
-def toc(dom, para, next_parser):
+def toc(ctx, dom, para, next_parser):
 	toc_dom = []
 	next_para = para.next()
 	style = next_para.get('properties', {}).get('style', '')
@@ -202,12 +303,12 @@ def toc(dom, para, next_parser):
 		para = next_para
 
 	body = make_node(dom, 'body')
-	next_parser(body, para)
+	yield next_parser(body, para)
 	
-def short_title(dom, para, next_parser):
+def short_title(ctx, dom, para, next_parser):
 	para = _get_short_title_para(para)
 	make_node(dom, 'text', text=para['text'])
-	next_parser(dom, para.next())
+	yield next_parser(dom, para.next())
 
 def is_container(prefix):
 	return Matcher({
@@ -218,7 +319,7 @@ is_any_container = Matcher({
 	'text': re.compile(r'^(?P<prefix>(division|title|subtitle|article|subdivision|chapter|subchapter|part|subpart)) (?P<num>[\w-]+\.) (?P<heading>.+)', re.I),
 })
 
-def _container(dom, para, next_parser):
+def _container(ctx, dom, para, next_parser):
 	if is_any_container(para):
 		_is_container = is_container(para['text_re'].group('prefix'))
 		container_paras = para.split(_is_container)
@@ -227,20 +328,20 @@ def _container(dom, para, next_parser):
 			container_dom = make_container(dom, **container_para['text_re'].groupdict())
 			next_para = container_para.next()
 			if is_any_container(next_para):
-				_container(container_dom, next_para, next_parser)
+				yield Pipeline(_container)(container_dom, next_para, next_parser)
 			else:
-				next_parser(container_dom, next_para)
+				yield next_parser(container_dom, next_para)
 	else:
-		next_parser(dom, para)
+		yield next_parser(dom, para)
 
 detect_section = Matcher({'text': re.compile(r'^Sec[,. ;/):-]')})
 is_section = Matcher({'text': re.compile(r'^(\u00a7|Sec\.) (?P<num>[\w.-]+)\. (?P<heading>[^\(][^.]+\.(\s[A-Z]|$))?(?P<remainder>.*)')})
 
-def _section(dom, para, next_parser):
+def _section(ctx, dom, para, next_parser):
 	section_paras = para.split(detect_section)
 	for section_para in section_paras:
 		if not is_section(section_para):
-			make_error(dom, section_para, reason='invalid section')
+			make_error(ctx, dom, section_para, reason='invalid section')
 			return
 		re_sults = section_para['text_re'].groupdict()
 		section_dom = make_section(dom, **re_sults)
@@ -250,9 +351,10 @@ def _section(dom, para, next_parser):
 		else:
 			next_para = section_para.next()
 		if next_para:
-			next_parser(section_dom, next_para)
+			yield next_parser(section_dom, next_para)
 
-is_any_para = Matcher({'text': re.compile(r'^(?P<num>\([\w-]+\)) ?(?P<remainder>.*)')})
+any_para_re = re.compile(r'^(?P<num>\([\w-]+\)) ?(?P<remainder>.*)')
+is_any_para = Matcher({'text': any_para_re})
 
 def is_para(para):
 	indent = para['indent']
@@ -261,9 +363,9 @@ def is_para(para):
 	return _is_para
 
 
-def _para(dom, para, next_parser):
+def _para(ctx, dom, para, next_parser):
 	if not is_any_para(para):
-		make_error(dom, para, reason='invalid numbered para')
+		make_error(ctx, dom, para, reason='invalid numbered para')
 		return
 	indent = para['properties'].get('indentation')
 	_is_para = is_para(para)
@@ -274,7 +376,7 @@ def _para(dom, para, next_parser):
 		# 	import ipdb
 		# 	ipdb.set_trace()
 		if not _is_para(para_para):
-			make_error(dom, para_para, reason='invalid numbered para')
+			make_error(ctx, dom, para_para, reason='invalid numbered para')
 			continue
 		re_sults = para_para['text_re'].groupdict()
 		para_dom = make_para(dom, **re_sults)
@@ -287,35 +389,121 @@ def _para(dom, para, next_parser):
 			next_para = para_para.next()
 		if next_para:
 			if is_any_para(next_para):
-				para_parser(para_dom, next_para, next_parser)
+				yield para_parser(para_dom, next_para, next_parser)
 			else:
-				next_parser(para_dom, next_para)
+				yield next_parser(para_dom, next_para)
 
 trailing_quote_re = re.compile(r'"(.?)$')
 
 def is_include(para):
+	if para.quotes:
+		return para.quotes.include[para.pos]
 	text = para['text']
 	return bool((text.startswith('"') and (text.count('"') % 2 or trailing_quote_re.search(text))))
 
 def is_include_end(para):
+	if para.quotes:
+		return para.quotes.include_end[para.pos]
 	text = para['text']
 	return bool((trailing_quote_re.search(text) and (text.startswith('"') or text.count('"') % 2)))
 
-def include(dom, para, next_parser):
+def is_text(para):
+	if para.quotes:
+		return para.quotes.text[para.pos]
+	return not (is_any_para(para) or is_include(para) or is_include_end(para))
+
+class QuoteIndex:
+	# What include detection and the text stage need to know about each
+	# paragraph, worked out in one pass over the document instead of from
+	# the text each time a paragraph is looked at: its number of double
+	# quotes, whether it starts or ends with one, whether it can start or
+	# end an include, and whether it is plain text or empty. The positions of the
+	# paragraphs that can end an include, and of the non-empty ones that
+	# aren't plain text, are kept sorted so that the next or last one in a
+	# range is a binary search away. Para updates a paragraph's entry when
+	# its text is changed.
+	def __init__(self, paras):
+		self.paras = paras
+		n = len(paras)
+		self.quote_count = [0] * n
+		self.starts_with_quote = [False] * n
+		self.ends_with_quote = [False] * n
+		self.include = [False] * n
+		self.include_end = [False] * n
+		self.text = [True] * n
+		self.empty = [True] * n
+		self.include_ends = []
+		self.non_text = []
+		for pos in range(n):
+			self.index(pos)
+			if self.include_end[pos]:
+				self.include_ends.append(pos)
+			if self.is_non_text(pos):
+				self.non_text.append(pos)
+
+	def index(self, pos):
+		text = Para(self.paras, pos=pos)['text']
+		count = text.count('"')
+		starts = text.startswith('"')
+		ends = bool(trailing_quote_re.search(text))
+		self.quote_count[pos] = count
+		self.starts_with_quote[pos] = starts
+		self.ends_with_quote[pos] = ends
+		self.include[pos] = starts and bool(count % 2 or ends)
+		self.include_end[pos] = ends and bool(starts or count % 2)
+		self.text[pos] = not (any_para_re.match(text) or self.include[pos] or self.include_end[pos])
+		self.empty[pos] = not text
+
+	def is_non_text(self, pos):
+		return not self.text[pos] and not self.empty[pos]
+
+	def update(self, pos):
+		self.index(pos)
+		for positions, member in ((self.include_ends, self.include_end[pos]), (self.non_text, self.is_non_text(pos))):
+			i = bisect.bisect_left(positions, pos)
+			present = i < len(positions) and positions[i] == pos
+			if member and not present:
+				positions.insert(i, pos)
+			elif present and not member:
+				del positions[i]
+
+	def next_include_end(self, start, end):
+		# The first paragraph in [start, end) that can end an include.
+		i = bisect.bisect_left(self.include_ends, start)
+		if i < len(self.include_ends) and self.include_ends[i] < end:
+			return self.include_ends[i]
+
+	def first_non_text(self, start, end):
+		i = bisect.bisect_left(self.non_text, start)
+		if i < len(self.non_text) and self.non_text[i] < end:
+			return self.non_text[i]
+
+	def last_non_text(self, start, end):
+		i = bisect.bisect_left(self.non_text, end)
+		if i > 0 and self.non_text[i - 1] >= start:
+			return self.non_text[i - 1]
+
+def find_include_end(para):
+	# Same as para.search(is_include_end).
+	if para.quotes:
+		pos = para.quotes.next_include_end(para.pos, para.end)
+		return para.at(pos) if pos is not None else None
+	return para.search(is_include_end)
+
+def include(ctx, dom, para, next_parser):
 	# if para['index'] >= 29:
 	# 	import ipdb
 	# 	ipdb.set_trace()
 	if is_include(para):
-		last_include = para.search(is_include_end)
+		last_include = find_include_end(para)
 		if last_include is None:
-			make_error(dom, para)
+			make_error(ctx, dom, para)
 			return
 		else:
 			next_para = last_include.next()
 			if next_para:
-				next_index = next_para.raw_index
-				include_para = Para(para._paras[:next_index])
-				next_para = Para(para._paras[next_index:])
+				include_para = para.slice(para.start, next_para.pos)
+				next_para = para.slice(next_para.pos, para.end)
 			else:
 				include_para = para
 				next_para = None
@@ -324,6 +512,9 @@ def include(dom, para, next_parser):
 		next_para = para
 
 	if include_para:
+		# Before the quotes are stripped below.
+		trailing_char = trailing_quote_re.search(last_include['text']).group(1)
+
 		include_dom = make_node(dom, 'include')
 		for i_para in include_para.paras:
 			if not i_para['text']:
@@ -333,73 +524,85 @@ def include(dom, para, next_parser):
 			if text.startswith('"'):
 				i_para['text'] = text[1:]
 			elif not text == '@@TABLE@@':
-				make_error(include_dom, i_para, 'missing double quote')
+				make_error(ctx, include_dom, i_para, 'missing double quote')
 		include_para = include_para.paras[0]
 
-		trailing_char = trailing_quote_re.search(last_include['text']).group(1)
 		last_include = include_para.last().search(lambda para: para['text'], reverse=True)
 		last_include['text'] = trailing_quote_re.sub('', last_include['text'])
 
 		if include_para.get('toc'):
 			for i_para in include_para.paras:
-				make_text(include_dom, i_para, proof=False)
+				make_text(ctx, include_dom, i_para, proof=False)
 		if is_any_container(include_para):
-			container(include_dom, include_para)
+			yield container(include_dom, include_para)
 		elif is_section(include_para):
-			section(include_dom, include_para)
+			yield section(include_dom, include_para)
 		elif is_any_para(include_para):
-			para_parser(include_dom, include_para)
+			yield para_parser(include_dom, include_para)
 		else:
 			for i_para in include_para.paras:
-				make_text(include_dom, i_para)
+				make_text(ctx, include_dom, i_para)
 
 		if trailing_char:
-			make_text(dom, {'text': trailing_char}, proof=False, after=True)
+			make_text(ctx, dom, {'text': trailing_char}, proof=False, after=True)
 
 	if next_para:
-		next_parser(dom, next_para)
+		yield next_parser(dom, next_para)
+
+def leading_text_count(para):
+	# The index that para.leading(matcher=is_text) would find, or None to
+	# let it look.
+	if para.quotes:
+		pos = para.quotes.first_non_text(para.pos, para.end)
+		return (pos if pos is not None else para.end) - para.pos
 
-is_text = lambda para: not (is_any_para(para) or is_include(para) or is_include_end(para))
+def trailing_text_count(para):
+	# The index that para.trailing(matcher=is_text) would find, or None to
+	# let it look.
+	if para.quotes:
+		pos = para.quotes.last_non_text(para.pos, para.end)
+		return para.end - 1 - pos - 1 if pos is not None else para.end - para.pos
 
-def text(dom, para, next_parser):
-	text_para, next_para = para.leading(matcher=is_text)
+def text(ctx, dom, para, next_parser):
+	text_para, next_para = para.leading(leading_text_count(para), matcher=is_text)
 
 	if text_para:
 		for text_para in text_para.paras:
-			make_text(dom, text_para)
+			make_text(ctx, dom, text_para)
 		if next_para and 'designation' in text_para.last()['text']: 
 			next_para['toc'] = True # hint to include parser whether include is a toc entry
 
 	if not next_para:
 		return
 
-	next_para, aftertext_para = next_para.trailing(matcher=is_text)
+	next_para, aftertext_para = next_para.trailing(trailing_text_count(next_para), matcher=is_text)
 
 	if next_para:
-		next_parser(dom, next_para)
+		yield next_parser(dom, next_para)
 
 	if aftertext_para:
 		for text_para in aftertext_para.paras:
-			make_text(dom, text_para, after=True)
+			make_text(ctx, dom, text_para, after=True)
 
-def unhandled(dom, para, next_parser):
+def unhandled(ctx, dom, para, next_parser):
 	for para in para.paras:
-		make_error(dom, para, reason='too confused')
+		make_error(ctx, dom, para, reason='too confused')
 
-para_parser = pipeline(_para, text, include, 'para_parser')
+para_parser = Pipeline(_para, text, include)
+para_parser.stages.append(para_parser) # numbered paragraphs after an include
 
-section = pipeline(
+section = Pipeline(
 	_section,
 	text,
 	include,
 	para_parser,
 )
 
-container = pipeline(
+container = Pipeline(
 	_container,
 	section,
 )
-parser = pipeline(
+parser = Pipeline(
 	header,
 	toc,
 	short_title,
@@ -448,26 +651,29 @@ def make_para(parent, num, **kwargs):
 
 is_auto_numbered = Matcher({'properties': {'num': exists()}})
 
-def make_text(parent, para, after=None, proof=None, **kwargs):
+def make_text(ctx, parent, para, after=None, proof=None, **kwargs):
 	text = para['text']
 	if not text:
 		return None
 	if '\t' in text or '   ' in text:
-		return make_error(parent, para, 'whitespace')
+		return make_error(ctx, parent, para, 'whitespace')
 	if is_auto_numbered(para):
-		return make_error(parent, para, 'autonumbered')
+		return make_error(ctx, parent, para, 'autonumbered')
 	text = text.strip()
 	tag = 'aftertext' if after else 'text'
 	if proof is None:
 		proof = (text and not (text[0].isupper() or text[0] in '"\u201c')) 
 	return make_node(parent, tag, text, proof=proof or after)
 
-def make_error(dom, para, reason=None):
-	global errors
-	errors += 1
+def make_error(ctx, dom, para, reason=None):
+	ctx.errors += 1
+	ctx.reasons[reason or 'unspecified'] += 1
 	error_dom = make_node(dom, 'error', para['text'], reason=reason)
 
-def parse(path, save=False):
+def parse(path, save=None, ctx=None):
+	# Parse a bill. save is a file to save the paragraphs read from the docx
+	# to, for debugging. ctx is the ParseContext to use, if the caller wants
+	# to look at it afterwards.
 	dom = etree.Element("measure",
 		attrib={
 			"{http://www.w3.org/2001/XMLSchema-instance}schemaLocation": "http://code.dccouncil.us/schemas/statute http://dccode.council.local/schemas/statute.xsd",
@@ -479,17 +685,166 @@ def parse(path, save=False):
 	paras = parse_file(path)
 	# save copy of doc for debugging
 	if save:
-		with open('doc.json', 'w') as f:
+		with open(save, 'w') as f:
 			json.dump(paras, f, indent=2)
-	slice_index = Para(paras, paras[-1]).search(lambda para: para['text'].startswith('Chairman'), reverse=True)
+	slice_index = Para(paras, pos=len(paras) - 1).search(lambda para: para['text'].startswith('Chairman'), reverse=True)
 	if slice_index:
 		slice_index = slice_index.prev()['index']
 		paras = paras[0:slice_index]
 
-	parser(dom, Para(paras, paras[0]))
+	run(ctx or ParseContext(), parser(dom, Para(paras, quotes=QuoteIndex(paras))))
 
 	return dom
 
+PARSER_FILES = ('parse_bill.py', 'matchers.py', 'worddoc.py')
+STATE_FILENAME = '.parse_bill_state.json'
+
+def parser_version():
+	# A hash of the parser's source code, so that bills are parsed again
+	# when the parser changes.
+	h = hashlib.sha1()
+	here = os.path.dirname(os.path.abspath(__file__))
+	for fn in PARSER_FILES:
+		with open(os.path.join(here, fn), 'rb') as f:
+			h.update(f.read())
+	return h.hexdigest()
+
+def file_digest(path):
+	h = hashlib.sha1()
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(65536), b''):
+			h.update(chunk)
+	return h.hexdigest()
+
+def write_atomic(path, data):
+	with open(path + '.tmp', 'wb') as f:
+		f.write(data)
+	os.replace(path + '.tmp', path)
+
+def find_bills(inputs):
+	# Yields (path, path relative to the output directory) for each docx
+	# in the given files, directories, and glob patterns.
+	for pattern in inputs:
+		for path in sorted(glob.glob(pattern)) or [pattern]:
+			if os.path.isdir(path):
+				for root, dirs, files in os.walk(path):
+					dirs.sort()
+					for fn in sorted(files):
+						if fn.endswith('.docx') and not fn.startswith('~'):
+							yield os.path.join(root, fn), os.path.relpath(os.path.join(root, fn), path)
+			else:
+				yield path, os.path.basename(path)
+
+def convert_bill(src_path, out_path, doc_json):
+	# Worker entry point. Parses a bill and writes its XML, returning what
+	# goes in the report.
+	started = time.time()
+	ctx = ParseContext()
+	os.makedirs(os.path.dirname(out_path) or '.', exist_ok=True)
+	try:
+		dom = parse(src_path, out_path[:-4] + '.doc.json' if doc_json else None, ctx)
+		write_atomic(out_path, etree.tostring(dom, pretty_print=True, encoding="utf-8"))
+		status = 'parsed'
+		message = None
+	except Exception as e:
+		status = 'failed'
+		message = '{}: {}'.format(type(e).__name__, e)
+	return {
+		'status': status,
+		'message': message,
+		'errors': ctx.errors,
+		'reasons': dict(ctx.reasons),
+		'seconds': round(time.time() - started, 3),
+	}
+
+def convert_bills(inputs, out_dir, jobs=None, doc_json=False, rewrite_all=False):
+	# Returns a report entry for each bill, in the order they were found.
+	version = parser_version()
+	try:
+		with open(os.path.join(out_dir, STATE_FILENAME)) as f:
+			old_state = json.load(f)
+	except FileNotFoundError:
+		old_state = {}
+	state = {}
+	bills = {}
+
+	with ProcessPoolExecutor(jobs) as pool:
+		futures = {}
+		for src_path, rel_path in find_bills(inputs):
+			if rel_path in bills:
+				print('{}: skipping, it has the same output file as another bill'.format(src_path), file=sys.stderr)
+				continue
+			out_path = os.path.join(out_dir, rel_path[:-5] + '.xml')
+			digest = file_digest(src_path)
+			old = old_state.get(rel_path)
+			bills[rel_path] = {'path': src_path, 'output': out_path}
+			if not rewrite_all and old and old['hash'] == digest and old['parser'] == version and os.path.exists(out_path):
+				bills[rel_path].update(old['result'], status='unchanged', message=None, seconds=0)
+				state[rel_path] = old
+				continue
+			futures[pool.submit(convert_bill, src_path, out_path, doc_json)] = (rel_path, digest)
+
+		for done, future in enumerate(as_completed(futures), 1):
+			rel_path, digest = futures[future]
+			result = future.result()
+			bills[rel_path].update(result)
+			print('[{}/{}] {} {} ({} errors, {}s)'.format(done, len(futures), result['status'], rel_path, result['errors'], result['seconds']), file=sys.stderr)
+			if result['status'] == 'parsed':
+				state[rel_path] = {'hash': digest, 'parser': version, 'result': {'errors': result['errors'], 'reasons': result['reasons']}}
+
+	os.makedirs(out_dir, exist_ok=True)
+	write_atomic(os.path.join(out_dir, STATE_FILENAME), json.dumps(state, indent=2, sort_keys=True).encode('utf-8'))
+	return list(bills.values())
+
+def write_report(bills, fn, slowest=10):
+	totals = Counter()
+	for bill in bills:
+		totals.update(bill['reasons'])
+	statuses = Counter(bill['status'] for bill in bills)
+	slowest = sorted((bill for bill in bills if bill['status'] != 'unchanged'), key=lambda bill: -bill['seconds'])[:slowest]
+
+	if fn.endswith('.csv'):
+		reasons = sorted(totals)
+		with open(fn, 'w', newline='') as f:
+			w = csv.writer(f)
+			w.writerow(['path', 'output', 'status', 'seconds', 'errors'] + reasons + ['message'])
+			for bill in bills:
+				w.writerow([bill['path'], bill['output'], bill['status'], bill['seconds'], bill['errors']]
+					+ [bill['reasons'].get(reason, 0) for reason in reasons] + [bill['message'] or ''])
+	else:
+		with open(fn, 'w') as f:
+			json.dump({
+				'bills': bills,
+				'statuses': statuses,
+				'errors': totals,
+				'slowest': [bill['path'] for bill in slowest],
+			}, f, indent=2)
+
+	print(', '.join('{} {}'.format(n, status) for status, n in sorted(statuses.items())), file=sys.stderr)
+	for reason, n in totals.most_common():
+		print('{:6} {} errors'.format(n, reason), file=sys.stderr)
+	if slowest:
+		print('slowest:', file=sys.stderr)
+		for bill in slowest:
+			print('{:8.3f}s {}'.format(bill['seconds'], bill['path']), file=sys.stderr)
+
 if __name__ == '__main__':
-	dom = parse(sys.argv[1], True)
-	sys.stdout.buffer.write(etree.tostring(dom, pretty_print=True, encoding="utf-8"))
+	argparser = argparse.ArgumentParser(description='Convert bills from docx to XML.')
+	argparser.add_argument('-o', '--out-dir', help='convert all of the inputs into this directory (otherwise the one input is written to stdout)')
+	argparser.add_argument('-j', '--jobs', type=int, default=None, help='number of worker processes (default: one per CPU)')
+	argparser.add_argument('--report', help='write a report to this .json or .csv file')
+	argparser.add_argument('--doc-json', nargs='?', const='doc.json', metavar='FILE', help='also save the paragraphs read from the docx to FILE (default doc.json), for debugging; with -o, FILE is ignored and each is saved as .doc.json next to its output')
+	argparser.add_argument('--all', action='store_true', help='convert every bill, even if it hasn\'t changed')
+	argparser.add_argument('inputs', nargs='+', help='docx files, directories, or glob patterns')
+	args = argparser.parse_args()
+
+	if args.out_dir is None:
+		if len(args.inputs) != 1:
+			argparser.error('give -o to convert more than one bill')
+		dom = parse(args.inputs[0], args.doc_json)
+		sys.stdout.buffer.write(etree.tostring(dom, pretty_print=True, encoding="utf-8"))
+	else:
+		bills = convert_bills(args.inputs, args.out_dir, args.jobs, args.doc_json is not None, args.all)
+		write_report(bills, args.report or os.path.join(args.out_dir, 'report.json'))
+		if any(bill['status'] == 'failed' for bill in bills):
+			sys.exit(1)
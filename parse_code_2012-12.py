@@ -1,14 +1,36 @@
 # Convert the DC Code .docx file from West into XML.
 #
 # Usage:
-# python3 parse_code_doc.py path/to/dc_code_unofficial_2012-12-11/ > dc_code_unofficial_2012-12-11.xml
-
-import sys, io, glob, re, lxml.etree as etree, datetime, pprint
+# python3 parse_code_2012-12.py [-j N] path/to/dc_code_unofficial_2012-12-11/ > dc_code_unofficial_2012-12-11.xml
+#
+# Each title's .docx file is parsed on its own in a pool of N worker
+# processes (one per CPU by default) into a separate tree, and the trees
+# are merged into the document in title order. Where a title continues
+# a table of contents level from the title before it (the same Division,
+# say), the levels are folded together the same way they would have been
+# had the titles been parsed one after another.
+
+import sys, io, glob, re, lxml.etree as etree, datetime, pprint, argparse
+from concurrent.futures import ProcessPoolExecutor
 from worddoc import open_docx
+from matchers import RegexCascade
 
 ANNOTATION_HEADINGS = ("CREDIT(S)", "HISTORICAL AND STATUTORY NOTES", "UNIFORM COMMERCIAL CODE COMMENT", "ACKNOWLEDGMENT")
 
+# The children of a level that aren't its content.
+LEVEL_METADATA = ("type", "num", "heading", "prefix")
+
+class ContinuedSection(Exception):
+	# A section continues the section before it, but there is no section
+	# before it in this tree.
+	pass
+
 def main():
+	argparser = argparse.ArgumentParser(description="Convert the DC Code .docx files from West into XML.")
+	argparser.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes (default: one per CPU)")
+	argparser.add_argument("path", help="the directory containing a .docx file for each title")
+	args = argparser.parse_args()
+
 	# Form the output dom.
 	dom = etree.Element("level")
 	dom.set( "type", "document")
@@ -16,28 +38,91 @@ def main():
 	meta = make_node(dom, "meta", None)
 	make_node(meta, "current-through", "2012-12-11")
 	
-	# Where did we insert the previous section into the table of contents hierarchy?
-	# This is a list of pairs of hierarchy info and the dom node corresponding to
-	# that level.
-	toc_location_stack = [(None, dom)]
-	
-	# Parse each title of the code in order.
-	for fn in sorted(glob.glob(sys.argv[1] + "/*.docx")):
-		titlenum = re.search("/([^/]*)\.docx", fn).group(1)
-		print(fn, "...", file=sys.stderr)
-		parse_title(fn, dom, toc_location_stack)
+	# Parse each title of the code in parallel, and merge them in order.
+	fns = sorted(glob.glob(args.path + "/*.docx"))
+	with ProcessPoolExecutor(args.jobs) as pool:
+		for fn, (continued_sections, xml) in zip(fns, pool.map(parse_title_tree, fns)):
+			print(fn, "...", file=sys.stderr)
+			for section in continued_sections:
+				parse_section(section, dom, toc_location_stack(dom))
+			merge_level(dom, deserialize_tree(xml))
 
 	# Output, being careful we get UTF-8 to the byte stream.
 	sys.stdout.buffer.write(etree.tostring(dom, pretty_print=True, encoding="utf-8", xml_declaration=True))
 
-def parse_title(fn, dom, toc_location_stack):
-	# Load the .docx file.
+def parse_title_tree(fn):
+	# Worker entry point. Parses a title into a tree of its own, starting
+	# from an empty document. Returns any sections at the start of the title
+	# that continue the last section of the title before it, which can only
+	# be parsed once that title is in place, and the serialized tree.
 	doc = open_docx(fn, drawing=drawing_handler)
-	
-	# Parse each section.
+	dom = etree.Element("level")
+	toc_location_stack = [(None, dom)]
+	continued_sections = []
 	for section in doc["sections"]:
-		parse_section(section, dom, toc_location_stack)
-	
+		try:
+			parse_section(section, dom, toc_location_stack)
+		except ContinuedSection:
+			continued_sections.append(section)
+	return continued_sections, serialize_tree(dom)
+
+# Serializing loses the difference between empty text and no text at all,
+# which changes how the final document is pretty-printed, so elements with
+# an empty text or tail are marked with this attribute on the way through.
+EMPTY_TEXT_ATTR = "_empty"
+
+def serialize_tree(dom):
+	for node in dom.iter():
+		empty = [k for k, v in (("text", node.text), ("tail", node.tail)) if v == ""]
+		if empty: node.set(EMPTY_TEXT_ATTR, " ".join(empty))
+	return etree.tostring(dom, encoding="utf-8")
+
+def deserialize_tree(xml):
+	dom = etree.fromstring(xml)
+	for node in dom.iter():
+		for k in node.attrib.pop(EMPTY_TEXT_ATTR, "").split():
+			setattr(node, k, "")
+	return dom
+
+def toc_level_key(node):
+	# The hierarchy info that parse_section_intro_matter keeps for a
+	# table of contents level on the toc_location_stack.
+	return (node.findtext("prefix"), node.findtext("num"), node.findtext("heading"))
+
+def last_toc_level(node):
+	toc_levels = node.xpath("level[@type='toc']")
+	return toc_levels[-1] if toc_levels else None
+
+def toc_location_stack(dom):
+	# Where parsing the titles in order would have left the
+	# toc_location_stack: the chain of the last table of contents level
+	# at each depth, since each new level is appended to its parent.
+	stack = [(None, dom)]
+	node = last_toc_level(dom)
+	while node is not None:
+		stack.append((toc_level_key(node), node))
+		node = last_toc_level(node)
+	return stack
+
+def merge_level(node, new_node):
+	# Move the content of new_node, a level parsed starting from an empty
+	# document, into node. parse_section_intro_matter would have put the
+	# first table of contents level under new_node into the last one under
+	# node if they are the same level, rather than making a new one, so
+	# those two are merged too.
+	content = [child for child in new_node if child.tag not in LEVEL_METADATA]
+	if content and content[0].tag == "level" and content[0].get("type") is None \
+		and node.xpath("*[not(name() = 'type' or name() = 'num' or name() = 'heading' or name() = 'prefix')]"):
+		raise ValueError("Adding body content to a level that already has body content or subparts.")
+
+	last = last_toc_level(node)
+	first = new_node.xpath("level[@type='toc']")
+	for child in content:
+		if last is not None and child is first[0] and toc_level_key(child) == toc_level_key(last):
+			merge_level(last, child)
+		else:
+			node.append(child)
+
 def parse_section(section, dom, toc_location_stack):
 	# Parse the intro matter of the section, including the table of contents
 	# spine pointers, and create a node in the right place in the dom.
@@ -58,9 +143,34 @@ def parse_section(section, dom, toc_location_stack):
 	# Parse the annotations at the end of the section.
 	parse_section_annotations(sec_node, remaining_paras)
 
+# The lines that can occur in the intro matter of a section, tried in
+# this order. Each pattern must match the whole line.
+INTRO_LINE_PATTERNS = [
+	("formerly-cited-as", "Formerly cited as (.*)"),
+	("currentness", "District of Columbia Official Code 2001 Edition Currentness"),
+	("toc-level", "(?:@@DRAWING@@)?\s*(Division|Subdivision|Title|Subtitle|Chapter|Subchapter|Part|Subpart|Unit|Article) ([A-Za-z0-9\-]+)\s?\. (.*\S)\s*"),
+	("appendix", "(?:@@DRAWING@@)?\s*Appendix"),
+	# A placeholder for an expired/repealed section or range of sections.
+	# These have to come before the normal section number/title line.
+	("placeholder", "(?:@@DRAWING@@)?\s*§§? (?P<section_start>\S+)(?:(?P<section_range_type> to|,) (?P<section_end>\S+))?\. (?:(?P<title>.*) )?\[(?P<reason>Expired|Repealed|Omitted|Reserved|Renumbered)\]"),
+	("placeholder", "(?:@@DRAWING@@)?\s*§§? (?P<section_start>\S+)(?:(?P<section_range_type> to|,) (?P<section_end>\S+))?\. (?P<reason>Expired|Repealed|Omitted|Reserved|Renumbered)"),
+	("section", "(?:@@DRAWING@@)?\s*§ (\d+A?(?::[\d\.A-Za-z]+)?-[\d\.A-Za-z]+). (.*)"),
+	("not-a-section", "DC CODE D\. .*, (Refs & Annos|Reserved)[\w\W]*"),
+	("metadata", "\(((Effective|Approved) .*)\)"),
+	# e.g. <This subchapter has expired effective October 30, 1999.>
+	("metadata", "<(This .*)>"),
+]
+INTRO_LINES = RegexCascade(*INTRO_LINE_PATTERNS)
+
+# In Part 5 there can also be a subpart that doesn't say what type of level it is.
+PART_5_INTRO_LINES = RegexCascade(*(INTRO_LINE_PATTERNS[:4]
+	+ [("part-5-subpart", "(?:@@DRAWING@@)?\s*([A-C])\. (.*\S)\s*")]
+	+ INTRO_LINE_PATTERNS[4:]))
+
+# Paragraph numbering, like "(3)" or "(A)".
+PARAGRAPH_NUMBER = re.compile("\([0-9A-Za-z\-\.]+\)\s*")
+
 def parse_section_intro_matter(section, dom, toc_location_stack):
-	global M # utility for doing regular expressions
-	
 	# Filter out empty paragraphs.
 
 	paras = [p for p in section["paragraphs"] if para_text_content(p) != ""]
@@ -71,6 +181,7 @@ def parse_section_intro_matter(section, dom, toc_location_stack):
 	# In this case, return the last node we created.
 
 	if len(section["paragraphs"][0]["runs"]) == 1 and section["paragraphs"][0]["runs"][0]["properties"].get("font") == "Courier New":
+		if len(toc_location_stack) == 1: raise ContinuedSection()
 		return (toc_location_stack[-1][1].xpath("*")[-1], paras)
 
 	# Parse the intro matter of the section.
@@ -83,33 +194,30 @@ def parse_section_intro_matter(section, dom, toc_location_stack):
 	
 	for i, paragraph in enumerate(paras):
 		ptext = para_text_content(paragraph)
+		line = (INTRO_LINES if toc_location[-1] != ('Part', '5', 'Default.') else PART_5_INTRO_LINES).match(ptext)
+		kind = line.kind if line else None
 
-		if re_match("Formerly cited as (.*)", ptext):
-			former_cited_as.append(M.group(1))
-		elif re_match("District of Columbia Official Code 2001 Edition Currentness", ptext):
+		if kind == "formerly-cited-as":
+			former_cited_as.append(line.group(1))
+		elif kind == "currentness":
 			continue # skip this
-		elif re_match("(?:@@DRAWING@@)?\s*(Division|Subdivision|Title|Subtitle|Chapter|Subchapter|Part|Subpart|Unit|Article) ([A-Za-z0-9\-]+)\s?\. (.*\S)\s*", ptext):
-			toc_location.append(M.groups())
-		elif re_match("(?:@@DRAWING@@)?\s*Appendix", ptext):
+		elif kind == "toc-level":
+			toc_location.append(line.groups)
+		elif kind == "appendix":
 			# Title 28 has a part just called "Appendix".
 			toc_location.append(("Appendix", None, None))
-		elif toc_location[-1] == ('Part', '5', 'Default.') and re_match("(?:@@DRAWING@@)?\s*([A-C])\. (.*\S)\s*", ptext):
+		elif kind == "part-5-subpart":
 			# e.g. 28:2A-502 is in Part 5 and then a subpart numbered A that doesn't say what type of level it is.
-			toc_location.append( ("level", M.group(1), M.group(2)) )
+			toc_location.append( ("level", line.group(1), line.group(2)) )
 
-		elif re_match("(?:@@DRAWING@@)?\s*§§? (?P<section_start>\S+)(?:(?P<section_range_type> to|,) (?P<section_end>\S+))?\. (?:(?P<title>.*) )?\[(?P<reason>Expired|Repealed|Omitted|Reserved|Renumbered)\]", ptext):
+		elif kind == "placeholder":
 			# A placeholder for an expired/repealed section or range of sections.
-			# This has to come before the normal section number/title line regex.
-			placeholder_info = M.groupdict()
-			break
-		elif re_match("(?:@@DRAWING@@)?\s*§§? (?P<section_start>\S+)(?:(?P<section_range_type> to|,) (?P<section_end>\S+))?\. (?P<reason>Expired|Repealed|Omitted|Reserved|Renumbered)", ptext):
-			# Aanother form of placeholder
-			placeholder_info = M.groupdict()
+			placeholder_info = line.groupdict
 			break
-		elif re_match("(?:@@DRAWING@@)?\s*§ (\d+A?(?::[\d\.A-Za-z]+)?-[\d\.A-Za-z]+). (.*)", ptext):
+		elif kind == "section":
 			# This is the section number and name, and signifies the end of the intro
 			# matter of the section.
-			section_number, section_title = M.groups()
+			section_number, section_title = line.groups
 			break
 
 		elif ptext == "This document has been updated. Use KEYCITE.":
@@ -117,31 +225,15 @@ def parse_section_intro_matter(section, dom, toc_location_stack):
 			# It's centered, so it must come before align=center test.
 			continue
 
-		elif paragraph["properties"].get("align") == "center":
+		elif paragraph["properties"].get("align") == "center" \
+			or (len(paragraph["runs"]) == 1 and paragraph["runs"][0]["properties"].get("font") == "Courier New") \
+			or ptext in ANNOTATION_HEADINGS \
+			or ptext in ("REPEAL OF UNIFORM ARBITRATION ACT", "TABLE OF DISPOSITION OF SECTIONS IN FORMER ARTICLE 9 AND OTHER CODE SECTIONS", "REVISION OF ARTICLE 9 OF THE UCC") \
+			or kind == "not-a-section":
 			# Occurs in document sections that don't appear to be proper sections of the code.
 			i -= 1 # include this line in the body
 			break
-		elif len(paragraph["runs"]) == 1 and paragraph["runs"][0]["properties"].get("font") == "Courier New":
-			# Occurs in document sections that don't appear to be proper sections of the code.
-			i -= 1 # include this line in the body
-			break
-		elif re.match("DC CODE D\. .*, (Refs & Annos|Reserved)", ptext):
-			# Occurs in document sections that don't appear to be proper sections of the code.
-			i -= 1 # include this line in the body
-			break
-		elif ptext in ANNOTATION_HEADINGS\
-			or ptext in ("REPEAL OF UNIFORM ARBITRATION ACT", "TABLE OF DISPOSITION OF SECTIONS IN FORMER ARTICLE 9 AND OTHER CODE SECTIONS", "REVISION OF ARTICLE 9 OF THE UCC"):
-			# Occurs in document sections that don't appear to be proper sections of the code.
-			i -= 1 # include this line in the body
-			break		
-
-		elif re_match("\(((Effective|Approved) .*)\)", ptext):
-			# This is metadata, but also the first line of some parts that don't have sections
-			# inside them but have content. So we'll end the metadata here.
-			i -= 1 # include this line in the body
-			break
-		elif re_match("<(This .*)>", ptext):
-			# e.g. <This subchapter has expired effective October 30, 1999.>
+		elif kind == "metadata":
 			# This is metadata, but also the first line of some parts that don't have sections
 			# inside them but have content. So we'll end the metadata here.
 			i -= 1 # include this line in the body
@@ -214,8 +306,6 @@ def parse_section_intro_matter(section, dom, toc_location_stack):
 	return (sec_node, paras[paragraphs_consumed+1:])
 			
 def parse_section_body(sec_node, paras):
-	global M
-
 	if len(paras) == 0:
 		return []
 	
@@ -240,8 +330,10 @@ def parse_section_body(sec_node, paras):
 		# move that into a separate node. Handle numbering like "(3)(A)".
 		# TODO: Does this grab too much??
 		is_first_number = True
-		while len(paragraph["runs"]) > 0 and re_match("\([0-9A-Za-z\-\.]+\)\s*", paragraph["runs"][0]["text"], dollar_sign=False):
-			num = M.group(0)
+		while len(paragraph["runs"]) > 0:
+			m = PARAGRAPH_NUMBER.match(paragraph["runs"][0]["text"])
+			if not m: break
+			num = m.group(0)
 			if is_first_number:
 				p = make_node(indentation_stack[-1], "level", None)
 				indentation_stack.append(p)
@@ -269,8 +361,6 @@ def parse_section_body(sec_node, paras):
 	return paras[i+1:]
 
 def parse_section_annotations(sec_node, paras):
-	global M
-	
 	# Parse the section annotations at the end.
 	
 	if len(paras) == 0: return
@@ -338,15 +428,6 @@ def runs_to_node(node, runs):
 def para_text_content(p):
 	return "".join(r["text"] for r in p["runs"]).strip()
 	
-M = None
-def re_match(pattern, string, dollar_sign=True):
-	# This is a helper utility that returns the match value
-	# but also stores it in a global variable so we can still
-	# get it.
-	global M
-	M = re.match(pattern + ("$" if dollar_sign else ""), string)
-	return M
-
 def make_node(parent, tag, text, **attrs):
   """Make a node in an XML document."""
   n = etree.Element(tag)
@@ -364,5 +445,6 @@ def make_node(parent, tag, text, **attrs):
 def drawing_handler(node):
 	return "@@DRAWING@@"
 
-main()
+if __name__ == "__main__":
+	main()
 
@@ -5,6 +5,7 @@
 
 import sys, re, lxml.etree as etree, os.path, json
 from worddoc import open_docx
+from matchers import RegexCascade
 
 heading_case_fix = { }
 little_words = set()
@@ -75,6 +76,36 @@ def hashfile(filepath):
         f.close()
     return sha1.hexdigest()
 
+# Lines that need correcting, matched against whole paragraphs.
+BARE_LEVEL_LINE = re.compile(r"(SUBTITLE|PART|SUBPART|CHAPTER|SUBCHAPTER|UNIT) +[A-Za-z0-9\-]+$", re.I)
+REPEATED_LINE = re.compile(r"SUBCHAPTER II-A|BLOOMINGDALE AND LEDROIT PARK BACKWATER VALVES$", re.I)
+RUN_ON_SECTION_LINE = re.compile(r"(§ 1-15-\d+\.) \n\n([(\[].*)$", re.I)
+APPENDICES_LINE = re.compile(r"§ [\d\-\.]+\s*-\s*(Appendices to §.*)$", re.I)
+ODDBALL_SECTION_LINE = re.compile(r"§ (?:III|F).(?:\s*(.*))?$", re.I)
+PREAMBLE_LINE = re.compile(r"§ [IV]+\.", re.I)
+
+# Paragraph numbering at the start of a run, like "(3)" or "1. ". Form
+# paragraphs can have leading space before the numbering.
+PARAGRAPH_NUMBER = re.compile(r"\([0-9A-Za-z\-\.]+\)\s*|[0-9a-z\-]+\.\s+")
+FORM_PARAGRAPH_NUMBER = re.compile(r"\s*\([0-9A-Za-z\-\.]+\)\s*|[0-9a-z\-]+\.\s+")
+
+# The number and title line of a section, tried in this order. The
+# placeholders for expired/repealed sections or ranges of sections have
+# to come before the normal section number/title line.
+PLACEHOLDER_TYPES = r"\s*\[(?P<type>Reserved|Expired|Omitted|Transferred|Repealed|Not funded)\]\.?"
+SECTION_LINES = RegexCascade(
+	("placeholder-range", r"§§? (?P<section_start>\S+)(?:(?P<section_range_type> to|,) (?P<section_end>\S*[^\.]))\.? (?P<title>.+?)(?:" + PLACEHOLDER_TYPES + ")?"),
+	("placeholder", r"§§? (?P<section_start>\S*[^\.])\.? (?P<title>.*\S|)" + PLACEHOLDER_TYPES),
+	("section", r"§ (\d+A?(?::[\d\.A-Za-z]+)?-[\d\.\-A-Za-z]*[\d\-A-Za-z]).(?:\s*(.*))?"),
+	flags=re.I)
+
+# The header line of a table of contents level, giving its type, number, and title.
+LEVEL_LINES = RegexCascade(
+	("reserved", r"(Division|Subdivision|Title|Subtitle|Chapter|Subchapter|Part|Subpart|Unit|Article)s ([A-Za-z0-9\-]+) (\[Reserved\])"),
+	("chapter-11", r"(Chapter) (11)()"),
+	("level", r"(Division|Subdivision|Title|Subtitle|Chapter|Subchapter|Part|Subpart|Unit|Article) +([A-Za-z0-9\-]+)\n([\w\W]*)"),
+	flags=re.I)
+
 def parse_doc_section(section, dom, state):
 	# Parses the Word document, one "section" at a time. By section I mean the things
 	# between 'section breaks' in Word. Not code sections.
@@ -116,37 +147,38 @@ def parse_doc_section(section, dom, state):
 
 		# Correct mistakes in the document.
 		context_path = "/".join([n[0] + ":" + n[1].xpath("string(num)") for n in state["stack"][1:]])
-		if psty == "sectextc" and re_match("(SUBTITLE|PART|SUBPART|CHAPTER|SUBCHAPTER|UNIT) +[A-Za-z0-9\-]+$", ptext):
+		if psty == "sectextc" and BARE_LEVEL_LINE.match(ptext):
 			# "PART D-i", "PART A", "PART F-i", "PART B-i", "PART XII", "SUBCHAPTER VII-E", various SUBPARTs,
 			# etc., which seems like some bad preprocessing on Lexis's side. The next paragraph is usually empty,
 			# and then the actual heading text appears. For "CHAPTER 31A1", the heading text appeared on the
 			# next paragraph in the 2013-10 file but not in the 2014-02 file.
-			psty = M.group(1).title() # "Part", "Subpart", etc.
+			psty = BARE_LEVEL_LINE.match(ptext).group(1).title() # "Part", "Subpart", etc.
 			for i in (1, 2):
 				if para_text_content(section["paragraphs"][para_index+i]).strip() != "":
 					ptext += "\n" + para_text_content(section["paragraphs"][para_index+i])
 					section["paragraphs"][para_index+i]["runs"] = [] # prevent processing later
 					break
 
-		elif psty == "sectextc" and re_match("SUBCHAPTER II-A|BLOOMINGDALE AND LEDROIT PARK BACKWATER VALVES", ptext):
+		elif psty == "sectextc" and REPEATED_LINE.match(ptext):
 			continue # repeated/weird text
 		elif psty == "sectextc" and context_path == "Division:V/Title:32/Chapter:13/Subchapter:I" and ptext == "GENERAL":
 			continue # repeated/weird text
 
-		elif psty == "Section" and re_match(r"(§ 1-15-\d+\.) \n\n([(\[].*)", ptext):
+		elif psty == "Section" and RUN_ON_SECTION_LINE.match(ptext):
 			# 1-15-1. \n\n(21 DCR 3198; 22 DCR 961....
-			ptext = M.group(1)
+			m = RUN_ON_SECTION_LINE.match(ptext)
+			ptext = m.group(1)
 
 			# move the rest into the next paragraph
 			section["paragraphs"][para_index+1]["properties"]["style"] = "sectext" # make sure it shows up
-			section["paragraphs"][para_index+1]["runs"].insert(0, {"text": M.group(2) + "\n", "properties": {}})
+			section["paragraphs"][para_index+1]["runs"].insert(0, {"text": m.group(2) + "\n", "properties": {}})
 
-		elif psty == "sectext" and re_match("§ [\d\-\.]+\s*-\s*(Appendices to §.*)", ptext):
+		elif psty == "sectext" and APPENDICES_LINE.match(ptext):
 			# move out of annotations and into an appendices level
 			if sec is not None: do_paragraph_indentation(sec)
 			sec = make_node(sec, "level", None)
 			sec.set("type", "appendices")
-			make_node(sec, "heading", M.group(1))
+			make_node(sec, "heading", APPENDICES_LINE.match(ptext).group(1))
 			annos = None
 
 		elif ptext == '(1) A notification of disposition must provide the following information:':
@@ -160,10 +192,10 @@ def parse_doc_section(section, dom, state):
 		elif sec is None and ptext.strip() == "Repealed.":
 			psty = "annotations"
 
-		elif psty == "sectext" and re_match("§ (?:III|F).(?:\s*(.*))?", ptext):
+		elif psty == "sectext" and ODDBALL_SECTION_LINE.match(ptext):
 			# This looks like a Lexis screw-up.
 			psty = "Section"
-			ptext = "§ 999-%d. %s" % (oddball_numbering, M.group(1))
+			ptext = "§ 999-%d. %s" % (oddball_numbering, ODDBALL_SECTION_LINE.match(ptext).group(1))
 			oddball_numbering += 1
 
 
@@ -175,7 +207,7 @@ def parse_doc_section(section, dom, state):
 			if sec is not None:
 				pass
 			elif (context_path.startswith("Division:III/Title:21/Chapter:24/") or context_path == "Division:V/Title:32/Chapter:13/Subchapter:I") \
-			 and re_match('§ [IV]+\.', ptext, dollar_sign=False):
+			 and PREAMBLE_LINE.match(ptext):
 				# This is body text in something like a preamble to the subchapter. It
 				# does not count as an actual section, I guess, since it is not citable
 				# by title and number. Treat the next lines as if we're inside a section,
@@ -196,12 +228,14 @@ def parse_doc_section(section, dom, state):
 			is_para_level = False
 			parent_node = sec
 			was_form = False
-			while len(para["runs"]) > 0 and re_match(("" if psty != "form" else r"\s*") + "\([0-9A-Za-z\-\.]+\)\s*|[0-9a-z\-]+\.\s+", para["runs"][0]["text"], dollar_sign=False, case_sensitive=True):
+			while len(para["runs"]) > 0:
+				m = (PARAGRAPH_NUMBER if psty != "form" else FORM_PARAGRAPH_NUMBER).match(para["runs"][0]["text"])
+				if not m: break
 				if psty == "form" and len(para["runs"]) > 0 and "Do you know of any will or codicil of" in para["runs"][0]:
 					# This is not a level.
 					break
 
-				num = M.group(0)
+				num = m.group(0)
 				if num.strip() == "(Signed)": break # not numbering
 				parent_node = make_node(sec, "level", None) # I think we are doing this flat (each iteration atts to sec and not recursively inside parent_node) because we infer indentation from numbering later
 				make_node(parent_node, "num", num.strip())
@@ -324,38 +358,37 @@ def parse_doc_section(section, dom, state):
 
 
 		elif psty == "Section":
-			placeholder_types = "\s*\[(?P<type>Reserved|Expired|Omitted|Transferred|Repealed|Not funded)\]\.?"
-
-			if re_match("§§? (?P<section_start>\S+)(?:(?P<section_range_type> to|,) (?P<section_end>\S*[^\.]))\.? (?P<title>.+?)(?:" + placeholder_types + ")?", ptext):
+			line = SECTION_LINES.match(ptext)
+			if line and line.kind == "placeholder-range":
 				# A placeholder for an expired/repealed section or range of sections.
 				# This has to come before the normal section number/title line regex.
 				if sec is not None: do_paragraph_indentation(sec)
 				sec = make_node(state["stack"][-1][1], "level", None)
 				sec.set("type", "placeholder")
-				if M.groupdict()["type"]: make_node(sec, "reason", M.groupdict()["type"])
-				make_node(sec, "section-start" if M.groupdict()["section_end"] else "section", M.groupdict()["section_start"])
-				if M.groupdict()["section_end"]:
-					make_node(sec, "section-end", M.groupdict()["section_end"])
-					make_node(sec, "section-range-type", "list" if M.groupdict()["section_range_type"] == "," else "range")
-				if M.groupdict().get("title"): make_node(sec, "heading", M.groupdict()["title"])
+				if line.groupdict["type"]: make_node(sec, "reason", line.groupdict["type"])
+				make_node(sec, "section-start" if line.groupdict["section_end"] else "section", line.groupdict["section_start"])
+				if line.groupdict["section_end"]:
+					make_node(sec, "section-end", line.groupdict["section_end"])
+					make_node(sec, "section-range-type", "list" if line.groupdict["section_range_type"] == "," else "range")
+				if line.groupdict.get("title"): make_node(sec, "heading", line.groupdict["title"])
 				annos = None
 				cur_form_node = None
 				continue
-			elif re_match("§§? (?P<section_start>\S*[^\.])\.? (?P<title>.*\S|)" + placeholder_types, ptext):
+			elif line and line.kind == "placeholder":
 				# A placeholder for an expired/repealed section or range of sections.
 				# This has to come before the normal section number/title line regex.
 				if sec is not None: do_paragraph_indentation(sec)
 				sec = make_node(state["stack"][-1][1], "level", None)
 				sec.set("type", "placeholder")
-				make_node(sec, "reason", M.groupdict()["type"])
-				make_node(sec, "section", M.groupdict()["section_start"])
-				if M.groupdict().get("title"): make_node(sec, "heading", M.groupdict()["title"])
+				make_node(sec, "reason", line.groupdict["type"])
+				make_node(sec, "section", line.groupdict["section_start"])
+				if line.groupdict.get("title"): make_node(sec, "heading", line.groupdict["title"])
 				annos = None
 				cur_form_node = None
 				continue
 
-			elif re_match("§ (\d+A?(?::[\d\.A-Za-z]+)?-[\d\.\-A-Za-z]*[\d\-A-Za-z]).(?:\s*(.*))?", ptext):
-				section_number, section_title = M.groups()
+			elif line and line.kind == "section":
+				section_number, section_title = line.groups
 
 			else:
 				print(context_path, file=sys.stderr)
@@ -381,14 +414,11 @@ def parse_doc_section(section, dom, state):
 			pass # ?
 
 		else:
-			if re_match("(Division|Subdivision|Title|Subtitle|Chapter|Subchapter|Part|Subpart|Unit|Article)s ([A-Za-z0-9\-]+) (\[Reserved\])", ptext):
-				pass
-			elif re_match("(Chapter) (11)()", ptext):
-				pass
-			elif not re_match("(Division|Subdivision|Title|Subtitle|Chapter|Subchapter|Part|Subpart|Unit|Article) +([A-Za-z0-9\-]+)\n([\w\W]*)", ptext):
+			line = LEVEL_LINES.match(ptext)
+			if not line:
 				raise ValueError("Invalid %s level header: %s" % (psty, ptext))
 
-			level_type, level_number, level_title = M.groups()
+			level_type, level_number, level_title = line.groups
 			level_title = re.sub("\s+", " ", level_title) # newlines
 			level_title = re.sub("[\s\.]+$", "", level_title) # trailing spaces and periods
 
@@ -435,7 +465,7 @@ def do_paragraph_indentation(node):
 	# that do not have numbering, return None.
 	def get_num(n):
 		n = n.xpath("string(num)")
-		m = re.match("\((.*)\)$", n) # don't use re_match because it gets in the way of the calling function
+		m = re.match("\((.*)\)$", n)
 		if m:
 			return m.group(1)
 		m = re.match("(.*)\.$", n)
@@ -530,15 +560,6 @@ def runs_to_node(node, runs):
 def para_text_content(p):
 	return "".join(r["text"] for r in p["runs"]).strip()
 	
-M = None
-def re_match(pattern, string, dollar_sign=True, case_sensitive=False):
-	# This is a helper utility that returns the match value
-	# but also stores it in a global variable so we can still
-	# get it.
-	global M
-	M = re.match(pattern + ("$" if dollar_sign else ""), string, re.I if not case_sensitive else 0)
-	return M
-
 def make_node(parent, tag, text, **attrs):
   """Make a node in an XML document."""
   n = etree.Element(tag)
@@ -3,6 +3,7 @@ import lxml.etree as etree
 from parsers import Parser, _make_node, _para_text_content
 from worddoc import open_docx
 import matchers
+import memprofile
 import copy
 
 div_re = re.compile(r'(?P<div>\w+)\.docx$')
@@ -17,11 +18,13 @@ def parse_file(dom, path_to_file, start_para_index):
 	if os.path.exists(tmp_doc):
 		doc = json.load(open(tmp_doc))
 		print('loading from', tmp_doc, file=sys.stderr)
+		memprofile.checkpoint('cache load {}'.format(os.path.basename(path_to_file)))
 	else:
 		print('saving to', tmp_doc, file=sys.stderr)
 
 	if doc is None:
 		doc = open_docx(path_to_file, pict=pict_handler)
+		memprofile.checkpoint('open_docx {}'.format(os.path.basename(path_to_file)))
 		div_re.search('./2015-06/Division VIII.docx').group('div')
 		for section in doc['sections']:
 			for para_index, para in enumerate(section["paragraphs"], start_para_index):
@@ -29,6 +32,7 @@ def parse_file(dom, path_to_file, start_para_index):
 			start_para_index += len(section['paragraphs'])
 		with open(tmp_doc, "w") as doccache:
 			json.dump( doc, doccache, indent=2)
+		memprofile.checkpoint('cache save {}'.format(os.path.basename(path_to_file)))
 	try:
 		# Parse each section.
 		for section in doc["sections"]:
@@ -36,6 +40,7 @@ def parse_file(dom, path_to_file, start_para_index):
 	except:
 		import traceback
 		traceback.print_exc()
+	memprofile.checkpoint('parse {}'.format(os.path.basename(path_to_file)))
 	return start_para_index
 
 def main():
@@ -74,7 +79,9 @@ def main():
 
 	# print(time.time() - start_time)
 	# Output, being careful we get UTF-8 to the byte stream.
-	sys.stdout.buffer.write(etree.tostring(dom, pretty_print=True, encoding="utf-8", xml_declaration=True))
+	out = etree.tostring(dom, pretty_print=True, encoding="utf-8", xml_declaration=True)
+	memprofile.checkpoint('tostring')
+	sys.stdout.buffer.write(out)
 
 def pict_handler(node):
 	return "@@PICT@@"
@@ -1,19 +1,33 @@
 # Convert a DC Council Statute at Large file, for a single statute
 # entry, into XML.
 #
-# python3 make_sal_xml.py A20-003.docx > output/A20-003.xml
-# python3 make_sal_xml.py R20-055.docx > output/R20-055.xml
+# python3 parse_statute.py A20-003.docx > output/A20-003.xml
+# python3 parse_statute.py R20-055.docx > output/R20-055.xml
+#
+# Or, to convert a whole volume directory at once:
+#
+# python3 parse_statute.py [-j N] -o output/ volume/
+#
+# which converts each .docx file in volume/ (and its subdirectories) to
+# an .xml file at the same relative path in output/. The files are
+# converted in a pool of N worker processes (one per CPU by default), each
+# of which converts many files, so the interpreter and lxml are only
+# started up once per worker rather than once per file.
 #
 # Chome won't normally render an XSLT instruction when loading from a
 # file:// URL. To turn off that security restriction, make sure Chrome
 # isn't running at all (check if you need to kill it), and then start
 # it with this command-line option:
 #
-# google-chrome --allow-file-access-from-files 
+# google-chrome --allow-file-access-from-files
 
-import sys, re, lxml.etree as etree, datetime
+import sys, os, os.path, re, lxml.etree as etree, datetime, argparse, time
+from concurrent.futures import ProcessPoolExecutor
 from worddoc import open_docx
 
+# How many files to send to a worker at once.
+BATCH_SIZE = 20
+
 def make_node(parent, tag, text, **attrs):
   """Make a node in an XML document."""
   n = etree.Element(tag)
@@ -28,209 +42,274 @@ def make_node(parent, tag, text, **attrs):
     n.set(k.replace("___", ""), v)
   return n
 
-# Form the output dom.
-dom = etree.Element("measure")
-
-# Load the .docx file.
-doc = open_docx(sys.argv[1])
-
-# Parse the header.
-
-header_text = []
-for sec in doc["header"]:
-	for p in sec["paragraphs"]:
-		header_text.append(" ".join(run["text"] for run in p["runs"]))
-header_text = "\n".join(header_text)
-
-stat_volume, stat_page, law_type, council_period, law_num, eff_date, exp_date = \
-	re.match(r"COUNCIL OF THE DISTRICT OF COLUMBIA\s+(\d+) DCSTAT (\d+)\n"
-			 r"(D.C. (?:Law|Act|Resolution)) (\d+)-(\d+), "
-			 r"effective ([^(]*[^\s(])"
-			 r"(?: \(Expiration date ([^(]*)\))?", header_text).groups()
-
-make_node(dom, "statutes-volume", stat_volume)
-make_node(dom, "statutes-page", stat_page)
-make_node(dom, "council-period", council_period)
-make_node(dom, "law-type", law_type)
-make_node(dom, "law-number", law_num)
-make_node(dom, "effective-date", eff_date) # TODO: Parse date.
-if exp_date: make_node(dom, "expiration-date", exp_date) # TODO: Parse date.
-notes_node = None
-body_node = None
-quotation_node = None
-last_margin_note = None
-indentation_stack = None
-
-# Parse the body.
-
-state = "start"
-def do_paragraph(p):
-	global dom
-	global state
-	global notes_node
-	global body_node
-	global quotation_node
-	global last_margin_note
-	global indentation_stack
-
-	p_text = " ".join(run["text"] for run in p["runs"])
-		
-	if state == "start" and p["properties"].get("style") == "MarginNotes":
-		for run in p["runs"]:
-			m = re.match("Bill (\d+)-(\d+)$", run["text"])
-			if m:
-				make_node(dom, "bill-number", m.group(2))
-				continue
-
-			m = re.match("Act (\d+)-(\d+)$", run["text"])
-			if m:
-				make_node(dom, "act-number", m.group(2))
-				continue
-
-			m = re.match("Proposed Resolution (\d+)-(\d+)$", run["text"])
-			if m:
-				make_node(dom, "proposed-resolution-number", m.group(2))
-				continue
-
-			m = re.match(r"Emergency Declaration Res\. (\d+-\d+)\s*$", run["text"])
-			if m:
-				make_node(dom, "emergency-declaration", None, resolution=m.group(1))
-				state = "em-dec-res-stat"
-				continue
-
-			if run["text"] == "effective":
-				state = "effective-date"
-				break
-				
-			#print("Unhandled margin note:", run)
-			state = "title"
-			if notes_node is None:
-				notes_node = make_node(dom, "notes", "")
+# The citation information in the page header of each statute.
+HEADER_FIELDS = ("statutes-volume", "statutes-page", "law-type", "council-period", "law-number", "effective-date", "expiration-date")
+
+def parse_header(header):
+	# Returns the citation information in a statute's page header, which
+	# is the "header" part of what open_docx returns.
+	header_text = []
+	for sec in header:
+		for p in sec["paragraphs"]:
+			header_text.append(" ".join(run["text"] for run in p["runs"]))
+	header_text = "\n".join(header_text)
+
+	m = re.match(r"COUNCIL OF THE DISTRICT OF COLUMBIA\s+(\d+) DCSTAT (\d+)\n"
+				 r"(D.C. (?:Law|Act|Resolution)) (\d+)-(\d+), "
+				 r"effective ([^(]*[^\s(])"
+				 r"(?: \(Expiration date ([^(]*)\))?", header_text)
+	if not m:
+		raise ValueError("Page header is not a Statutes at Large citation: " + repr(header_text[:200]))
+	return dict(zip(HEADER_FIELDS, m.groups()))
+
+class StatuteConverter:
+	# Converts one statute. The state machine's state lives on the
+	# converter, so make a new one for each document.
+
+	def __init__(self):
+		# Form the output dom.
+		self.dom = etree.Element("measure")
+		self.notes_node = None
+		self.body_node = None
+		self.quotation_node = None
+		self.last_margin_note = None
+		self.indentation_stack = None
+		self.state = "start"
+
+	def convert(self, doc):
+		self.do_header(doc["header"])
+		for sec in doc["sections"]:
+			for p in sec["paragraphs"]:
+				self.do_paragraph(p)
+		return self.dom
+
+	def do_header(self, header):
+		dom = self.dom
+		h = parse_header(header)
+		make_node(dom, "statutes-volume", h["statutes-volume"])
+		make_node(dom, "statutes-page", h["statutes-page"])
+		make_node(dom, "council-period", h["council-period"])
+		make_node(dom, "law-type", h["law-type"])
+		make_node(dom, "law-number", h["law-number"])
+		make_node(dom, "effective-date", h["effective-date"]) # TODO: Parse date.
+		if h["expiration-date"]: make_node(dom, "expiration-date", h["expiration-date"]) # TODO: Parse date.
+
+	def do_paragraph(self, p):
+		dom = self.dom
+
+		p_text = " ".join(run["text"] for run in p["runs"])
+
+		if self.state == "start" and p["properties"].get("style") == "MarginNotes":
+			for run in p["runs"]:
+				m = re.match("Bill (\d+)-(\d+)$", run["text"])
+				if m:
+					make_node(dom, "bill-number", m.group(2))
+					continue
+
+				m = re.match("Act (\d+)-(\d+)$", run["text"])
+				if m:
+					make_node(dom, "act-number", m.group(2))
+					continue
+
+				m = re.match("Proposed Resolution (\d+)-(\d+)$", run["text"])
+				if m:
+					make_node(dom, "proposed-resolution-number", m.group(2))
+					continue
+
+				m = re.match(r"Emergency Declaration Res\. (\d+-\d+)\s*$", run["text"])
+				if m:
+					make_node(dom, "emergency-declaration", None, resolution=m.group(1))
+					self.state = "em-dec-res-stat"
+					continue
+
+				if run["text"] == "effective":
+					self.state = "effective-date"
+					break
+
+				#print("Unhandled margin note:", run)
+				self.state = "title"
+				if self.notes_node is None:
+					self.notes_node = make_node(dom, "notes", "")
+				else:
+					self.notes_node.text += " "
+				self.notes_node.text += " ".join(run["text"] for run in p["runs"])
+
+		elif self.state == "effective-date" and p["properties"].get("style") == "MarginNotes":
+			# TODO: Parse date.
+			make_node(dom, "act-effective", " ".join(run["text"] for run in p["runs"]))
+			self.state = "title"
+
+		elif self.state == "em-dec-res-stat" and p["properties"].get("style") == "MarginNotes":
+			dom.xpath("emergency-declaration")[0].set("statute", " ".join(run["text"] for run in p["runs"]))
+			self.state = "title"
+
+		elif self.state == "title" and p["properties"].get("style") == "MarginNotes":
+			if self.notes_node is None:
+				self.notes_node = make_node(dom, "notes", "")
 			else:
-				notes_node.text += " "
-			notes_node.text += " ".join(run["text"] for run in p["runs"])
-			
-	elif state == "effective-date" and p["properties"].get("style") == "MarginNotes":
-		# TODO: Parse date.
-		make_node(dom, "act-effective", " ".join(run["text"] for run in p["runs"]))
-		state = "title"
-
-	elif state == "em-dec-res-stat" and p["properties"].get("style") == "MarginNotes":
-		dom.xpath("emergency-declaration")[0].set("statute", " ".join(run["text"] for run in p["runs"]))
-		state = "title"
-
-	elif state == "title" and p["properties"].get("style") == "MarginNotes":
-		if notes_node is None:
-			notes_node = make_node(dom, "notes", "")
-		else:
-			notes_node.text += " "
-		notes_node.text += " ".join(run["text"] for run in p["runs"])
-
-	elif state == "title" and p["properties"].get("style") == "Longtitle":
-		make_node(dom, "long-title", " ".join(run["text"] for run in p["runs"]).strip())
-		state = "body"
-		
-	elif state == "title" and p_text.strip() != "":
-		make_node(dom, "act-header", p_text)
-		
-	elif state == "body":
-		if body_node is None:
-			body_node = make_node(dom, "body", None)
-			indentation_stack = [(None, body_node)]
-
-		if p["properties"].get("frame"):
-			if not last_margin_note or last_margin_note[0] != p["properties"]["frame"]:
-				if p_text.strip() == "": return
-				last_margin_note = (p["properties"]["frame"], etree.Element("margin-notes"))
-			make_node(last_margin_note[1], "line", p_text)
-				
-		elif p_text.strip() != "":
-			# Is this inside a quotation?
-			if p_text.strip().startswith("“"):
-				if not quotation_node:
-					# Create a <quotation> node, and save/reset the indentation_stack.
-					quotation_node = (make_node(indentation_stack[-1][1], "quotation", None), indentation_stack)
-					indentation_stack = [(None, quotation_node[0])]
-			elif quotation_node:
-				# End whatever quoted region we were in.
-				indentation_stack = quotation_node[1]
-				quotation_node = None
-			
-			# Current indentation level.
-			indent = p["properties"].get("indentation", 0)
-			if p["properties"].get("align") == "center": indent = 0
-			
-			# If we're at less indentation that we last saw, pop off all entries
-			# at a greater or equal indentation level.
-			while len(indentation_stack) > 1 and indentation_stack[-1][0] >= indent:
-				indentation_stack.pop(-1)
-			
-			# What node are we going to insert into?
-			container = indentation_stack[-1][1]
-
-			# If we saw a margin note, put it right before the following paragraph.
-			if last_margin_note:
-				container.append(last_margin_note[1])
-				last_margin_note = None
-				
-			# Make a node and put it on the indentation stack.
-			para = make_node(container, "para", None)
-			indentation_stack.append( (indent, para) )
-		
-			# Separate list numbering.
-			m = re.match("\s*(\([^)]+\))+\s*", p["runs"][0]["text"])
-			if m:
-				make_node(para, "num", m.group(0).strip())
-				p["runs"][0]["text"] = p["runs"][0]["text"][len(m.group(0)):]
-			
-			# Being smart about "(c)(1)" type numbering is impossible because
-			# we don't know if the subsequent indent corresponds to the (1) level
-			# or is indentation within that. We need to compare numbering styles.
-			#number_node = None
-			#while True:
-			#	m = re.match("\([^)]+\)\s*", p["runs"][0]["text"])
-			#	if not m: break
-			#	if number_node is None:
-			#		number_node = make_node(para, "num", m.group(0).strip())
-			#	else:
-			#		para = make_node(para, "para", None)
-			#		indentation_stack.append( (indent, para) )
-			#		number_node = make_node(para, "num", m.group(0).strip())
-			#	p["runs"][0]["text"] = p["runs"][0]["text"][len(m.group(0)):]
-
-			# Add text inside here.
-			t = make_node(para, "t", "")
-			last_run = None
-			for i, run in enumerate(p["runs"]):
-				# Strip off quotation marks at the start of quoted text because it
-				# is a display thing, not a semantic thing, once we embed the text
-				# within a <quotation> node.
-				#if quotation_node and i == 0 and run["text"].startswith("“"):
-				#	run["text"] = run["text"][1:]
-				#	# TODO: What to do with the close quote and (non-quoted) text
-				#	# like a period that follows the close quote?
-				
-				# If this run has no formatting commands, insert the text plainly.
-				if len(run["properties"]) == 0:
-					# Use 'text' of the parent or 'tail' of the last child in this paragraph?
-					if last_run == None:
-						t.text += run["text"]
+				self.notes_node.text += " "
+			self.notes_node.text += " ".join(run["text"] for run in p["runs"])
+
+		elif self.state == "title" and p["properties"].get("style") == "Longtitle":
+			make_node(dom, "long-title", " ".join(run["text"] for run in p["runs"]).strip())
+			self.state = "body"
+
+		elif self.state == "title" and p_text.strip() != "":
+			make_node(dom, "act-header", p_text)
+
+		elif self.state == "body":
+			if self.body_node is None:
+				self.body_node = make_node(dom, "body", None)
+				self.indentation_stack = [(None, self.body_node)]
+
+			if p["properties"].get("frame"):
+				if not self.last_margin_note or self.last_margin_note[0] != p["properties"]["frame"]:
+					if p_text.strip() == "": return
+					self.last_margin_note = (p["properties"]["frame"], etree.Element("margin-notes"))
+				make_node(self.last_margin_note[1], "line", p_text)
+
+			elif p_text.strip() != "":
+				# Is this inside a quotation?
+				if p_text.strip().startswith("“"):
+					if not self.quotation_node:
+						# Create a <quotation> node, and save/reset the indentation_stack.
+						self.quotation_node = (make_node(self.indentation_stack[-1][1], "quotation", None), self.indentation_stack)
+						self.indentation_stack = [(None, self.quotation_node[0])]
+				elif self.quotation_node:
+					# End whatever quoted region we were in.
+					self.indentation_stack = self.quotation_node[1]
+					self.quotation_node = None
+
+				# Current indentation level.
+				indent = p["properties"].get("indentation", 0)
+				if p["properties"].get("align") == "center": indent = 0
+
+				# If we're at less indentation that we last saw, pop off all entries
+				# at a greater or equal indentation level.
+				indentation_stack = self.indentation_stack
+				while len(indentation_stack) > 1 and indentation_stack[-1][0] >= indent:
+					indentation_stack.pop(-1)
+
+				# What node are we going to insert into?
+				container = indentation_stack[-1][1]
+
+				# If we saw a margin note, put it right before the following paragraph.
+				if self.last_margin_note:
+					container.append(self.last_margin_note[1])
+					self.last_margin_note = None
+
+				# Make a node and put it on the indentation stack.
+				para = make_node(container, "para", None)
+				indentation_stack.append( (indent, para) )
+
+				# Separate list numbering.
+				m = re.match("\s*(\([^)]+\))+\s*", p["runs"][0]["text"])
+				if m:
+					make_node(para, "num", m.group(0).strip())
+					p["runs"][0]["text"] = p["runs"][0]["text"][len(m.group(0)):]
+
+				# Being smart about "(c)(1)" type numbering is impossible because
+				# we don't know if the subsequent indent corresponds to the (1) level
+				# or is indentation within that. We need to compare numbering styles.
+				#number_node = None
+				#while True:
+				#	m = re.match("\([^)]+\)\s*", p["runs"][0]["text"])
+				#	if not m: break
+				#	if number_node is None:
+				#		number_node = make_node(para, "num", m.group(0).strip())
+				#	else:
+				#		para = make_node(para, "para", None)
+				#		indentation_stack.append( (indent, para) )
+				#		number_node = make_node(para, "num", m.group(0).strip())
+				#	p["runs"][0]["text"] = p["runs"][0]["text"][len(m.group(0)):]
+
+				# Add text inside here.
+				t = make_node(para, "t", "")
+				last_run = None
+				for i, run in enumerate(p["runs"]):
+					# Strip off quotation marks at the start of quoted text because it
+					# is a display thing, not a semantic thing, once we embed the text
+					# within a <quotation> node.
+					#if self.quotation_node and i == 0 and run["text"].startswith("“"):
+					#	run["text"] = run["text"][1:]
+					#	# TODO: What to do with the close quote and (non-quoted) text
+					#	# like a period that follows the close quote?
+
+					# If this run has no formatting commands, insert the text plainly.
+					if len(run["properties"]) == 0:
+						# Use 'text' of the parent or 'tail' of the last child in this paragraph?
+						if last_run == None:
+							t.text += run["text"]
+						else:
+							last_run.tail = (last_run.tail if last_run.tail else "") + run["text"]
+
+					# This run has formatting, so use a <span>.
 					else:
-						last_run.tail = (last_run.tail if last_run.tail else "") + run["text"]
-						
-				# This run has formatting, so use a <span>.
-				else:
-					last_run = make_node(t, "span", run["text"], **run["properties"])
-			
-	elif len(p["runs"]) > 0:
-		print("Unhandled paragraph", p)
+						last_run = make_node(t, "span", run["text"], **run["properties"])
+
+		elif len(p["runs"]) > 0:
+			print("Unhandled paragraph", p, file=sys.stderr)
+
+def convert(path):
+	# Load the .docx file and return the XML for it.
+	dom = StatuteConverter().convert(open_docx(path))
+	return b'<?xml-stylesheet href="statute_to_html.xsl" type="text/xsl"?>\n' \
+		+ etree.tostring(dom, pretty_print=True, encoding="utf-8") # cheating by not using etree for the stylesheet instruction
+
+def find_statutes(in_dir):
+	# Yields the path of each .docx file in the directory, relative to it.
+	for root, dirs, files in os.walk(in_dir):
+		dirs.sort()
+		for fn in sorted(files):
+			if fn.endswith(".docx") and not fn.startswith("~"):
+				yield os.path.relpath(os.path.join(root, fn), in_dir)
+
+def convert_files(batch):
+	# Worker entry point. Converts each (docx path, xml path) and returns
+	# an error message or None for each.
+	ret = []
+	for src_path, out_path in batch:
+		try:
+			xml = convert(src_path)
+		except Exception as e:
+			ret.append("{}: {}".format(type(e).__name__, e))
+			continue
+		os.makedirs(os.path.dirname(out_path), exist_ok=True)
+		with open(out_path, "wb") as f:
+			f.write(xml)
+		ret.append(None)
+	return ret
 
-# Output the document.
+def convert_volume(in_dir, out_dir, jobs=None):
+	# Returns the number of files converted and the number that failed.
+	files = [
+		(os.path.join(in_dir, fn), os.path.join(out_dir, fn[:-5] + ".xml"))
+		for fn in find_statutes(in_dir)
+	]
+	batches = [files[i:i + BATCH_SIZE] for i in range(0, len(files), BATCH_SIZE)]
+	failed = 0
+	with ProcessPoolExecutor(jobs) as pool:
+		for batch, errors in zip(batches, pool.map(convert_files, batches)):
+			for (src_path, out_path), error in zip(batch, errors):
+				if error:
+					print("{}: {}".format(src_path, error), file=sys.stderr)
+					failed += 1
+	return len(files), failed
 
-for sec in doc["sections"]:
-	for p in sec["paragraphs"]:
-		do_paragraph(p)
+if __name__ == "__main__":
+	argparser = argparse.ArgumentParser(description="Convert Statutes at Large files into XML.")
+	argparser.add_argument("-o", "--out-dir", help="convert every .docx file in the input directory into this directory")
+	argparser.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes (default: one per CPU)")
+	argparser.add_argument("input", help="a .docx file, or with -o a volume directory")
+	args = argparser.parse_args()
 
-print('<?xml-stylesheet href="statute_to_html.xsl" type="text/xsl"?>') # cheating by not using etree
-#print(etree.tostring(dom, pretty_print=True, encoding=str))
-sys.stdout.buffer.write(etree.tostring(dom, pretty_print=True, encoding="utf-8"))
+	if args.out_dir is None:
+		sys.stdout.buffer.write(convert(args.input))
+	else:
+		started = time.time()
+		count, failed = convert_volume(args.input, args.out_dir, args.jobs)
+		elapsed = time.time() - started
+		print("{} files converted, {} failed, in {:.1f}s ({:.1f} files/s)".format(
+			count - failed, failed, elapsed, count / elapsed if elapsed else 0), file=sys.stderr)
+		if failed:
+			sys.exit(1)
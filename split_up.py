@@ -3,8 +3,26 @@
 #
 # Usage:
 # python3 split_up.py dest_dir < code.xml
+#
+# Files whose content hasn't changed since the last run are not rewritten.
+# A manifest of the hash, size and mtime of each file written is kept so
+# that files which are no longer produced can be deleted. A file whose
+# size or mtime isn't what the manifest says (it was edited, reverted or
+# deleted since) is compared byte for byte instead. When dest_dir is a git
+# checkout the manifest is kept in dest_dir/.git/split_up_manifest.json,
+# where it can't be committed, and otherwise in
+# dest_dir/.split_up_manifest.json. A summary of the files that changed is
+# printed to stdout, one per line, like `git status --short`:
+#
+# A Title-1/index.xml
+# M sections/1-101.xml
+# D sections/1-102.xml
 
-import sys, os, os.path, lxml.etree, re
+import sys, os, os.path, lxml.etree, re, json, hashlib
+import memprofile
+
+MANIFEST_FILENAME = ".split_up_manifest.json"
+GIT_MANIFEST_FILENAME = "split_up_manifest.json"
 
 def make_node(parent, tag, text, **attrs):
   """Make a node in an XML document."""
@@ -82,21 +100,105 @@ def write_node(node, path, filename, backpath, toc, seen_filenames):
 	if fn in seen_filenames: raise Exception("Sanity check failed. Two parts of the code mapped to the same file name: {}.".format(fn))
 	seen_filenames.add(fn)
 
-	with open(fn, "wb") as f:
-		f.write(lxml.etree.tostring(node, pretty_print=True, encoding="utf-8", xml_declaration=False))
+	write_file(fn, lxml.etree.tostring(node, pretty_print=True, encoding="utf-8", xml_declaration=False))
 
 def clean_filename(fn):
 	return re.sub("[^0-9A-Za-z\-\.\~]+", "_", fn)
 
+def write_file(fn, data):
+	# Only write the file if its content differs from what is already on disk,
+	# so that unchanged files keep their mtimes. Trust the manifest's hash when
+	# the file's size and mtime are the ones it recorded, otherwise compare
+	# against the file itself.
+	rel_fn = os.path.relpath(fn, sys.argv[1])
+	digest = hashlib.sha1(data).hexdigest()
+
+	try:
+		st = os.stat(fn)
+	except FileNotFoundError:
+		changes.append(("A", rel_fn))
+	else:
+		entry = old_manifest.get(rel_fn)
+		if isinstance(entry, dict) and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime_ns:
+			unchanged = entry["hash"] == digest
+		else:
+			with open(fn, "rb") as f:
+				unchanged = f.read() == data
+		if unchanged:
+			new_manifest[rel_fn] = { "hash": digest, "size": st.st_size, "mtime": st.st_mtime_ns }
+			return
+		changes.append(("M", rel_fn))
+
+	with open(fn, "wb") as f:
+		f.write(data)
+	st = os.stat(fn)
+	new_manifest[rel_fn] = { "hash": digest, "size": st.st_size, "mtime": st.st_mtime_ns }
+
+def remove_stale_files():
+	# Delete files we wrote last time that we didn't produce this time,
+	# and any directories that are left empty.
+	for rel_fn in sorted(set(old_manifest) - set(new_manifest)):
+		fn = os.path.join(sys.argv[1], rel_fn)
+		if not os.path.exists(fn): continue
+		os.remove(fn)
+		changes.append(("D", rel_fn))
+		d = os.path.dirname(fn)
+		while os.path.normpath(d) != os.path.normpath(sys.argv[1]) and not os.listdir(d):
+			os.rmdir(d)
+			d = os.path.dirname(d)
+
+def manifest_path():
+	# Keep the manifest out of the files that get committed.
+	git_dir = os.path.join(sys.argv[1], ".git")
+	if os.path.isdir(git_dir):
+		return os.path.join(git_dir, GIT_MANIFEST_FILENAME)
+	return os.path.join(sys.argv[1], MANIFEST_FILENAME)
+
+def load_manifest():
+	# Fall back to a manifest left in dest_dir itself by an older version.
+	for fn in (manifest_path(), os.path.join(sys.argv[1], MANIFEST_FILENAME)):
+		try:
+			with open(fn) as f:
+				return json.load(f)
+		except FileNotFoundError:
+			pass
+	return { }
+
+def save_manifest():
+	with open(manifest_path(), "w") as f:
+		json.dump(new_manifest, f, indent=2, sort_keys=True)
+	old_fn = os.path.join(sys.argv[1], MANIFEST_FILENAME)
+	if manifest_path() != old_fn and os.path.exists(old_fn):
+		os.remove(old_fn)
+
+# Load the hashes, sizes and mtimes of the files written on the last run.
+old_manifest = load_manifest()
+new_manifest = { }
+changes = []
+
 # Read in the master code file.
 dom = lxml.etree.parse(sys.stdin.buffer, lxml.etree.XMLParser(remove_blank_text=True))
+memprofile.checkpoint("parse code")
 
 # Create an empty TOC DOM.
 toc = lxml.etree.Element("toc")
 
 # Write out the split-up XML files.
 write_node(dom.getroot(), '/', "index.xml", "", toc, set())
+memprofile.checkpoint("write files")
 
 # Write out the TOC file.
-with open(sys.argv[1] + 'toc.xml', "wb") as f:
-	f.write(lxml.etree.tostring(toc, pretty_print=True, encoding="utf-8", xml_declaration=False))
+write_file(os.path.join(sys.argv[1], 'toc.xml'), lxml.etree.tostring(toc, pretty_print=True, encoding="utf-8", xml_declaration=False))
+
+# Clean up files from the previous run that no longer exist and save the new manifest.
+remove_stale_files()
+save_manifest()
+
+# Report what changed so later build stages can skip unchanged files.
+for status, rel_fn in changes:
+	print(status, rel_fn)
+print("{} added, {} changed, {} removed, {} unchanged".format(
+	sum(1 for c in changes if c[0] == "A"),
+	sum(1 for c in changes if c[0] == "M"),
+	sum(1 for c in changes if c[0] == "D"),
+	len(new_manifest) - sum(1 for c in changes if c[0] != "D")), file=sys.stderr)
@@ -0,0 +1,176 @@
+# Keeps an index of the Statutes at Large citations of converted statutes
+# (or of the source .docx files) in an SQLite database, so that we can
+# find which file is 62 DCSTAT 1234 or D.C. Law 20-155 without grepping
+# through thousands of files.
+#
+# Usage:
+# python3 statute_index.py [--db statutes.sqlite] update output/ more/A20-003.docx ...
+# python3 statute_index.py [--db statutes.sqlite] query "62 DCSTAT 1234" "62 DCSTAT 1200-1300" "D.C. Law 20-155" L20-155
+#
+# update adds the .xml and .docx files in the given files and directories
+# to the index. Only the citation information at the top of each file is
+# read: the first few elements of an .xml file written by parse_statute.py,
+# or just the page header of a .docx file. Files whose size and
+# modification time haven't changed since they were last indexed are
+# skipped (unless --all is given), and files that are gone from a
+# directory that is updated are dropped from the index.
+#
+# A page query finds the statute that the page falls in, i.e. the one that
+# starts on the page or the nearest page before it. A page range query
+# finds every statute with a page in the range. A law number can be given
+# as "D.C. Law 20-155", "Act 20-155", "L20-155", "A20-155", "R20-155", or
+# just "20-155" to match any law type.
+
+import sys, os, os.path, re, sqlite3, zipfile, argparse
+import lxml.etree
+from worddoc import process_paragraphs
+from parse_statute import parse_header, HEADER_FIELDS
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS statutes (
+	path TEXT PRIMARY KEY,
+	mtime REAL,
+	size INTEGER,
+	volume INTEGER,
+	page INTEGER,
+	law_type TEXT,
+	council_period INTEGER,
+	law_number INTEGER,
+	effective TEXT,
+	expiration TEXT,
+	error TEXT
+);
+CREATE INDEX IF NOT EXISTS statutes_page ON statutes (volume, page);
+CREATE INDEX IF NOT EXISTS statutes_law ON statutes (council_period, law_number);
+"""
+
+COLUMNS = "volume, page, law_type, council_period, law_number, effective, expiration, path"
+
+LAW_TYPES = { "L": "D.C. Law", "A": "D.C. Act", "R": "D.C. Resolution" }
+
+def open_index(fn):
+	db = sqlite3.connect(fn)
+	db.executescript(SCHEMA)
+	return db
+
+def read_docx_header(path):
+	# Just the page header, without reading the document body.
+	with zipfile.ZipFile(path) as z:
+		header = lxml.etree.parse(z.open("word/header1.xml")).getroot()
+	return parse_header(process_paragraphs(header, {}))
+
+def read_xml_header(path):
+	# The citation elements come first in the file, so stop reading at
+	# the first element that isn't one of them.
+	ret = dict.fromkeys(HEADER_FIELDS)
+	for event, node in lxml.etree.iterparse(path, events=("end",)):
+		if node.getparent() is None: break
+		if node.tag not in HEADER_FIELDS: break
+		ret[node.tag] = node.text
+	if ret["statutes-volume"] is None:
+		raise ValueError("No statutes-volume element.")
+	return ret
+
+def find_files(path):
+	if not os.path.isdir(path):
+		yield path
+		return
+	for root, dirs, files in os.walk(path):
+		dirs.sort()
+		for fn in sorted(files):
+			if fn.endswith((".xml", ".docx")) and not fn.startswith("~"):
+				yield os.path.join(root, fn)
+
+def update(db, inputs, rewrite_all=False):
+	# Returns the number of files indexed, unchanged, and removed.
+	indexed = unchanged = removed = 0
+	known = { path: (mtime, size) for path, mtime, size in db.execute("SELECT path, mtime, size FROM statutes") }
+	with db:
+		for input_path in inputs:
+			input_path = os.path.abspath(input_path)
+			seen = set()
+			for path in find_files(input_path):
+				seen.add(path)
+				st = os.stat(path)
+				if not rewrite_all and known.get(path) == (st.st_mtime, st.st_size):
+					unchanged += 1
+					continue
+
+				try:
+					h = (read_docx_header if path.endswith(".docx") else read_xml_header)(path)
+					error = None
+				except Exception as e:
+					h = dict.fromkeys(HEADER_FIELDS)
+					error = "{}: {}".format(type(e).__name__, e)
+					print("{}: {}".format(path, error), file=sys.stderr)
+				db.execute("INSERT OR REPLACE INTO statutes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (
+					path, st.st_mtime, st.st_size,
+					int(h["statutes-volume"]) if h["statutes-volume"] else None,
+					int(h["statutes-page"]) if h["statutes-page"] else None,
+					h["law-type"],
+					int(h["council-period"]) if h["council-period"] else None,
+					int(h["law-number"]) if h["law-number"] else None,
+					h["effective-date"], h["expiration-date"], error))
+				indexed += 1
+
+			# Drop files that are gone from this directory.
+			if os.path.isdir(input_path):
+				prefix = os.path.join(input_path, "")
+				for path in known:
+					if path.startswith(prefix) and path not in seen:
+						db.execute("DELETE FROM statutes WHERE path = ?", (path,))
+						removed += 1
+	return indexed, unchanged, removed
+
+def query(db, q):
+	# Returns the rows matching a citation.
+	m = re.match(r"^\s*(\d+)\s*(?:DCSTAT|D\.C\. ?Stat\.?|:)\s*(\d+)(?:\s*-\s*(\d+))?\s*$", q, re.I)
+	if m:
+		volume, first, last = int(m.group(1)), int(m.group(2)), int(m.group(3) or m.group(2))
+		# The statute the first page falls in, and any that start later in the range.
+		start = db.execute("SELECT MAX(page) FROM statutes WHERE volume = ? AND page <= ?", (volume, first)).fetchone()[0]
+		return db.execute("SELECT " + COLUMNS + " FROM statutes WHERE volume = ? AND page BETWEEN ? AND ? ORDER BY page, path",
+			(volume, start if start is not None else first, last)).fetchall()
+
+	m = re.match(r"^\s*(?:(?:D\.C\.\s*)?(Law|Act|Resolution)\s*|([LAR]))?(\d+)-(\d+)\s*$", q, re.I)
+	if m:
+		sql = "SELECT " + COLUMNS + " FROM statutes WHERE council_period = ? AND law_number = ?"
+		args = [int(m.group(3)), int(m.group(4))]
+		if m.group(1) or m.group(2):
+			sql += " AND law_type = ?"
+			args.append(LAW_TYPES[(m.group(1) or m.group(2))[0].upper()])
+		return db.execute(sql + " ORDER BY path", args).fetchall()
+
+	raise ValueError("Not a Statutes at Large page or law number citation: " + q)
+
+if __name__ == "__main__":
+	argparser = argparse.ArgumentParser(description="Index and look up Statutes at Large citations.")
+	argparser.add_argument("--db", default="statutes.sqlite", help="the index file (default: statutes.sqlite)")
+	commands = argparser.add_subparsers(dest="command")
+	update_parser = commands.add_parser("update", help="add files and directories to the index")
+	update_parser.add_argument("--all", action="store_true", help="read every file, even if it hasn't changed")
+	update_parser.add_argument("paths", nargs="+")
+	query_parser = commands.add_parser("query", help="look up citations")
+	query_parser.add_argument("citations", nargs="+")
+	args = argparser.parse_args()
+
+	db = open_index(args.db)
+	if args.command == "update":
+		indexed, unchanged, removed = update(db, args.paths, args.all)
+		print("{} files indexed, {} unchanged, {} removed".format(indexed, unchanged, removed), file=sys.stderr)
+	elif args.command == "query":
+		found = True
+		for q in args.citations:
+			try:
+				rows = query(db, q)
+			except ValueError as e:
+				argparser.error(str(e))
+			if not rows:
+				print("{}: not found".format(q), file=sys.stderr)
+				found = False
+			for volume, page, law_type, council_period, law_number, effective, expiration, path in rows:
+				print("{} DCSTAT {}\t{} {}-{}\t{}\t{}".format(volume, page, law_type, council_period, law_number, effective, path))
+		if not found:
+			sys.exit(1)
+	else:
+		argparser.print_help()
@@ -0,0 +1,138 @@
+# Regression test for substantive_diff in commit-title-diffs.py. It
+# checks that it gives exactly what the difflib.ndiff version it
+# replaced gave, on synthetic section pairs with non-substantive
+# (spaces, periods, capitalization) and substantive changes.
+#
+# Usage:
+# python3 -m unittest test_commit_title_diffs
+
+import os.path, difflib, importlib.util, random, re, unittest
+
+def load_commit_title_diffs():
+	# commit-title-diffs.py isn't an importable module name.
+	path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "commit-title-diffs.py")
+	spec = importlib.util.spec_from_file_location("commit_title_diffs", path)
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	return module
+
+ctd = load_commit_title_diffs()
+
+# The original substantive_diff, as it was before it was sped up.
+leading_whitespace = re.compile('^\s*')
+ignore_chars = re.compile(r'[ \s—.-]+', re.UNICODE)
+
+def ndiff_substantive_diff(a, b):
+	a = a.splitlines()
+	b = b.splitlines()
+
+	rem = []
+	for l in difflib.ndiff(a, b):
+		if l[0] == ' ':
+			rem = []
+		elif l[0] == '-':
+			rem.append(l[2:])
+		elif l[0] == '+':
+			normalized = leading_whitespace.match(l[2:]).group() + ignore_chars.sub('', l[2:]).lower()
+			i = None
+			for r in rem:
+				a_normalized = leading_whitespace.match(r).group() + ignore_chars.sub('', r).lower()
+				if normalized == a_normalized or (a_normalized.strip().startswith('<heading>temporary') and normalized.strip().startswith('<heading>temporary')):
+					i = b.index(l[2:])
+					b.remove(l[2:])
+					b.insert(i, r)
+					break
+			if i is not None: # if a rem was patched to the ins
+				rem.remove(r)
+			else:
+				rem = []
+		elif  l[0] == '?':
+			continue
+		else:
+			print(l[0])
+
+	return '\n'.join(b) + '\n'
+
+WORDS = "the mayor council district shall may issue rules tax fee permit license board".split()
+
+def make_section(rand, paras):
+	lines = ['<section>', '  <num>1-101</num>', '  <heading>Definitions.</heading>']
+	for i in range(paras):
+		indent = '  ' * rand.randint(1, 3)
+		lines.append(indent + '<para>')
+		lines.append(indent + '  <num>({})</num>'.format(i))
+		lines.append(indent + '  <text>The ' + ' '.join(rand.choice(WORDS) for _ in range(rand.randint(3, 12))) + '.</text>')
+		if rand.random() < 0.1:
+			lines.append(indent + '  <heading>Temporary ' + rand.choice(WORDS) + '.</heading>')
+		lines.append(indent + '</para>')
+	lines.append('</section>')
+	return lines
+
+def non_substantive_change(rand, line):
+	k = rand.random()
+	if k < 0.4:
+		return line.replace('.', '', 1) if '.' in line else line + '.'
+	elif k < 0.7:
+		return line.replace('The', 'the')
+	return ' ' + line
+
+def substantive_change(rand, line):
+	if '<heading>Temporary' in line:
+		return line.replace('Temporary', 'Temporary ' + rand.choice(WORDS))
+	return line.replace('</', ' ' + rand.choice(WORDS) + '</', 1)
+
+def edit_section(rand, lines, moves):
+	out = []
+	for line in lines:
+		k = rand.random()
+		if k < 0.15:
+			line = non_substantive_change(rand, line)
+		elif k < 0.2:
+			line = substantive_change(rand, line)
+		elif moves and k < 0.23:
+			continue # deleted
+		elif moves and k < 0.26:
+			out.append(line) # inserted
+		out.append(line)
+	return out
+
+def section_pairs(count, seed, moves, paras=(1, 15)):
+	rand = random.Random(seed)
+	for _ in range(count):
+		a = make_section(rand, rand.randint(*paras))
+		b = edit_section(rand, a, moves)
+		yield '\n'.join(a) + '\n', '\n'.join(b) + '\n'
+
+class SubstantiveDiffTest(unittest.TestCase):
+	def test_examples(self):
+		a = '<section>\n  <text>The Mayor shall issue rules.</text>\n  <heading>Temporary rules.</heading>\n</section>\n'
+		b = '<section>\n  <text>the Mayor shall issue rules</text>\n  <heading>Temporary fees.</heading>\n</section>\n'
+		self.assertEqual(ctd.substantive_diff(a, b), a)
+		b = '<section>\n  <text>The Mayor may issue rules</text>\n</section>\n'
+		self.assertEqual(ctd.substantive_diff(a, b), b)
+
+	def test_patched_line_goes_to_the_first_copy_of_its_text(self):
+		# ndiff's version put a patched line where b.index() found the
+		# first line with the inserted line's text, even if that was an
+		# earlier copy of it.
+		a = '<para>\n  <text>Fees</text>\n</para>\n<para>\n  <text>Fines.</text>\n  <text>Fees.</text>\n</para>\n'
+		b = '<para>\n  <text>Fees</text>\n</para>\n<para>\n  <text>Fines, and more.</text>\n  <text>Fees</text>\n</para>\n'
+		self.assertEqual(ctd.substantive_diff(a, b), ndiff_substantive_diff(a, b))
+
+	def assertSameAsNdiff(self, pairs):
+		for a, b in pairs:
+			self.assertEqual(ctd.substantive_diff(a, b), ndiff_substantive_diff(a, b), (a, b))
+
+	def test_lines_changed_in_place(self):
+		self.assertSameAsNdiff(section_pairs(1000, 1, moves=False))
+
+	def test_lines_inserted_and_deleted(self):
+		self.assertSameAsNdiff(section_pairs(1000, 2, moves=True))
+
+	def test_long_files(self):
+		# Over 200 lines, SequenceMatcher treats common lines like
+		# </para> as junk, which changes how ndiff lines the files up.
+		self.assertSameAsNdiff(section_pairs(20, 3, moves=True, paras=(60, 120)))
+
+if __name__ == '__main__':
+	unittest.main()